@@ -9,21 +9,96 @@ A simple Flask application demonstrating:
 - Basic chat between Patient and Receptionist
 """
 
-from flask import Flask, render_template, redirect, url_for, request, session, flash
+from flask import Blueprint, Flask, current_app, has_app_context, has_request_context, render_template, redirect, url_for, request, session, flash, jsonify, Response, stream_with_context, g, make_response
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-from passlib.hash import pbkdf2_sha256
-from sqlalchemy.orm import relationship     
-app = Flask(__name__)
-app.secret_key = "secret_key_for_session"  # Change in production
-
-# Configure SQLite database
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///hospital.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-db = SQLAlchemy(app)
+from flask_sqlalchemy.session import Session as FlaskSession
+from markupsafe import Markup, escape
+from datetime import datetime, timedelta, timezone
+import csv
+import functools
+import io
+import itertools
+import json
+import os
+import re
+import sqlite3
+import threading
+import time as time_module
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.message import EmailMessage
+from types import SimpleNamespace
+from sqlalchemy import Table, and_, event, func, inspect, or_, text, tuple_
+from sqlalchemy.exc import IntegrityError
+import click
+from sqlalchemy.orm import Session, aliased, joinedload, make_transient_to_detached, object_session, relationship     
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.sql.util import find_tables
+from audit import AuditLog, replay
+from identity import IdentityCache
+from jobs import FileSender, JobQueue, SmtpSender, WorkerPool
+from metrics import Metrics
+from passwords import AttemptThrottle, HashingBusy, PasswordHasher
+from reference import CURRENT_SCOPE, ReferenceCache
+from scheduling import AppointmentIndex, AvailabilityCalendar, DoctorSchedule, WEEKDAY_CODES, expand_recurrence, parse_clock, parse_minutes, to_minutes
+from slot_search import find_free_slots
+from config import DEFAULT_SECRET_KEY, PROFILES
+
+DIRECTORY_TABLES = {"users"}  # Shared by every clinic: logins, and which clinic each user belongs to
+
+def current_clinic():
+    """The clinic whose database this app context uses (see CLINICS below); None without clinics."""
+    return g.get("clinic") if has_app_context() else None
+
+def clinic_bind_key(clinic):
+    return f"clinic:{clinic}"
+
+class ClinicSession(FlaskSession):
+    """
+    Sends statements to the current clinic's database, except those reading
+    or writing only the user directory, which always use the default
+    database. Clinic databases hold a copy of their members' user rows, so
+    statements joining users to clinic tables run there.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        clinic = current_clinic()
+        if bind is None and clinic is not None and not self._directory_only(mapper, clause):
+            return self._db.engines[clinic_bind_key(clinic)]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    @staticmethod
+    def _directory_only(mapper, clause):
+        if mapper is not None and inspect(mapper).local_table.name not in DIRECTORY_TABLES:
+            return False
+        if clause is None:
+            return mapper is not None  # Flushing a directory model
+        tables = {table.name for table in find_tables(clause, check_columns=True, include_crud=True)
+                  if isinstance(table, Table)}
+        return bool(tables) and tables <= DIRECTORY_TABLES
+
+# Models, routes and commands bind to no app here; create_app() below wires
+# them to one, so importing this module never touches the database
+db = SQLAlchemy(session_options={"class_": ClinicSession})
+bp = Blueprint("main", __name__, cli_group=None)
+
+# Route, SQL and template timings for /metrics; hooks are only installed when enabled
+metrics = Metrics()
+password_seconds = metrics.histogram("password_hash_seconds", "PBKDF2 hash/verify time, including queueing")
+
+def sqlite_connection_listener(config):
+    """A connect listener applying the configured SQLite journal mode and busy timeout."""
+    def configure_sqlite_connection(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA busy_timeout={int(config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+    return configure_sqlite_connection
 
 # Add datetime.now to template context
-@app.context_processor
+@bp.app_context_processor
 def utility_processor():
     return dict(now=datetime.now)
 
@@ -33,26 +108,49 @@ def utility_processor():
 
 class User(db.Model):
     __tablename__ = "users"
+    __table_args__ = (
+        db.Index("ix_users_role_name", "role", "name"),
+        db.Index("ix_users_clinic_role_name", "clinic", "role", "name"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(50), unique=True, nullable=False)
     password = db.Column(db.String(200), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # "doctor", "patient", "receptionist"
     name = db.Column(db.String(100), nullable=True)
     email = db.Column(db.String(100), nullable=True)
+    clinic = db.Column(db.String(50), nullable=True)  # A CLINIC_DATABASES key; unused without clinics
 
 class DoctorAvailability(db.Model):
     __tablename__ = "doctor_availability"
+    __table_args__ = (db.Index("ix_doctor_availability_doctor_day", "doctor_id", "day_of_week"),)
     id = db.Column(db.Integer, primary_key=True)
     doctor_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     day_of_week = db.Column(db.Integer, nullable=False)  # 0-6 for Monday-Sunday
     start_time = db.Column(db.String(20), nullable=False)
     end_time = db.Column(db.String(20), nullable=False)
+    start_minute = db.Column(db.Integer, nullable=True)  # Minutes after midnight, kept in sync with start_time
+    end_minute = db.Column(db.Integer, nullable=True)
     is_available = db.Column(db.Boolean, default=True)
 
     doctor = relationship("User", backref="availability")
 
+class AvailabilityException(db.Model):
+    """A dated closure (holiday, leave) or extra opening overriding the weekly windows."""
+    __tablename__ = "availability_exceptions"
+    __table_args__ = (db.Index("ix_availability_exceptions_doctor_date", "doctor_id", "date"),)
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    date = db.Column(db.String(20), nullable=False)
+    start_time = db.Column(db.String(20), nullable=True)  # Empty start/end covers the whole day
+    end_time = db.Column(db.String(20), nullable=True)
+    is_available = db.Column(db.Boolean, default=False)  # False = closed, True = extra hours
+    reason = db.Column(db.String(200), nullable=True)
+
+    doctor = relationship("User", backref="availability_exceptions")
+
 class DoctorRate(db.Model):
     __tablename__ = "doctor_rates"
+    __table_args__ = (db.Index("ix_doctor_rates_doctor", "doctor_id"),)
     id = db.Column(db.Integer, primary_key=True)
     doctor_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     rate_per_hour = db.Column(db.Float, nullable=False)
@@ -61,27 +159,62 @@ class DoctorRate(db.Model):
 
     doctor = relationship("User", backref="rate")
 
+class AppointmentSeries(db.Model):
+    """A recurring booking; its occurrences are ordinary appointments sharing series_id."""
+    __tablename__ = "appointment_series"
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    rule = db.Column(db.String(200), nullable=False)  # RRULE-style, e.g. "FREQ=WEEKLY;BYDAY=TU;COUNT=12"
+    first_date = db.Column(db.String(20), nullable=False)
+    time = db.Column(db.String(20), nullable=False)
+    duration = db.Column(db.Integer, default=60)
+    notes = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    doctor = relationship("User", foreign_keys=[doctor_id])
+    patient = relationship("User", foreign_keys=[patient_id])
+
 class Appointment(db.Model):
     __tablename__ = "appointments"
+    __table_args__ = (
+        db.Index("ix_appointments_doctor_start", "doctor_id", "start_at"),
+        db.Index("ix_appointments_patient_start", "patient_id", "start_at"),
+        db.Index("ix_appointments_start", "start_at", "id"),
+        db.Index("ix_appointments_status", "status"),
+        db.Index("ix_appointments_series_start", "series_id", "start_at"),
+        # Backstop for the booking lock: one active appointment per doctor and start time
+        db.Index("uq_appointments_doctor_start_active", "doctor_id", "start_at", unique=True,
+                 sqlite_where=text("status != 'Canceled'"), postgresql_where=text("status != 'Canceled'")),
+    )
     id = db.Column(db.Integer, primary_key=True)
     doctor_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     patient_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     date = db.Column(db.String(20), nullable=False)
     time = db.Column(db.String(20), nullable=False)
     duration = db.Column(db.Integer, default=60)  # Duration in minutes
+    start_at = db.Column(db.DateTime, nullable=True)  # Typed copies of date/time/duration for range queries
+    end_at = db.Column(db.DateTime, nullable=True)
     status = db.Column(db.String(20), default="Scheduled")
     notes = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     is_paid = db.Column(db.Boolean, default=False)
     payment_date = db.Column(db.DateTime, nullable=True)
+    series_id = db.Column(db.Integer, db.ForeignKey("appointment_series.id"), nullable=True)
+    version = db.Column(db.Integer, default=1, nullable=True)  # Optimistic lock; see __mapper_args__
+    reminder_for = db.Column(db.DateTime, nullable=True)  # start_at the patient was last reminded of
 
     doctor = relationship("User", foreign_keys=[doctor_id], backref="appointments_as_doctor")
     patient = relationship("User", foreign_keys=[patient_id], backref="appointments_as_patient")
 
+    # Every ORM UPDATE checks and bumps the version, so a concurrent edit raises StaleDataError
+    __mapper_args__ = {"version_id_col": version}
+    archived = False
+
     def calculate_cost(self):
         """Calculate the cost of the appointment based on doctor's rate and duration"""
-        doctor_rate = DoctorRate.query.filter_by(doctor_id=self.doctor_id).first()
+        doctor_rate = reference_cache.get("rates").get(int(self.doctor_id))
         if not doctor_rate:
             return 0
         
@@ -89,46 +222,90 @@ class Appointment(db.Model):
         hours = (self.duration + 59) // 60  # This will round up to the nearest hour
         return doctor_rate.rate_per_hour * hours
 
+    @property
+    def interval(self):
+        """(start, end) of the appointment in epoch minutes"""
+        start = parse_minutes(self.date, self.time)
+        return start, start + int(self.duration or 60)
+
     def is_time_available(self):
         """Check if the appointment time is available for the doctor"""
-        # Convert date string to datetime
-        appointment_datetime = datetime.strptime(f"{self.date} {self.time}", "%Y-%m-%d %H:%M")
-        day_of_week = appointment_datetime.weekday()
-        
-        # Check doctor's availability for this day
-        availability = DoctorAvailability.query.filter_by(
-            doctor_id=self.doctor_id,
-            day_of_week=day_of_week,
-            is_available=True
-        ).first()
-        
-        if not availability:
+        appointment_day = datetime.strptime(self.date, "%Y-%m-%d").date()
+        start, end = self.interval
+
+        # Check doctor's compiled availability (weekly windows plus dated exceptions)
+        if not availability_calendar.works_on(self.doctor_id, appointment_day):
             return False, "Doctor is not available on this day"
-            
-        # Check if time is within working hours
-        start_time = datetime.strptime(availability.start_time, "%H:%M").time()
-        end_time = datetime.strptime(availability.end_time, "%H:%M").time()
-        appointment_time = appointment_datetime.time()
-        
-        if not (start_time <= appointment_time <= end_time):
+
+        if not availability_calendar.is_available(self.doctor_id, start, end):
             return False, "Appointment time is outside working hours"
-            
-        # Check for existing appointments at the same time
-        existing = Appointment.query.filter(
-            Appointment.doctor_id == self.doctor_id,
-            Appointment.date == self.date,
-            Appointment.time == self.time,
-            Appointment.status != "Canceled",
-            Appointment.id != self.id
-        ).first()
-        
+
+        # Check for existing appointments overlapping [start, start + duration)
+        existing = appointment_index.find_conflict(self.doctor_id, start, end, exclude_id=self.id)
+
         if existing:
             return False, "This time slot is already booked"
             
         return True, "Time slot is available"
 
+class ArchivedAppointment(db.Model):
+    """Canceled or long-past paid appointments moved out of the hot table; see archive_old_records."""
+    __tablename__ = "appointments_archive"
+    __table_args__ = (
+        db.Index("ix_appointments_archive_doctor_start", "doctor_id", "start_at"),
+        db.Index("ix_appointments_archive_patient_start", "patient_id", "start_at"),
+        db.Index("ix_appointments_archive_start", "start_at", "id"),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Same id as in appointments
+    doctor_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    date = db.Column(db.String(20), nullable=False)
+    time = db.Column(db.String(20), nullable=False)
+    duration = db.Column(db.Integer, default=60)
+    start_at = db.Column(db.DateTime, nullable=True)
+    end_at = db.Column(db.DateTime, nullable=True)
+    status = db.Column(db.String(20), default="Scheduled")
+    notes = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    is_paid = db.Column(db.Boolean, default=False)
+    payment_date = db.Column(db.DateTime, nullable=True)
+    series_id = db.Column(db.Integer, nullable=True)
+    version = db.Column(db.Integer, nullable=True)
+    reminder_for = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=True)
+
+    doctor = relationship("User", foreign_keys=[doctor_id])
+    patient = relationship("User", foreign_keys=[patient_id])
+
+    archived = True
+
+    def calculate_cost(self):
+        return Appointment.calculate_cost(self)
+
+class BillingRollup(db.Model):
+    """Billed/paid totals per doctor, patient and day, maintained incrementally."""
+    __tablename__ = "billing_rollups"
+    __table_args__ = (
+        db.UniqueConstraint("doctor_id", "patient_id", "day"),
+        db.Index("ix_billing_rollups_patient_day", "patient_id", "day"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    doctor_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    day = db.Column(db.String(20), nullable=False)
+    appointment_count = db.Column(db.Integer, default=0, nullable=False)
+    billed = db.Column(db.Float, default=0.0, nullable=False)
+    paid = db.Column(db.Float, default=0.0, nullable=False)
+
 class Message(db.Model):
     __tablename__ = "messages"
+    __table_args__ = (
+        # A patient's chat is what they sent plus what was sent to them, by any receptionist
+        db.Index("ix_messages_sender_timestamp", "sender_id", "timestamp"),
+        db.Index("ix_messages_receiver_timestamp", "receiver_id", "timestamp"),
+        db.Index("ix_messages_timestamp", "timestamp"),  # Finds messages past the retention window
+    )
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -139,39 +316,947 @@ class Message(db.Model):
     sender = relationship("User", foreign_keys=[sender_id], backref="sent_messages")
     receiver = relationship("User", foreign_keys=[receiver_id], backref="received_messages")
 
+class ArchivedMessage(db.Model):
+    """Chat messages older than the retention window; read through by conversation_messages."""
+    __tablename__ = "messages_archive"
+    __table_args__ = (
+        db.Index("ix_messages_archive_sender_timestamp", "sender_id", "timestamp"),
+        db.Index("ix_messages_archive_receiver_timestamp", "receiver_id", "timestamp"),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Same id as in messages
+    sender_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=True)
+
+class Conversation(db.Model):
+    """One row per patient chat, updated on every message insert for the receptionist inbox."""
+    __tablename__ = "conversations"
+    __table_args__ = (
+        db.Index("ix_conversations_receptionist_activity", "receptionist_id", "last_message_at"),
+        db.Index("ix_conversations_awaiting", "awaiting_reply", "receptionist_id", "awaiting_since"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey("users.id"), unique=True, nullable=False)
+    receptionist_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    last_sender_id = db.Column(db.Integer, nullable=True)
+    last_preview = db.Column(db.String(200), nullable=True)
+    unread_for_receptionist = db.Column(db.Integer, default=0, nullable=False)
+    unread_for_patient = db.Column(db.Integer, default=0, nullable=False)
+    awaiting_reply = db.Column(db.Boolean, default=False, nullable=True)  # The patient spoke last
+    awaiting_since = db.Column(db.DateTime, nullable=True)  # The patient's first unanswered message
+
+    patient = relationship("User", foreign_keys=[patient_id])
+    receptionist = relationship("User", foreign_keys=[receptionist_id])
+
+class ReceptionistPresence(db.Model):
+    """Whether a receptionist is taking chats, and how quickly they reply, for conversation routing."""
+    __tablename__ = "receptionist_presence"
+    receptionist_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    status = db.Column(db.String(20), default="offline", nullable=False)  # "online", "away" or "offline"
+    last_seen_at = db.Column(db.DateTime, nullable=True)
+    last_assigned_at = db.Column(db.DateTime, nullable=True)  # Ties in load go to whoever waited longest
+    replies = db.Column(db.Integer, default=0, nullable=False)
+    reply_seconds = db.Column(db.Float, default=0, nullable=False)  # Total time patients waited for those replies
+
+class AuditEvent(db.Model):
+    """Append-only history of appointment and rate changes, written in batches by audit_log."""
+    __tablename__ = "audit_events"
+    __table_args__ = (db.Index("ix_audit_events_entity", "entity", "entity_id", "at"),)
+    id = db.Column(db.Integer, primary_key=True)
+    at = db.Column(db.DateTime, nullable=False)
+    entity = db.Column(db.String(20), nullable=False)  # "appointment", or "rate" keyed by the doctor's id
+    entity_id = db.Column(db.Integer, nullable=False)  # No foreign key: history outlives archival and deletes
+    action = db.Column(db.String(20), nullable=False)  # booked, canceled, rescheduled, paid, rate_changed
+    actor_id = db.Column(db.Integer, nullable=True)    # The logged-in user, if any
+    data = db.Column(db.Text, nullable=False)          # JSON fields as they stood after the change
+
+class Job(db.Model):
+    """Background work claimed and run by jobs.JobQueue workers."""
+    __tablename__ = "jobs"
+    __table_args__ = (
+        db.Index("ix_jobs_status_run_at", "status", "run_at"),
+        db.Index("ix_jobs_dedupe_status", "dedupe_key", "status"),
+        db.Index("ix_jobs_status_finished_at", "status", "finished_at"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=True)  # JSON keyword arguments for the handler
+    status = db.Column(db.String(20), default="queued", nullable=False)  # queued, running, done, failed
+    run_at = db.Column(db.DateTime, nullable=False)  # When due; while running, when the lease expires
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    max_attempts = db.Column(db.Integer, default=5, nullable=False)
+    locked_by = db.Column(db.String(100), nullable=True)
+    dedupe_key = db.Column(db.String(100), nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+def appointment_bounds(date, time, duration):
+    """Typed (start_at, end_at) for the string date/time columns."""
+    start_at = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
+    return start_at, start_at + timedelta(minutes=int(duration or 60))
+
+@event.listens_for(Appointment, "before_insert")
+@event.listens_for(Appointment, "before_update")
+def sync_appointment_bounds(mapper, connection, appointment):
+    appointment.start_at, appointment.end_at = appointment_bounds(
+        appointment.date, appointment.time, appointment.duration
+    )
+
+@event.listens_for(DoctorAvailability, "before_insert")
+@event.listens_for(DoctorAvailability, "before_update")
+def sync_availability_minutes(mapper, connection, availability):
+    availability.start_minute = parse_clock(availability.start_time)
+    availability.end_minute = parse_clock(availability.end_time)
+
+###############################################################################
+#                                   CLINICS                                   #
+###############################################################################
+
+# With CLINIC_DATABASES set, each clinic's appointments, chats, billing, jobs
+# and audit trail live in its own database, so one clinic's writes never wait
+# for another's lock. The default database becomes the user directory: logins
+# read it, and the logged-in user's clinic picks the database for the rest of
+# the request (ClinicSession). Clinic databases keep a copy of their members'
+# user rows, refreshed whenever a directory row changes.
+
+def clinic_names():
+    """Every configured clinic, or [None] for the one database without clinics."""
+    return list(current_app.config["CLINIC_DATABASES"]) or [None]
+
+def clinic_engine(clinic):
+    return db.engines[clinic_bind_key(clinic)] if clinic else db.engine
+
+def database_engine():
+    """The engine holding the current clinic's data (the only one without clinics)."""
+    return clinic_engine(current_clinic())
+
+def user_clinic(user):
+    """A user's clinic; users from before clinics were configured belong to the first one."""
+    if not current_app.config["CLINIC_DATABASES"]:
+        return None
+    return user.clinic or clinic_names()[0]
+
+def use_clinic(clinic):
+    """Send the app context's later statements to `clinic`'s database (None: the directory)."""
+    g.clinic = clinic
+
+@contextmanager
+def clinic_context(clinic, app=None):
+    """A new app context, with its own session, whose statements go to `clinic`'s database."""
+    with (app or current_app._get_current_object()).app_context():
+        use_clinic(clinic)
+        yield
+
+def clinic_members():
+    """Criteria keeping a User query to the current clinic's members; none without clinics."""
+    clinic = current_clinic()
+    return [User.clinic == clinic] if clinic else []
+
+def in_current_clinic(user):
+    return user is not None and user_clinic(user) == current_clinic()
+
+def outside_clinic(*user_ids):
+    """
+    Whether any of `user_ids` is unknown or belongs to another clinic. Checked
+    before a doctor's per-process schedule caches are filled, since a doctor
+    from another clinic would look fully free here. Always False without clinics.
+    """
+    if not current_app.config["CLINIC_DATABASES"]:
+        return False
+    return not all(in_current_clinic(load_user(user_id)) for user_id in user_ids)
+
+@bp.before_app_request
+def select_clinic():
+    if current_app.config["CLINIC_DATABASES"] and session.get("user_id") is not None:
+        user = load_user(session["user_id"])
+        if user is not None:
+            use_clinic(user_clinic(user))
+
+def replicate_users(user_ids=None):
+    """
+    Copy directory rows (all, or those in `user_ids`) into their clinics'
+    databases, inserting or overwriting. Uses its own connections, so it can
+    run after a commit. Returns how many rows were copied.
+    """
+    if not current_app.config["CLINIC_DATABASES"]:
+        return 0
+    users = User.__table__
+    query = db.select(users)
+    if user_ids is not None:
+        query = query.where(users.c.id.in_(list(user_ids)))
+    by_clinic = {}
+    with db.engine.connect() as connection:
+        for row in connection.execute(query).mappings():
+            by_clinic.setdefault(row["clinic"] or clinic_names()[0], []).append(dict(row))
+
+    for clinic, rows in by_clinic.items():
+        if clinic not in current_app.config["CLINIC_DATABASES"]:
+            current_app.logger.warning("%d users belong to unknown clinic %r.", len(rows), clinic)
+            continue
+        with clinic_engine(clinic).begin() as connection:
+            existing = db.select(users.c.id)
+            if user_ids is not None:
+                existing = existing.where(users.c.id.in_([row["id"] for row in rows]))
+            existing = set(connection.execute(existing).scalars())
+            updates = [{**row, "user_id": row["id"]} for row in rows if row["id"] in existing]
+            inserts = [row for row in rows if row["id"] not in existing]
+            if updates:
+                connection.execute(db.update(users).where(users.c.id == db.bindparam("user_id")), updates)
+            if inserts:
+                connection.execute(db.insert(users), inserts)
+    return sum(len(rows) for rows in by_clinic.values())
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+def user_directory_changed(mapper, connection, user):
+    object_session(user).info.setdefault("replicate_users", set()).add(user.id)
+
+@event.listens_for(Session, "after_commit")
+def replicate_changed_users(session):
+    user_ids = session.info.pop("replicate_users", None)
+    if user_ids:
+        replicate_users(user_ids)
+
+@event.listens_for(Session, "after_rollback")
+def drop_user_replication(session):
+    session.info.pop("replicate_users", None)
+
+def selected_clinics(clinic=None):
+    """`clinic` (a --clinic option) checked against the configuration, or every clinic if None."""
+    if clinic is None:
+        return clinic_names()
+    if clinic not in current_app.config["CLINIC_DATABASES"]:
+        raise click.BadParameter(f"unknown clinic {clinic!r}", param_hint="--clinic")
+    return [clinic]
+
+def each_clinic(command):
+    """
+    Give a CLI command a --clinic option and run it in that clinic's
+    database, or once in each clinic's database when it is left out.
+    """
+    @click.option("--clinic", default=None, help="Only this clinic (default: every clinic).")
+    @functools.wraps(command)
+    def run(clinic, **kwargs):
+        for name in selected_clinics(clinic):
+            if name:
+                print(f"Clinic {name}:")
+            with clinic_context(name):
+                command(**kwargs)
+    return run
+
+def one_clinic(command):
+    """Give a CLI command a --clinic option, required when clinics are configured, and run it there."""
+    @click.option("--clinic", default=None, help="The clinic whose database to use (required with clinics).")
+    @functools.wraps(command)
+    def run(clinic, **kwargs):
+        if current_app.config["CLINIC_DATABASES"] and clinic is None:
+            raise click.UsageError("--clinic is required when CLINIC_DATABASES is set.")
+        with clinic_context(selected_clinics(clinic)[0]):
+            command(**kwargs)
+    return run
+
+def fan_out(func, *args):
+    """
+    Call func(*args) against every clinic's database at once, each on a pool
+    thread with its own app context and session, so `args` must not be
+    bound to the caller's session. Returns {clinic: result}.
+    """
+    app = current_app._get_current_object()
+    clinics = clinic_names()
+
+    def run(clinic):
+        with clinic_context(clinic, app):
+            return func(*args)
+
+    with ThreadPoolExecutor(max_workers=min(app.config["CLINIC_FANOUT_WORKERS"], len(clinics)),
+                            thread_name_prefix="clinic-fanout") as pool:
+        return dict(zip(clinics, pool.map(run, clinics)))
+
+def clinic_summary():
+    """Today's and upcoming appointments, waiting chats and balances in the current clinic."""
+    now = datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    active = Appointment.status != "Canceled"
+    today_count = db.session.query(func.count(Appointment.id)).filter(
+        Appointment.start_at >= today, Appointment.start_at < today + timedelta(days=1), active).scalar()
+    upcoming = db.session.query(func.count(Appointment.id)).filter(Appointment.start_at >= now, active).scalar()
+    waiting, oldest_wait = db.session.query(func.count(Conversation.id), func.min(Conversation.awaiting_since)).filter(
+        Conversation.awaiting_reply == True).one()
+    billed, paid = db.session.query(func.sum(BillingRollup.billed), func.sum(BillingRollup.paid)).one()
+    return {
+        "appointments_today": today_count,
+        "upcoming_appointments": upcoming,
+        "receptionists_online": len(online_receptionists()),
+        "waiting_chats": waiting,
+        "oldest_wait": oldest_wait.isoformat(timespec="seconds") + "Z" if oldest_wait else None,
+        "billed": round(billed or 0, 2),
+        "paid": round(paid or 0, 2),
+        "outstanding": round((billed or 0) - (paid or 0), 2),
+    }
+
+@bp.route("/reports/clinics", methods=["GET"])
+def clinics_report():
+    """Receptionists' side-by-side view of every clinic, gathered from all clinic databases at once."""
+    user = get_current_user()
+    if not user or user.role != "receptionist":
+        flash("Access denied.", "danger")
+        return redirect(url_for("main.dashboard"))
+
+    rows = [{"clinic": clinic, **summary} for clinic, summary in fan_out(clinic_summary).items()]
+    if request.args.get("format") == "json":
+        return jsonify(clinics=rows)
+    return render_template("clinics_report.html", rows=rows, user=user)
+
 ###############################################################################
 #                            UTILITY & INIT SEQUENCE                           #
 ###############################################################################
 
-# Create all tables (if they don't already exist)
-with app.app_context():
-    db.create_all()
+MIGRATION_BATCH_SIZE = 1000
+
+def add_missing_columns(connection, table):
+    """ALTER TABLE ... ADD COLUMN for nullable model columns missing from the database."""
+    existing = {column["name"] for column in db.inspect(connection).get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name not in existing and column.nullable and not column.primary_key:
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}'))
+            added.append(column.name)
+    return added
+
+# Indexes older versions created that no query uses any more
+OBSOLETE_INDEXES = ("ix_messages_conversation", "ix_messages_archive_conversation")
+
+def migrate_schema():
+    """
+    Bring a database created by an older version up to the current models in
+    place: add new columns, drop obsolete indexes, backfill the typed
+    scheduling columns in batches, and create any indexes missing from
+    existing tables. Works on the current clinic's database.
+    """
+    with database_engine().begin() as connection:
+        for table in db.metadata.sorted_tables:
+            add_missing_columns(connection, table)
+        for name in OBSOLETE_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        connection.execute(db.update(Appointment.__table__).where(
+            Appointment.__table__.c.version.is_(None)).values(version=1))
+
+    while True:
+        rows = db.session.query(
+            Appointment.id, Appointment.date, Appointment.time, Appointment.duration, Appointment.version
+        ).filter(Appointment.start_at.is_(None)).limit(MIGRATION_BATCH_SIZE).all()
+        if not rows:
+            break
+        updates = []
+        for appointment_id, date, time, duration, version in rows:
+            start_at, end_at = appointment_bounds(date, time, duration)
+            updates.append({"id": appointment_id, "start_at": start_at, "end_at": end_at, "version": version})
+        db.session.execute(db.update(Appointment), updates)
+        db.session.commit()
+
+    rows = DoctorAvailability.query.filter(DoctorAvailability.start_minute.is_(None)).all()
+    for availability in rows:
+        sync_availability_minutes(None, None, availability)
+    db.session.commit()
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                with database_engine().begin() as connection:
+                    index.create(connection, checkfirst=True)
+            except IntegrityError:
+                # Existing rows violate a unique index (e.g. old double bookings); keep serving
+                current_app.logger.warning("Could not create %s: existing rows violate it.", index.name)
+
+def hot_queries():
+    """The per-request queries each index exists for, keyed by a short description."""
+    some_id, some_day = 1, datetime(2000, 1, 1)
+    return {
+        "appointment index load": db.session.query(Appointment.id, Appointment.start_at, Appointment.end_at).filter(
+            Appointment.doctor_id == some_id, Appointment.status != "Canceled"),
+        "doctor appointments page": Appointment.query.filter(
+            Appointment.doctor_id == some_id, Appointment.start_at > some_day).order_by(Appointment.start_at),
+        "patient appointments page": Appointment.query.filter(
+            Appointment.patient_id == some_id, Appointment.start_at > some_day).order_by(Appointment.start_at),
+        "appointments by status": Appointment.query.filter(Appointment.status == "Scheduled"),
+        "series occurrences": Appointment.query.filter(
+            Appointment.series_id == some_id, Appointment.start_at >= some_day).order_by(Appointment.start_at),
+        "all appointments page": Appointment.query.filter(
+            Appointment.start_at > some_day).order_by(Appointment.start_at, Appointment.id),
+        "patient chat, sent": Message.query.filter(Message.sender_id == some_id).order_by(Message.timestamp),
+        "patient chat, received": Message.query.filter(Message.receiver_id == some_id).order_by(Message.timestamp),
+        "chat queue depth": db.session.query(Conversation.receptionist_id, func.count()).filter(
+            Conversation.awaiting_reply == True, Conversation.receptionist_id.in_((1, 2))
+        ).group_by(Conversation.receptionist_id),
+        "waiting conversations": db.session.query(Conversation.id).filter(
+            Conversation.awaiting_reply == True).order_by(Conversation.awaiting_since),
+        "users by role": User.query.filter_by(role="doctor"),
+        "patient typeahead": User.query.filter(
+            User.role == "patient", User.name >= "Jo", User.name < "Jo\U0010ffff"),
+        "clinic patient typeahead": User.query.filter(
+            User.clinic == "north", User.role == "patient", User.name >= "Jo", User.name < "Jo\U0010ffff"),
+        "doctor availability": DoctorAvailability.query.filter_by(doctor_id=some_id, is_available=True),
+        "availability exceptions": AvailabilityException.query.filter_by(doctor_id=some_id),
+        "doctor rate": DoctorRate.query.filter_by(doctor_id=some_id),
+        "doctor billing report": BillingRollup.query.filter_by(doctor_id=some_id),
+        "patient billing report": BillingRollup.query.filter_by(patient_id=some_id),
+        "due jobs": Job.query.filter(Job.status.in_(("queued", "running")), Job.run_at <= some_day),
+        "job dedupe": Job.query.filter_by(dedupe_key="send_reminders", status="queued"),
+        "finished jobs": db.session.query(Job.id).filter(Job.status == "done", Job.finished_at < some_day),
+        "archive candidates": db.session.query(Appointment.id).filter(
+            Appointment.start_at < some_day,
+            or_(Appointment.status == "Canceled", and_(Appointment.is_paid == True, Appointment.start_at < some_day))
+        ).order_by(Appointment.start_at),
+        "old messages": db.session.query(Message.id).filter(Message.timestamp < some_day).order_by(Message.timestamp),
+        "archived appointments page": ArchivedAppointment.query.filter(
+            ArchivedAppointment.patient_id == some_id, ArchivedAppointment.start_at > some_day
+        ).order_by(ArchivedAppointment.start_at),
+        "audit history": AuditEvent.query.filter_by(entity="appointment", entity_id=some_id).order_by(
+            AuditEvent.at, AuditEvent.id),
+        "reminder sweep": Appointment.query.filter(
+            Appointment.start_at > some_day, Appointment.start_at <= some_day + timedelta(hours=24)),
+    }
+
+@bp.cli.command("explain-queries")
+@each_clinic
+def explain_queries_command():
+    """Print EXPLAIN QUERY PLAN for the hot queries and fail if one scans a whole table."""
+    if database_engine().dialect.name != "sqlite":
+        print("explain-queries only understands SQLite query plans.")
+        return
+    full_scans = []
+    for name, query in hot_queries().items():
+        sql = str(query.statement.compile(dialect=database_engine().dialect, compile_kwargs={"literal_binds": True}))
+        plan = [row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + sql))]
+        # A plain "SCAN <table>" without an index means every row is read
+        scans = [step for step in plan if step.startswith("SCAN") and "INDEX" not in step]
+        if scans:
+            full_scans.append(name)
+        print(f"{'FULL SCAN' if scans else 'ok':>9}  {name}: {'; '.join(plan)}")
+    if full_scans:
+        raise SystemExit(f"{len(full_scans)} hot queries are not covered by an index.")
+
+@bp.cli.command("init-db")
+def init_db_command():
+    """Create or migrate the schema and build derived tables; run once per deploy."""
+    init_database()
+    print("Database is up to date.")
+
+# Backfills and derived structures that `flask init-db` sets up after the
+# tables exist, in the order they are defined below
+INIT_STEPS = []
+
+def init_step(func):
+    INIT_STEPS.append(func)
+    return func
+
+def init_database():
+    """
+    Create all tables (if they don't already exist), migrate older ones in
+    place and run the init steps, in the default database and every clinic's.
+    """
+    for clinic in dict.fromkeys([None] + clinic_names()):
+        with clinic_context(clinic):
+            db.metadata.create_all(database_engine())
+            migrate_schema()
+    if current_app.config["CLINIC_DATABASES"]:
+        # Users from before clinics were configured join the first one
+        User.query.filter(User.clinic.is_(None)).update({"clinic": clinic_names()[0]})
+        db.session.commit()
+        replicate_users()
+    for clinic in clinic_names():
+        with clinic_context(clinic):
+            for step in INIT_STEPS:
+                step()
+
+def load_doctor_intervals(doctor_id):
+    """Active appointment intervals for one doctor, used to fill the appointment index."""
+    rows = db.session.query(
+        Appointment.id, Appointment.start_at, Appointment.end_at
+    ).filter(
+        Appointment.doctor_id == doctor_id,
+        Appointment.status != "Canceled"
+    )
+    for appointment_id, start_at, end_at in rows:
+        yield appointment_id, to_minutes(start_at), to_minutes(end_at)
+
+# Per-doctor interval index used by Appointment.is_time_available
+appointment_index = AppointmentIndex(lambda doctor_id: list(load_doctor_intervals(doctor_id)))
+
+def load_doctor_calendar(doctor_id):
+    """Weekly windows and dated exceptions for one doctor, compiled by the availability calendar."""
+    windows = [
+        (a.day_of_week, a.start_minute, a.end_minute)
+        for a in DoctorAvailability.query.filter_by(doctor_id=doctor_id, is_available=True)
+    ]
+    exceptions = [
+        (e.date, e.start_time, e.end_time, e.is_available)
+        for e in AvailabilityException.query.filter_by(doctor_id=doctor_id)
+    ]
+    return windows, exceptions
+
+# Compiled availability bitsets, invalidated whenever manage_availability writes
+availability_calendar = AvailabilityCalendar(load_doctor_calendar)
+
+def lock_doctor_schedule(doctor_id):
+    """
+    Serialize bookings for one doctor until the transaction ends. Server
+    databases lock the doctor's user row with SELECT ... FOR UPDATE; SQLite
+    only has a database-wide write lock, taken up front with BEGIN IMMEDIATE.
+    """
+    if database_engine().dialect.name == "sqlite":
+        begin_write_transaction()
+    else:
+        db.session.query(User.id).filter_by(id=doctor_id).with_for_update().one()
+
+def begin_write_transaction():
+    """
+    On SQLite, take the write lock when the transaction starts (BEGIN IMMEDIATE)
+    instead of at its first write, so a read-then-write cannot fail midway
+    because another connection wrote in between. No-op elsewhere.
+    """
+    if database_engine().dialect.name != "sqlite":
+        return
+    connection = db.session.connection()
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+def claim_slots(doctor_id, bounds, exclude_ids=()):
+    """
+    Lock the doctor's schedule and re-check (start_at, end_at) bounds against
+    the committed appointments. The appointment index is per process, so this
+    is what stops two workers from booking the same slot. Returns the start
+    of the first clash, or None; call abandon_booking on a clash.
+    """
+    lock_doctor_schedule(doctor_id)
+    first = min(start_at for start_at, _ in bounds)
+    last = max(end_at for _, end_at in bounds)
+    rows = db.session.query(Appointment.id, Appointment.start_at, Appointment.end_at).filter(
+        Appointment.doctor_id == doctor_id,
+        Appointment.status != "Canceled",
+        Appointment.start_at < last,
+        Appointment.end_at > first
+    )
+    booked = DoctorSchedule(
+        (appointment_id, to_minutes(start_at), to_minutes(end_at))
+        for appointment_id, start_at, end_at in rows if appointment_id not in exclude_ids
+    )
+    for start_at, end_at in bounds:
+        if booked.find_overlap(to_minutes(start_at), to_minutes(end_at)):
+            return start_at
+    return None
+
+# Raised at flush/commit by a concurrent edit (stale version) or a slot taken under the unique index
+BOOKING_CONFLICTS = (IntegrityError, StaleDataError)
+
+def abandon_booking(doctor_id):
+    """Roll back a booking that lost a race and drop the doctor's now-stale index."""
+    db.session.rollback()
+    appointment_index.invalidate(doctor_id)
+
+# Sized from the app's config by create_app()
+password_hasher = ip_throttle = account_throttle = None
 
 def hash_password(password):
-    return pbkdf2_sha256.hash(password)
+    with metrics.timer(password_seconds, operation="hash"):
+        return password_hasher.hash(password)
 
 def verify_password(password, hashed):
-    return pbkdf2_sha256.verify(password, hashed)
+    with metrics.timer(password_seconds, operation="verify"):
+        return password_hasher.verify(password, hashed)
+
+def server_busy(template):
+    """Answer 503 with Retry-After when the hashing pool is saturated."""
+    flash("The server is busy right now. Please try again in a moment.", "warning")
+    return render_template(template), 503, {"Retry-After": "2"}
+
+identity_cache = IdentityCache()  # Sized by create_app()
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_cached_user(mapper, connection, user):
+    identity_cache.invalidate(user.id)
+
+def _user_snapshot(user):
+    # A detached copy that can be merged into any later session without a query
+    snapshot = User(**{column.key: getattr(user, column.key) for column in User.__table__.columns})
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+def load_user(user_id):
+    """
+    User by id, memoized for the request on flask.g and cached across
+    requests in the identity cache. Returns None if the user does not exist.
+    """
+    user_id = int(user_id)
+    memo = g.setdefault("users", {})
+    if user_id in memo:
+        return memo[user_id]
+
+    cached = identity_cache.get(user_id)
+    if cached is not None:
+        user = db.session.merge(cached, load=False)
+    else:
+        version = identity_cache.version(user_id)
+        user = User.query.get(user_id)
+        if user is not None:
+            identity_cache.put(user_id, _user_snapshot(user), version)
+    memo[user_id] = user
+    return user
 
 def get_current_user():
-    """Returns the current logged-in user object from DB, or None if not logged in."""
+    """Returns the current logged-in user object, or None if not logged in."""
     if "user_id" in session:
-        return User.query.get(session["user_id"])
+        return load_user(session["user_id"])
     return None
 
+# Doctors, receptionists, rates and availability tables, invalidated after the writing transaction
+# commits; each clinic has its own copy
+reference_cache = ReferenceCache(scope=current_clinic)  # TTL set by create_app()
+
+def _row_snapshot(row):
+    # Read-only copy that templates can use after the session is gone
+    return SimpleNamespace(**{column.key: getattr(row, column.key) for column in row.__table__.columns})
+
+def load_doctor_directory(_):
+    return [SimpleNamespace(id=doctor_id, name=name) for doctor_id, name in
+            db.session.query(User.id, User.name).filter(User.role == "doctor", *clinic_members()).order_by(User.id)]
+
+def load_receptionist_directory(_):
+    return [SimpleNamespace(id=receptionist_id, name=name) for receptionist_id, name in
+            db.session.query(User.id, User.name).filter(User.role == "receptionist", *clinic_members()).order_by(User.id)]
+
+def load_doctor_rates(_):
+    # Highest id first so the oldest row wins, matching DoctorRate.query...first()
+    return {rate.doctor_id: _row_snapshot(rate) for rate in DoctorRate.query.order_by(DoctorRate.id.desc())}
+
+def load_availability_tables(doctor_id):
+    windows = DoctorAvailability.query.filter_by(doctor_id=doctor_id).order_by(
+        DoctorAvailability.day_of_week, DoctorAvailability.start_time
+    )
+    exceptions = AvailabilityException.query.filter_by(doctor_id=doctor_id).order_by(
+        AvailabilityException.date, AvailabilityException.start_time
+    )
+    return [_row_snapshot(w) for w in windows], [_row_snapshot(e) for e in exceptions]
+
+reference_cache.register("doctors", load_doctor_directory)
+reference_cache.register("receptionists", load_receptionist_directory)
+reference_cache.register("rates", load_doctor_rates)
+reference_cache.register("availability", load_availability_tables)
+
+def mark_reference_stale(session, name, key=None, scope=CURRENT_SCOPE):
+    """Invalidate a reference dataset once `session` commits (dropped on rollback)."""
+    scope = current_clinic() if scope is CURRENT_SCOPE else scope
+    session.info.setdefault("stale_reference", set()).add((name, key, scope))
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def user_reference_changed(mapper, connection, user):
+    if user.role in ("doctor", "receptionist"):
+        # The directory is written from any clinic; the user's own clinic lists them
+        mark_reference_stale(object_session(user), f"{user.role}s", scope=user_clinic(user))
+
+@event.listens_for(DoctorRate, "after_insert")
+@event.listens_for(DoctorRate, "after_update")
+@event.listens_for(DoctorRate, "after_delete")
+def rate_reference_changed(mapper, connection, rate):
+    mark_reference_stale(object_session(rate), "rates")
+
+@event.listens_for(DoctorAvailability, "after_insert")
+@event.listens_for(DoctorAvailability, "after_update")
+@event.listens_for(DoctorAvailability, "after_delete")
+@event.listens_for(AvailabilityException, "after_insert")
+@event.listens_for(AvailabilityException, "after_update")
+@event.listens_for(AvailabilityException, "after_delete")
+def availability_reference_changed(mapper, connection, row):
+    mark_reference_stale(object_session(row), "availability", row.doctor_id)
+
+@event.listens_for(Session, "after_commit")
+def drop_stale_reference_data(session):
+    for name, key, scope in session.info.pop("stale_reference", ()):
+        reference_cache.invalidate(name, key, scope)
+
+@event.listens_for(Session, "after_rollback")
+def keep_reference_data(session):
+    session.info.pop("stale_reference", None)
+
+def page_validators(user, datasets, *extra, last_modified=None):
+    """
+    (etag, last_modified) for a page rendered for `user` from reference
+    `datasets` ((name, key) pairs) and any `extra` values it depends on.
+    Load the datasets before calling so the versions match what is rendered.
+    """
+    etag = reference_cache.etag(datasets, user.id, user.name, datetime.now().date(), *extra)
+    times = [reference_cache.last_modified(name, key) for name, key in datasets]
+    if last_modified:
+        times.append(last_modified.replace(tzinfo=timezone.utc, microsecond=0))
+    return etag, max(times)
+
+def conditional_render(validators, template, **context):
+    """
+    Render `template` with ETag/Last-Modified, or answer 304 when the
+    client's copy is current. Pending flash messages always get a full page.
+    """
+    etag, last_modified = validators
+    if not session.get("_flashes"):
+        if request.if_none_match:
+            if request.if_none_match.contains(etag):
+                return _not_modified(etag, last_modified)
+        elif request.if_modified_since and last_modified <= request.if_modified_since:
+            return _not_modified(etag, last_modified)
+    response = make_response(render_template(template, **context))
+    return _with_validators(response, etag, last_modified)
+
+def conditional_json(validators, payload):
+    """JSON counterpart of conditional_render for API reads."""
+    etag, last_modified = validators
+    if request.if_none_match.contains(etag):
+        return _not_modified(etag, last_modified)
+    return _with_validators(jsonify(payload), etag, last_modified)
+
+def _not_modified(etag, last_modified):
+    return _with_validators(Response(status=304), etag, last_modified)
+
+def _with_validators(response, etag, last_modified):
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"  # Always revalidate; never share
+    response.vary.add("Cookie")
+    return response
+
+###############################################################################
+#                               BILLING ENGINE                                #
+###############################################################################
+
+def appointment_cost_expression(model=Appointment):
+    """SQL expression for Appointment.calculate_cost; needs DoctorRate outer-joined."""
+    hours = (func.coalesce(model.duration, 60) + 59) // 60
+    return func.coalesce(DoctorRate.rate_per_hour, 0) * hours
+
+def billing_snapshot(appointment):
+    """
+    What an appointment currently contributes to the rollups, as
+    (doctor_id, patient_id, day, count, billed, paid). Canceled ones add nothing.
+    """
+    if appointment.status == "Canceled":
+        return None
+    cost = appointment.calculate_cost()
+    return (int(appointment.doctor_id), int(appointment.patient_id), appointment.date,
+            1, cost, cost if appointment.is_paid else 0.0)
+
+def _bump_rollup(doctor_id, patient_id, day, count, billed, paid):
+    # Increment in SQL so concurrent writers cannot lose each other's updates
+    updated = BillingRollup.query.filter_by(
+        doctor_id=doctor_id, patient_id=patient_id, day=day
+    ).update({
+        BillingRollup.appointment_count: BillingRollup.appointment_count + count,
+        BillingRollup.billed: BillingRollup.billed + billed,
+        BillingRollup.paid: BillingRollup.paid + paid,
+    }, synchronize_session=False)
+    if not updated:
+        db.session.add(BillingRollup(
+            doctor_id=doctor_id, patient_id=patient_id, day=day,
+            appointment_count=count, billed=billed, paid=paid
+        ))
+
+def bump_rollups_for(rows, sign=1):
+    """
+    Fold many appointments, given as dicts with doctor_id, patient_id, date,
+    duration, status and is_paid, into the rollups with one bump per
+    (doctor, patient, day). sign=-1 takes them back out.
+    """
+    doctor_ids = {row["doctor_id"] for row in rows}
+    rates = dict(db.session.query(DoctorRate.doctor_id, DoctorRate.rate_per_hour).filter(
+        DoctorRate.doctor_id.in_(doctor_ids or [0])
+    ))
+    totals = {}
+    for row in rows:
+        if row["status"] == "Canceled":
+            continue
+        cost = rates.get(row["doctor_id"], 0) * ((int(row["duration"] or 60) + 59) // 60)
+        key = (row["doctor_id"], row["patient_id"], row["date"])
+        count, billed, paid = totals.get(key, (0, 0.0, 0.0))
+        totals[key] = (count + 1, billed + cost, paid + (cost if row["is_paid"] else 0.0))
+    for key, (count, billed, paid) in totals.items():
+        _bump_rollup(*key, sign * count, sign * billed, sign * paid)
+
+def record_billing_change(appointment, before=None):
+    """
+    Apply the difference between `before` (a billing_snapshot taken prior to
+    the change, or None for a new booking) and the appointment's current
+    state. Call before committing so the rollup moves in the same transaction.
+    """
+    after = billing_snapshot(appointment)
+    if before == after:
+        return
+    if before:
+        _bump_rollup(*before[:3], -before[3], -before[4], -before[5])
+    if after:
+        _bump_rollup(*after)
+
+def rebuild_billing_rollups(doctor_id=None):
+    """Recompute rollups set-based from appointments (hot and archived), for one doctor or everyone."""
+    stale = BillingRollup.query
+    if doctor_id is not None:
+        stale = stale.filter_by(doctor_id=doctor_id)
+    stale.delete(synchronize_session=False)
+
+    # Archived appointments still count: they were billed, they just live elsewhere
+    live = db.union_all(*(
+        db.select(model.doctor_id, model.patient_id, model.date, model.duration, model.is_paid).where(
+            model.status != "Canceled", *([model.doctor_id == doctor_id] if doctor_id is not None else []))
+        for model in (Appointment, ArchivedAppointment)
+    )).subquery()
+    cost = appointment_cost_expression(live.c)
+    source = db.select(
+        live.c.doctor_id,
+        live.c.patient_id,
+        live.c.date,
+        func.count(),
+        func.sum(cost),
+        func.sum(db.case((live.c.is_paid == True, cost), else_=0.0)),
+    ).select_from(live).outerjoin(
+        DoctorRate, DoctorRate.doctor_id == live.c.doctor_id
+    ).group_by(live.c.doctor_id, live.c.patient_id, live.c.date)
+
+    db.session.execute(db.insert(BillingRollup).from_select(
+        ["doctor_id", "patient_id", "day", "appointment_count", "billed", "paid"], source
+    ))
+
+@bp.cli.command("rebuild-billing")
+@each_clinic
+def rebuild_billing_command():
+    """Recompute every billing rollup from the appointments table."""
+    rebuild_billing_rollups()
+    db.session.commit()
+    print(f"Rebuilt {BillingRollup.query.count()} billing rollup rows.")
+
+@init_step
+def backfill_billing_rollups():
+    """Backfill rollups for databases created before the billing engine existed."""
+    if not db.session.query(BillingRollup.id).first() and db.session.query(Appointment.id).first():
+        rebuild_billing_rollups()
+        db.session.commit()
+
+###############################################################################
+#                                  AUDIT LOG                                  #
+###############################################################################
+
+# Writers stage events in their transaction (like billing changes); they are
+# handed to audit_log after the commit and written behind the request in batches.
+# Bulk imports are history being migrated, not changes, and are not audited.
+
+audit_written = metrics.counter("audit_events_total", "Audit events written to audit_events")
+audit_flush_seconds = metrics.histogram("audit_flush_seconds", "Time to write one batch of audit events")
+
+def observe_audit_flush(count, seconds):
+    audit_written.inc(count)
+    audit_flush_seconds.observe(seconds)
+
+audit_log = AuditLog(observe=observe_audit_flush)  # Writer and batching set by create_app()
+
+AUDITED_APPOINTMENT_FIELDS = ("doctor_id", "patient_id", "date", "time", "duration", "status", "is_paid")
+
+def audit_writer(app):
+    """
+    Insert one batch of events outside any request, one transaction per
+    clinic database the events belong to. If one clinic's insert fails after
+    another's committed, the whole batch is retried and the committed events
+    are written twice; history is never lost.
+    """
+    def write(rows):
+        by_clinic = {}
+        for row in rows:
+            row = dict(row)
+            by_clinic.setdefault(row.pop("clinic", None), []).append(row)
+        with app.app_context():
+            for clinic, clinic_rows in by_clinic.items():
+                with clinic_engine(clinic).begin() as connection:
+                    connection.execute(AuditEvent.__table__.insert(), clinic_rows)
+    return write
+
+def auditing():
+    return current_app.config["AUDIT_ENABLED"]
+
+def audit(entity, entity_id, action, data):
+    """Stage an event in the current transaction: logged once it commits, dropped on rollback."""
+    if not auditing():
+        return
+    db.session.info.setdefault("audit_events", []).append({
+        "at": datetime.utcnow(),
+        "entity": entity,
+        "entity_id": int(entity_id),
+        "action": action,
+        "actor_id": session.get("user_id") if has_request_context() else None,
+        "data": json.dumps(data),
+        "clinic": current_clinic(),  # Which database the writer puts it in
+    })
+
+def audit_appointment(action, appointment):
+    """Stage an appointment's audited fields after `action`; takes a model or a row dict with "id"."""
+    if not isinstance(appointment, dict):
+        appointment = {field: getattr(appointment, field) for field in ("id",) + AUDITED_APPOINTMENT_FIELDS}
+    data = {field: appointment[field] for field in AUDITED_APPOINTMENT_FIELDS}
+    data["is_paid"] = bool(data["is_paid"])
+    audit("appointment", appointment["id"], action, data)
+
+@event.listens_for(Session, "after_commit")
+def hand_over_audit_events(session):
+    events = session.info.pop("audit_events", None)
+    if events:
+        audit_log.record(events)
+
+@event.listens_for(Session, "after_rollback")
+def drop_audit_events(session):
+    session.info.pop("audit_events", None)
+
+def audit_history(entity, entity_id):
+    """
+    An entity's events, oldest first, including any still buffered by this
+    process; other processes' events can lag by up to AUDIT_FLUSH_SECONDS.
+    """
+    audit_log.flush()
+    rows = AuditEvent.query.filter_by(entity=entity, entity_id=entity_id).order_by(AuditEvent.at, AuditEvent.id)
+    return [{"at": row.at, "action": row.action, "actor_id": row.actor_id, "data": json.loads(row.data)}
+            for row in rows]
+
+def appointment_state_at(appointment_id, at=None):
+    """
+    Rebuild an appointment as it stood at `at` (UTC, default now) from the
+    audit log, with the doctor's rate at that moment and the cost it gave.
+    Returns (state, events up to `at`); state is None before the
+    appointment's first audited change, and the rate None before the
+    doctor's first audited rate change.
+    """
+    events = [row for row in audit_history("appointment", appointment_id) if at is None or row["at"] <= at]
+    state = replay(events)
+    if state is not None:
+        rate = replay(audit_history("rate", state["doctor_id"]), at)
+        state["rate_per_hour"] = rate["rate_per_hour"] if rate else None
+        hours = (int(state["duration"] or 60) + 59) // 60
+        state["cost"] = state["rate_per_hour"] * hours if rate else None
+    return state, events
+
 ###############################################################################
 #                                 AUTH ROUTES                                 #
 ###############################################################################
 
-@app.route("/")
+@bp.route("/")
 def index():
     """Landing page: if logged in, go to dashboard; else show basic home page."""
     user = get_current_user()
     if user:
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("main.dashboard"))
     return render_template("index.html")
 
-@app.route("/signup", methods=["GET", "POST"])
+@bp.route("/signup", methods=["GET", "POST"])
 def signup():
     if request.method == "POST":
         role = request.form.get("role")  # "doctor", "patient", "receptionist"
@@ -179,105 +1264,275 @@ def signup():
         password = request.form.get("password")
         name = request.form.get("name")
         email = request.form.get("email")
+        clinics = list(current_app.config["CLINIC_DATABASES"])
+        clinic = request.form.get("clinic") if clinics else None
+        if clinics and clinic not in clinics:
+            flash("Please choose a clinic.", "danger")
+            return redirect(url_for("main.signup"))
 
         if User.query.filter_by(username=username).first():
             flash("Username already exists.", "danger")
-            return redirect(url_for("signup"))
+            return redirect(url_for("main.signup"))
         
+        try:
+            hashed = hash_password(password)
+        except HashingBusy:
+            return server_busy("signup.html")
+
         user = User(
             username=username,
-            password=hash_password(password),
+            password=hashed,
             role=role,
             name=name,
-            email=email
+            email=email,
+            clinic=clinic
         )
         db.session.add(user)
         db.session.commit()
         flash("Signup successful. Please log in.", "success")
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     
-    return render_template("signup.html")
+    return render_template("signup.html", clinics=list(current_app.config["CLINIC_DATABASES"]))
+
+def check_credentials(username, password, client_ip):
+    """
+    One login attempt under the per-IP and per-account throttles.
+    Returns (user, retry_after): user is None for bad credentials or when
+    throttled, in which case retry_after is the wait in seconds. Raises
+    HashingBusy when the hashing pool is saturated.
+    """
+    retry_after = max(ip_throttle.retry_after(client_ip), account_throttle.retry_after(username))
+    if retry_after:
+        return None, retry_after
+    ip_throttle.record(client_ip)
+
+    user = User.query.filter_by(username=username).first()
+    with metrics.timer(password_seconds, operation="verify"):
+        matches, new_hash = password_hasher.verify_and_update(password, user.password) if user else (False, None)
+
+    if not matches:
+        account_throttle.record(username)
+        return None, 0
+    if new_hash:
+        # Configured rounds changed since this hash was made
+        user.password = new_hash
+        db.session.commit()
+    account_throttle.reset(username)
+    return user, 0
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form.get("username")
-        password = request.form.get("password")
+        try:
+            user, retry_after = check_credentials(username, request.form.get("password"),
+                                                  request.remote_addr or "unknown")
+        except HashingBusy:
+            return server_busy("login.html")
+
+        if retry_after:
+            flash(f"Too many login attempts. Please try again in {retry_after} seconds.", "danger")
+            return render_template("login.html"), 429, {"Retry-After": str(retry_after)}
 
-        user = User.query.filter_by(username=username).first()
-        if user and verify_password(password, user.password):
+        if user:
             # Set session
             session["user_id"] = user.id
+            use_clinic(user_clinic(user))
+            if user.role == "receptionist":
+                set_presence(user.id, "online")
             flash("Login successful.", "success")
-            return redirect(url_for("dashboard"))
+            return redirect(url_for("main.dashboard"))
         else:
             flash("Invalid credentials.", "danger")
-            return redirect(url_for("login"))
+            return redirect(url_for("main.login"))
 
     return render_template("login.html")
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
+    user = get_current_user()
+    if user and user.role == "receptionist":
+        set_presence(user.id, "offline")  # Their waiting patients go to colleagues
     session.clear()
     flash("You have been logged out.", "info")
-    return redirect(url_for("index"))
+    return redirect(url_for("main.index"))
 
 
 ###############################################################################
 #                               DASHBOARD VIEWS                               #
 ###############################################################################
 
-@app.route("/dashboard")
+@bp.route("/dashboard")
 def dashboard():
     user = get_current_user()
     if not user:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     if user.role == "doctor":
         return render_template("dashboard_doctor.html", user=user)
     elif user.role == "patient":
         return render_template("dashboard_patient.html", user=user)
     elif user.role == "receptionist":
-        return render_template("dashboard_receptionist.html", user=user)
+        return render_template("dashboard_receptionist.html", user=user,
+                               clinics=list(current_app.config["CLINIC_DATABASES"]))
     else:
         flash("Unknown role.", "danger")
-        return redirect(url_for("logout"))
+        return redirect(url_for("main.logout"))
 
 ###############################################################################
 #                            APPOINTMENT ROUTES                               #
 ###############################################################################
 
-@app.route("/appointments", methods=["GET"])
-def appointments():
-    """List all appointments relevant to the current user."""
-    user = get_current_user()
-    if not user:
-        return redirect(url_for("login"))
-    
+APPOINTMENTS_PAGE_SIZE = 50
+
+def appointment_page(user, args, limit=APPOINTMENTS_PAGE_SIZE):
+    """
+    One page of (appointment, cost) rows visible to `user`, with doctor, patient
+    and rate loaded in the same query. Filters come from `args`: doctor_id,
+    status, date_from, date_to, and archived=1 to read through to the archive.
+    Pages are keyset-paginated on (start_at, id) via the `after` cursor,
+    `limit` rows at a time. Returns (rows, filters, next_cursor).
+    """
+    filters = {key: args.get(key) for key in ("doctor_id", "status", "date_from", "date_to", "archived")
+               if args.get(key)}
+    try:
+        if "date_from" in filters:
+            datetime.strptime(filters["date_from"], "%Y-%m-%d")
+        if "date_to" in filters:
+            datetime.strptime(filters["date_to"], "%Y-%m-%d")
+    except ValueError:
+        filters.pop("date_from", None)
+        filters.pop("date_to", None)
+
+    after = None
+    cursor = args.get("after")
+    if cursor:
+        try:
+            start_at, appointment_id = cursor.split("|")
+            after = datetime.fromisoformat(start_at), int(appointment_id)
+        except ValueError:
+            after = None
+
+    rows = _appointment_rows(Appointment, user, filters, after, limit)
+    if filters.get("archived"):
+        # Both halves are ordered on (start_at, id); merge them and keep the first page
+        rows += _appointment_rows(ArchivedAppointment, user, filters, after, limit)
+        rows.sort(key=lambda row: (row[0].start_at, row[0].id))
+        rows = rows[:limit + 1]
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1][0]
+        next_cursor = f"{last.start_at.isoformat()}|{last.id}"
+    return rows, filters, next_cursor
+
+def _appointment_rows(model, user, filters, after, limit):
+    # `model` is Appointment or ArchivedAppointment; both have the same columns
+    query = db.session.query(model, appointment_cost_expression(model).label("cost")).outerjoin(
+        DoctorRate, DoctorRate.doctor_id == model.doctor_id
+    ).options(
+        joinedload(model.doctor),
+        joinedload(model.patient)
+    )
+
     # If doctor -> show all for that doctor
     # If patient -> show all for that patient
     # If receptionist -> show all appointments across the board
     if user.role == "doctor":
-        my_appointments = Appointment.query.filter_by(doctor_id=user.id).all()
+        query = query.filter(model.doctor_id == user.id)
     elif user.role == "patient":
-        my_appointments = Appointment.query.filter_by(patient_id=user.id).all()
-    else:  # receptionist
-        my_appointments = Appointment.query.all()
+        query = query.filter(model.patient_id == user.id)
+
+    if "doctor_id" in filters:
+        query = query.filter(model.doctor_id == filters["doctor_id"])
+    if "status" in filters:
+        query = query.filter(model.status == filters["status"])
+    if "date_from" in filters:
+        query = query.filter(model.start_at >= datetime.strptime(filters["date_from"], "%Y-%m-%d"))
+    if "date_to" in filters:
+        date_to = datetime.strptime(filters["date_to"], "%Y-%m-%d") + timedelta(days=1)
+        query = query.filter(model.start_at < date_to)
+
+    if after:
+        start_at, appointment_id = after
+        query = query.filter(or_(
+            model.start_at > start_at,
+            and_(model.start_at == start_at, model.id > appointment_id)
+        ))
+
+    return query.order_by(model.start_at, model.id).limit(limit + 1).all()
+
+@bp.route("/appointments", methods=["GET"])
+def appointments():
+    """List appointments relevant to the current user, one page at a time."""
+    user = get_current_user()
+    if not user:
+        return redirect(url_for("main.login"))
+
+    rows, filters, next_cursor = appointment_page(user, request.args)
+    doctors = reference_cache.get("doctors") if user.role != "doctor" else None
 
-    return render_template("appointments.html", appointments=my_appointments, user=user)
+    return render_template("appointments.html", appointments=rows, user=user,
+                           filters=filters, next_cursor=next_cursor, doctors=doctors)
 
-@app.route("/schedule_appointment", methods=["GET", "POST"])
+def book_appointment(doctor_id, patient_id, date, time, duration=60, notes=""):
+    """
+    Book one appointment: check availability against the in-memory index,
+    then re-check the database under the doctor's lock and commit.
+    Returns (appointment, None), or (None, reason) with nothing written.
+    """
+    if outside_clinic(doctor_id, patient_id):
+        return None, "Doctor and patient must belong to this clinic"
+
+    # Create temporary appointment object to check availability
+    temp_appointment = Appointment(
+        doctor_id=doctor_id,
+        patient_id=patient_id,
+        date=date,
+        time=time,
+        duration=duration
+    )
+
+    is_available, message = temp_appointment.is_time_available()
+    if not is_available:
+        return None, message
+
+    # Another worker may have taken the slot since the index check
+    if claim_slots(doctor_id, [appointment_bounds(date, time, duration)]):
+        abandon_booking(doctor_id)
+        return None, "This time slot is already booked"
+
+    appointment = Appointment(
+        doctor_id=doctor_id,
+        patient_id=patient_id,
+        date=date,
+        time=time,
+        duration=duration,
+        notes=notes,
+        status="Scheduled"
+    )
+    try:
+        db.session.add(appointment)
+        record_billing_change(appointment)
+        db.session.flush()
+        audit_appointment("booked", appointment)
+        db.session.commit()
+    except BOOKING_CONFLICTS:
+        abandon_booking(doctor_id)
+        return None, "This time slot is already booked"
+    appointment_index.add(appointment.doctor_id, appointment.id, *appointment.interval)
+    return appointment, None
+
+@bp.route("/schedule_appointment", methods=["GET", "POST"])
 def schedule_appointment():
     user = get_current_user()
     if not user:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
     
     if user.role not in ["patient", "receptionist"]:
         flash("Access denied.", "danger")
-        return redirect(url_for("dashboard"))
-
-    doctors = User.query.filter_by(role="doctor").all()
-    patients = User.query.filter_by(role="patient").all() if user.role == "receptionist" else None
+        return redirect(url_for("main.dashboard"))
 
     if request.method == "POST":
         doctor_id = request.form.get("doctor_id")
@@ -288,48 +1543,120 @@ def schedule_appointment():
 
         if not all([doctor_id, date, time]):
             flash("All fields are required.", "danger")
-            return redirect(url_for("schedule_appointment"))
+            return redirect(url_for("main.schedule_appointment"))
 
         patient_id = user.id if user.role == "patient" else request.form.get("patient_id")
         if not patient_id:
             flash("Patient selection is required.", "danger")
-            return redirect(url_for("schedule_appointment"))
+            return redirect(url_for("main.schedule_appointment"))
 
-        # Create temporary appointment object to check availability
-        temp_appointment = Appointment(
-            doctor_id=doctor_id,
-            patient_id=patient_id,
-            date=date,
-            time=time,
-            duration=int(duration)
-        )
-        
-        is_available, message = temp_appointment.is_time_available()
-        if not is_available:
-            flash(message, "danger")
-            return redirect(url_for("schedule_appointment"))
+        if outside_clinic(int(doctor_id), int(patient_id)):
+            flash("Doctor and patient must belong to this clinic.", "danger")
+            return redirect(url_for("main.schedule_appointment"))
 
-        appointment = Appointment(
-            doctor_id=doctor_id,
-            patient_id=patient_id,
-            date=date,
-            time=time,
-            duration=int(duration),
-            notes=notes,
-            status="Scheduled"
-        )
-        db.session.add(appointment)
-        db.session.commit()
+        rule = series_rule(request.form, date)
+        if rule:
+            try:
+                booked, failures = book_series(int(doctor_id), int(patient_id), date, time, int(duration), rule, notes)
+            except ValueError as exc:
+                flash(f"Invalid repeat pattern: {exc}", "danger")
+                return redirect(url_for("main.schedule_appointment"))
+            if failures:
+                flash_series_failures(failures)
+                return redirect(url_for("main.schedule_appointment"))
+            flash(f"Booked {booked} recurring appointments.", "success")
+            return redirect(url_for("main.appointments"))
+
+        appointment, message = book_appointment(int(doctor_id), int(patient_id), date, time, int(duration), notes)
+        if not appointment:
+            flash(message, "danger")
+            return redirect(url_for("main.schedule_appointment"))
         flash("Appointment scheduled successfully!", "success")
-        return redirect(url_for("appointments"))
+        return redirect(url_for("main.appointments"))
 
-    return render_template("schedule_appointment.html", doctors=doctors, patients=patients, user=user)
+    # Receptionists pick patients through the /patients/search typeahead
+    doctors = reference_cache.get("doctors")
+    return conditional_render(page_validators(user, [("doctors", None)]), "schedule_appointment.html",
+                              doctors=doctors, user=user)
 
-@app.route("/cancel_appointment/<int:appointment_id>", methods=["POST"])
+@bp.route("/find_slots", methods=["GET"])
+def find_slots():
+    """
+    Earliest free slots across doctors as JSON.
+    Query args: date_from, date_to, duration (minutes), doctor_id (optional), limit.
+    """
+    user = get_current_user()
+    if not user:
+        return jsonify(error="Login required."), 401
+
+    try:
+        today = datetime.now().date()
+        date_from = request.args.get("date_from")
+        date_from = datetime.strptime(date_from, "%Y-%m-%d").date() if date_from else today
+        date_to = request.args.get("date_to")
+        date_to = datetime.strptime(date_to, "%Y-%m-%d").date() if date_to else date_from + timedelta(days=13)
+        duration = int(request.args.get("duration", 60))
+        limit = min(int(request.args.get("limit", 10)), 50)
+    except ValueError:
+        return jsonify(error="Invalid search parameters."), 400
+
+    date_from = max(date_from, today)
+    date_to = min(date_to, date_from + timedelta(days=62))  # Bound the search grid
+
+    doctors = {d.id: d for d in reference_cache.get("doctors")
+               if not request.args.get("doctor_id") or str(d.id) == request.args.get("doctor_id")}
+
+    slots = find_free_slots(
+        availability_calendar, appointment_index, list(doctors),
+        date_from, date_to, duration, limit=limit, not_before=datetime.now()
+    )
+    return jsonify(slots=[
+        {
+            "doctor_id": doctor_id,
+            "doctor_name": doctors[doctor_id].name,
+            "date": start.strftime("%Y-%m-%d"),
+            "time": start.strftime("%H:%M"),
+        }
+        for doctor_id, start in slots
+    ])
+
+PATIENT_SEARCH_LIMIT = 20
+
+def search_patients(query, limit=10):
+    """
+    Patients whose name starts with `query` (as typed or capitalized), or
+    whose username is exactly `query`, in the current clinic. Name prefixes
+    are range scans on ix_users_role_name (ix_users_clinic_role_name with
+    clinics), so lookups stay cheap with a large directory.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    terms = [and_(User.role == "patient", User.username == query)]
+    for prefix in {query, query[:1].upper() + query[1:]}:
+        terms.append(and_(User.role == "patient", User.name >= prefix, User.name < prefix + "\U0010ffff"))
+    return User.query.filter(or_(*terms), *clinic_members()).order_by(User.name).limit(limit).all()
+
+@bp.route("/patients/search", methods=["GET"])
+def patient_search():
+    """Typeahead for patient pickers: ?q=<name prefix or username> -> JSON."""
+    user = get_current_user()
+    if not user or user.role not in ["receptionist", "doctor"]:
+        return jsonify(error="Access denied."), 403
+    try:
+        limit = min(int(request.args.get("limit", 10)), PATIENT_SEARCH_LIMIT)
+    except ValueError:
+        return jsonify(error="Invalid limit."), 400
+    return jsonify(patients=[
+        {"id": p.id, "name": p.name, "username": p.username, "email": p.email}
+        for p in search_patients(request.args.get("q", ""), limit)
+    ])
+
+@bp.route("/cancel_appointment/<int:appointment_id>", methods=["POST"])
 def cancel_appointment(appointment_id):
     user = get_current_user()
     if not user:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     appointment = Appointment.query.get_or_404(appointment_id)
 
@@ -337,33 +1664,42 @@ def cancel_appointment(appointment_id):
     # (patient who booked it, the doctor, or the receptionist)
     if user.role == "patient" and appointment.patient_id != user.id:
         flash("Unauthorized to cancel this appointment.", "danger")
-        return redirect(url_for("appointments"))
+        return redirect(url_for("main.appointments"))
     # Doctors can also cancel their appointments
     if user.role == "doctor" and appointment.doctor_id != user.id:
         flash("Unauthorized to cancel this appointment.", "danger")
-        return redirect(url_for("appointments"))
+        return redirect(url_for("main.appointments"))
     # Receptionist can cancel any appointment
 
+    before = billing_snapshot(appointment)
     appointment.status = "Canceled"
-    db.session.commit()
+    try:
+        record_billing_change(appointment, before)
+        audit_appointment("canceled", appointment)
+        db.session.commit()
+    except BOOKING_CONFLICTS:
+        abandon_booking(appointment.doctor_id)
+        flash("This appointment was changed by someone else. Please try again.", "warning")
+        return redirect(url_for("main.appointments"))
+    appointment_index.remove(appointment.doctor_id, appointment.id)
     flash("Appointment canceled.", "info")
-    return redirect(url_for("appointments"))
+    return redirect(url_for("main.appointments"))
 
-@app.route("/reschedule_appointment/<int:appointment_id>", methods=["GET", "POST"])
+@bp.route("/reschedule_appointment/<int:appointment_id>", methods=["GET", "POST"])
 def reschedule_appointment(appointment_id):
     user = get_current_user()
     if not user:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     appointment = Appointment.query.get_or_404(appointment_id)
 
     # Check if user is authorized to reschedule 
     if user.role == "patient" and appointment.patient_id != user.id:
         flash("Unauthorized to reschedule this appointment.", "danger")
-        return redirect(url_for("appointments"))
+        return redirect(url_for("main.appointments"))
     if user.role == "doctor" and appointment.doctor_id != user.id:
         flash("Unauthorized to reschedule this appointment.", "danger")
-        return redirect(url_for("appointments"))
+        return redirect(url_for("main.appointments"))
 
     if request.method == "POST":
         new_date = request.form.get("date")
@@ -371,8 +1707,14 @@ def reschedule_appointment(appointment_id):
         duration = request.form.get("duration", appointment.duration)
         notes = request.form.get("notes", "")
 
+        # The form carries the version it was rendered from; refuse to overwrite a newer edit
+        if request.form.get("version", str(appointment.version)) != str(appointment.version):
+            flash("This appointment was changed by someone else. Please review it and try again.", "warning")
+            return redirect(url_for("main.reschedule_appointment", appointment_id=appointment_id))
+
         # Create temporary appointment object to check availability
         temp_appointment = Appointment(
+            id=appointment.id,
             doctor_id=appointment.doctor_id,
             patient_id=appointment.patient_id,
             date=new_date,
@@ -383,83 +1725,137 @@ def reschedule_appointment(appointment_id):
         is_available, message = temp_appointment.is_time_available()
         if not is_available:
             flash(message, "danger")
-            return redirect(url_for("reschedule_appointment", appointment_id=appointment_id))
-
-        appointment.date = new_date
-        appointment.time = new_time
-        appointment.duration = int(duration)
-        appointment.notes = notes
-        appointment.status = "Rescheduled"
-        db.session.commit()
+            return redirect(url_for("main.reschedule_appointment", appointment_id=appointment_id))
+
+        bounds = appointment_bounds(new_date, new_time, duration)
+        if claim_slots(appointment.doctor_id, [bounds], exclude_ids={appointment.id}):
+            abandon_booking(appointment.doctor_id)
+            flash("This time slot is already booked", "danger")
+            return redirect(url_for("main.reschedule_appointment", appointment_id=appointment_id))
+
+        try:
+            before = billing_snapshot(appointment)
+            appointment.date = new_date
+            appointment.time = new_time
+            appointment.duration = int(duration)
+            appointment.notes = notes
+            appointment.status = "Rescheduled"
+            record_billing_change(appointment, before)
+            audit_appointment("rescheduled", appointment)
+            db.session.commit()
+        except BOOKING_CONFLICTS:
+            abandon_booking(appointment.doctor_id)
+            flash("This appointment was changed by someone else. Please review it and try again.", "warning")
+            return redirect(url_for("main.reschedule_appointment", appointment_id=appointment_id))
+        appointment_index.add(appointment.doctor_id, appointment.id, *appointment.interval)
         flash("Appointment rescheduled successfully.", "success")
-        return redirect(url_for("appointments"))
+        return redirect(url_for("main.appointments"))
 
-    doctors = [User.query.get(appointment.doctor_id)]
-    patients = [User.query.get(appointment.patient_id)] if user.role == "receptionist" else None
-    
-    return render_template("schedule_appointment.html", 
-                         appointment=appointment, 
-                         user=user, 
-                         doctors=doctors,
-                         patients=patients)
+    doctors = [load_user(appointment.doctor_id)]
+    validators = page_validators(user, [], appointment.id, appointment.version,
+                                 last_modified=appointment.updated_at or appointment.created_at)
+    return conditional_render(validators, "schedule_appointment.html",
+                              appointment=appointment,
+                              user=user,
+                              doctors=doctors)
 
-@app.route("/manage_availability", methods=["GET", "POST"])
+@bp.route("/manage_availability", methods=["GET", "POST"])
 def manage_availability():
     user = get_current_user()
     if not user or user.role != "doctor":
         flash("Access denied.", "danger")
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("main.dashboard"))
 
     if request.method == "POST":
-        day = request.form.get("day")
-        start_time = request.form.get("start_time")
-        end_time = request.form.get("end_time")
-        is_available = request.form.get("is_available") == "true"
-
-        availability = DoctorAvailability.query.filter_by(
-            doctor_id=user.id,
-            day_of_week=day
-        ).first()
-
-        if availability:
-            availability.start_time = start_time
-            availability.end_time = end_time
-            availability.is_available = is_available
-        else:
-            availability = DoctorAvailability(
+        action = request.form.get("action", "add_window")
+
+        if action == "add_window":
+            day = request.form.get("day")
+            start_time = request.form.get("start_time")
+            end_time = request.form.get("end_time")
+            is_available = request.form.get("is_available", "true") == "true"
+
+            if not all([day, start_time, end_time]) or parse_clock(start_time) >= parse_clock(end_time):
+                flash("Please enter a start time before the end time.", "danger")
+                return redirect(url_for("main.manage_availability"))
+
+            db.session.add(DoctorAvailability(
                 doctor_id=user.id,
-                day_of_week=day,
+                day_of_week=int(day),
                 start_time=start_time,
                 end_time=end_time,
                 is_available=is_available
-            )
-            db.session.add(availability)
+            ))
+
+        elif action == "delete_window":
+            DoctorAvailability.query.filter_by(
+                id=request.form.get("window_id"),
+                doctor_id=user.id
+            ).delete()
+
+        elif action == "add_exception":
+            date = request.form.get("date")
+            start_time = request.form.get("start_time") or None
+            end_time = request.form.get("end_time") or None
+            is_available = request.form.get("is_available") == "true"
+
+            if not date:
+                flash("Please select a date.", "danger")
+                return redirect(url_for("main.manage_availability"))
+            if bool(start_time) != bool(end_time) or (start_time and parse_clock(start_time) >= parse_clock(end_time)):
+                flash("Leave both times empty for the whole day, or enter a start before the end.", "danger")
+                return redirect(url_for("main.manage_availability"))
+            if is_available and not start_time:
+                flash("Extra hours need a start and end time.", "danger")
+                return redirect(url_for("main.manage_availability"))
+
+            db.session.add(AvailabilityException(
+                doctor_id=user.id,
+                date=date,
+                start_time=start_time,
+                end_time=end_time,
+                is_available=is_available,
+                reason=request.form.get("reason", "")
+            ))
+
+        elif action == "delete_exception":
+            AvailabilityException.query.filter_by(
+                id=request.form.get("exception_id"),
+                doctor_id=user.id
+            ).delete()
 
         db.session.commit()
+        availability_calendar.invalidate(user.id)
+        # Bulk deletes skip the mapper events, so drop the cached tables here too
+        reference_cache.invalidate("availability", user.id)
         flash("Availability updated successfully.", "success")
-        return redirect(url_for("manage_availability"))
+        return redirect(url_for("main.manage_availability"))
 
-    availability = DoctorAvailability.query.filter_by(doctor_id=user.id).all()
+    availability, exceptions = reference_cache.get("availability", user.id)
+    today = datetime.now().strftime("%Y-%m-%d")
+    exceptions = [e for e in exceptions if e.date >= today]
     days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
     
-    return render_template("manage_availability.html", 
-                         availability=availability,
-                         days=days,
-                         user=user)
-
-@app.route("/manage_rate", methods=["GET", "POST"])
+    return conditional_render(page_validators(user, [("availability", user.id)]),
+                              "manage_availability.html",
+                              availability=availability,
+                              exceptions=exceptions,
+                              days=days,
+                              user=user)
+
+@bp.route("/manage_rate", methods=["GET", "POST"])
 def manage_rate():
     user = get_current_user()
     if not user or user.role != "doctor":
         flash("Access denied.", "danger")
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("main.dashboard"))
 
     if request.method == "POST":
         rate_per_hour = request.form.get("rate_per_hour")
         
         if not rate_per_hour or float(rate_per_hour) <= 0:
             flash("Please enter a valid rate.", "danger")
-            return redirect(url_for("manage_rate"))
+            return redirect(url_for("main.manage_rate"))
             
         doctor_rate = DoctorRate.query.filter_by(doctor_id=user.id).first()
         
@@ -472,98 +1868,887 @@ def manage_rate():
             )
             db.session.add(doctor_rate)
             
+        # Costs follow the current rate, so this doctor's rollups are re-derived in the background
+        job_queue.enqueue("rebuild_billing", {"doctor_id": user.id}, dedupe_key=f"rebuild_billing:{user.id}")
+        audit("rate", user.id, "rate_changed", {"rate_per_hour": doctor_rate.rate_per_hour})
         db.session.commit()
         flash("Rate updated successfully.", "success")
-        return redirect(url_for("manage_rate"))
+        return redirect(url_for("main.manage_rate"))
         
-    doctor_rate = DoctorRate.query.filter_by(doctor_id=user.id).first()
-    return render_template("manage_rate.html", user=user, doctor_rate=doctor_rate)
+    doctor_rate = reference_cache.get("rates").get(user.id)
+    return conditional_render(page_validators(user, [("rates", None)]), "manage_rate.html",
+                              user=user, doctor_rate=doctor_rate)
 
-@app.route("/billing", methods=["GET"])
+@bp.route("/billing", methods=["GET"])
 def billing():
     user = get_current_user()
     if not user:
-        return redirect(url_for("login"))
-        
-    if user.role == "patient":
-        appointments = Appointment.query.filter_by(patient_id=user.id).all()
-    elif user.role == "doctor":
-        appointments = Appointment.query.filter_by(doctor_id=user.id).all()
-    else:  # receptionist
-        appointments = Appointment.query.all()
-        
-    return render_template("billing.html", appointments=appointments, user=user)
+        return redirect(url_for("main.login"))
+
+    rows, filters, next_cursor = appointment_page(user, request.args)
+    doctors = reference_cache.get("doctors") if user.role != "doctor" else None
 
-@app.route("/mark_paid/<int:appointment_id>", methods=["POST"])
+    return render_template("billing.html", appointments=rows, user=user,
+                           filters=filters, next_cursor=next_cursor, doctors=doctors)
+
+@bp.route("/mark_paid/<int:appointment_id>", methods=["POST"])
 def mark_paid(appointment_id):
     user = get_current_user()
     if not user or user.role not in ["doctor", "receptionist"]:
         flash("Access denied.", "danger")
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("main.dashboard"))
         
     appointment = Appointment.query.get_or_404(appointment_id)
     
     if user.role == "doctor" and appointment.doctor_id != user.id:
         flash("Unauthorized to mark this appointment as paid.", "danger")
-        return redirect(url_for("billing"))
+        return redirect(url_for("main.billing"))
         
+    before = billing_snapshot(appointment)
     appointment.is_paid = True
     appointment.payment_date = datetime.utcnow()
-    db.session.commit()
+    try:
+        # The rollup bump autoflushes the appointment, so a concurrent edit can surface there too
+        record_billing_change(appointment, before)
+        audit_appointment("paid", appointment)
+        db.session.commit()
+    except BOOKING_CONFLICTS:
+        db.session.rollback()
+        flash("This appointment was changed by someone else. Please try again.", "warning")
+        return redirect(url_for("main.billing"))
     
     flash("Payment recorded successfully.", "success")
-    return redirect(url_for("billing"))
+    return redirect(url_for("main.billing"))
+
+
+@bp.route("/billing/report", methods=["GET"])
+def billing_report():
+    """
+    Revenue and outstanding balances grouped by doctor, patient or day.
+    Reads only the billing rollups, never the appointments table.
+    """
+    user = get_current_user()
+    if not user:
+        return redirect(url_for("main.login"))
+
+    group_by = request.args.get("group_by", "day")
+    rows = billing_report_for(user, group_by, request.args)
+    if rows is None:
+        flash("Unknown report grouping.", "danger")
+        return redirect(url_for("main.billing_report"))
+
+    if request.args.get("format") == "json":
+        return jsonify(group_by=group_by, rows=rows)
+    return render_template("billing_report.html", rows=rows, group_by=group_by, user=user,
+                           clinics=list(current_app.config["CLINIC_DATABASES"]),
+                           all_clinics=request.args.get("clinics") == "all")
+
+BILLING_REPORT_LIMIT = 500
+
+def billing_report_for(user, group_by, args):
+    """
+    billing_report_rows in the user's clinic, or in every clinic at once for
+    a receptionist asking for clinics=all or the clinic grouping. Days are
+    summed across clinics; doctor, patient and clinic rows are each from one
+    clinic and say which.
+    """
+    everywhere = args.get("clinics") == "all" or group_by == "clinic"
+    if not (everywhere and user.role == "receptionist" and current_app.config["CLINIC_DATABASES"]):
+        return billing_report_rows(user, group_by, args)
+
+    viewer = SimpleNamespace(id=user.id, role=user.role)  # Not bound to this request's session
+    per_clinic = fan_out(billing_report_rows, viewer, group_by, dict(args.items()))
+    if group_by != "day":
+        rows = [{**row, "clinic": clinic} for clinic, clinic_rows in per_clinic.items() for row in clinic_rows]
+        rows.sort(key=lambda row: row["billed"], reverse=True)
+        return rows[:BILLING_REPORT_LIMIT]
+
+    days = {}
+    for clinic_rows in per_clinic.values():
+        for row in clinic_rows:
+            total = days.setdefault(row["key"], dict(row, appointments=0, billed=0, paid=0, outstanding=0))
+            for field in ("appointments", "billed", "paid", "outstanding"):
+                total[field] = round(total[field] + row[field], 2)
+    return sorted(days.values(), key=lambda row: row["key"], reverse=True)[:BILLING_REPORT_LIMIT]
+
+def billing_report_rows(user, group_by, args):
+    """
+    Rollup totals visible to `user`, grouped by "doctor", "patient", "day"
+    or "clinic" (one row for the current clinic) and filtered by args
+    date_from/date_to. Returns None for an unknown grouping.
+    """
+    keys = {
+        "doctor": BillingRollup.doctor_id,
+        "patient": BillingRollup.patient_id,
+        "day": BillingRollup.day,
+        "clinic": None,
+    }
+    if group_by not in keys:
+        return None
+
+    billed = func.sum(BillingRollup.billed)
+    paid = func.sum(BillingRollup.paid)
+    key = keys[group_by]
+    totals = (func.sum(BillingRollup.appointment_count), billed, paid)
+    if key is None:
+        query = db.session.query(db.literal(current_clinic()), *totals)
+    else:
+        query = db.session.query(key, *totals).group_by(key)
 
+    if user.role == "doctor":
+        query = query.filter(BillingRollup.doctor_id == user.id)
+    elif user.role == "patient":
+        query = query.filter(BillingRollup.patient_id == user.id)
+    if args.get("date_from"):
+        query = query.filter(BillingRollup.day >= args["date_from"])
+    if args.get("date_to"):
+        query = query.filter(BillingRollup.day <= args["date_to"])
+
+    query = query.order_by(key.desc() if group_by == "day" else billed.desc())
+    rows = [
+        {
+            "key": row_key,
+            "appointments": count or 0,
+            "billed": round(total_billed or 0, 2),
+            "paid": round(total_paid or 0, 2),
+            "outstanding": round((total_billed or 0) - (total_paid or 0), 2),
+        }
+        for row_key, count, total_billed, total_paid in query.limit(BILLING_REPORT_LIMIT)
+    ]
+    if group_by in ("doctor", "patient"):
+        names = dict(db.session.query(User.id, User.name).filter(User.id.in_([r["key"] for r in rows])))
+        for row in rows:
+            row["name"] = names.get(row["key"])
+    return rows
+
+###############################################################################
+#                            RECURRING SERIES                                 #
+###############################################################################
+
+def series_rule(form, first_date):
+    """
+    RRULE text from the schedule form: the raw `rrule` field if given, else
+    built from repeat (DAILY/WEEKLY), repeat_interval, repeat_days and
+    repeat_count or repeat_until. None for a one-off booking.
+    """
+    if form.get("rrule", "").strip():
+        return form["rrule"].strip()
+    freq = form.get("repeat")
+    if not freq:
+        return None
+    parts = [f"FREQ={freq}", f"INTERVAL={form.get('repeat_interval') or 1}"]
+    days = [day for day in form.getlist("repeat_days") if day in WEEKDAY_CODES]
+    if freq == "WEEKLY" and days:
+        parts.append("BYDAY=" + ",".join(days))
+    if form.get("repeat_until"):
+        parts.append("UNTIL=" + form["repeat_until"].replace("-", ""))
+    else:
+        parts.append(f"COUNT={form.get('repeat_count') or 1}")
+    return ";".join(parts)
+
+def check_occurrences(doctor_id, bounds, exclude_ids=()):
+    """
+    Check every (start_at, end_at) against the doctor's compiled availability
+    and the appointment index, and against each other, in one in-memory pass.
+    Appointments in `exclude_ids` (the series being moved) do not count as
+    conflicts. Returns [(start_at, reason)] for the occurrences that fail.
+    """
+    batch = DoctorSchedule()
+    failures = []
+    for position, (start_at, end_at) in enumerate(bounds):
+        start, end = to_minutes(start_at), to_minutes(end_at)
+        if not availability_calendar.is_available(doctor_id, start, end):
+            failures.append((start_at, "outside working hours"))
+            continue
+        clashes = [a for a, _, _ in appointment_index.overlapping(doctor_id, start, end) if a not in exclude_ids]
+        if clashes or batch.find_overlap(start, end):
+            failures.append((start_at, "already booked"))
+            continue
+        batch.add(position, start, end)
+    return failures
+
+def flash_series_failures(failures, outcome="Nothing was booked.", shown=5):
+    listed = ", ".join(f"{start_at:%Y-%m-%d %H:%M} ({reason})" for start_at, reason in failures[:shown])
+    more = f" and {len(failures) - shown} more" if len(failures) > shown else ""
+    flash(f"{len(failures)} occurrences are unavailable: {listed}{more}. {outcome}", "danger")
+
+def book_series(doctor_id, patient_id, first_date, time, duration, rule, notes=""):
+    """
+    Expand `rule` from first_date, check every occurrence, and insert the
+    series with all of its appointments and billing in one transaction.
+    Returns (booked_count, failures); nothing is written if any occurrence fails.
+    Raises ValueError for an invalid rule, date or time. Callers check that
+    doctor and patient belong to the current clinic (outside_clinic).
+    """
+    days = expand_recurrence(rule, datetime.strptime(first_date, "%Y-%m-%d").date())
+    bounds = [appointment_bounds(day.strftime("%Y-%m-%d"), time, duration) for day in days]
+    failures = check_occurrences(doctor_id, bounds)
+    if failures:
+        return 0, failures
+    clash = claim_slots(doctor_id, bounds)
+    if clash:
+        abandon_booking(doctor_id)
+        return 0, [(clash, "already booked")]
+
+    try:
+        return _insert_series(doctor_id, patient_id, first_date, time, duration, rule, notes, bounds), []
+    except BOOKING_CONFLICTS:
+        abandon_booking(doctor_id)
+        return 0, [(bounds[0][0], "already booked")]
+
+def _insert_series(doctor_id, patient_id, first_date, time, duration, rule, notes, bounds):
+    series = AppointmentSeries(doctor_id=doctor_id, patient_id=patient_id, rule=rule,
+                               first_date=first_date, time=time, duration=duration, notes=notes)
+    db.session.add(series)
+    db.session.flush()
+    rows = [{
+        "doctor_id": doctor_id,
+        "patient_id": patient_id,
+        "series_id": series.id,
+        "date": start_at.strftime("%Y-%m-%d"),
+        "time": start_at.strftime("%H:%M"),
+        "duration": duration,
+        "start_at": start_at,
+        "end_at": end_at,
+        "status": "Scheduled",
+        "notes": notes,
+        "is_paid": False,
+    } for start_at, end_at in bounds]
+    db.session.execute(db.insert(Appointment), rows)
+    bump_rollups_for(rows)
+    if auditing():
+        # The bulk insert returns no ids; the series index finds them
+        ids = dict(db.session.query(Appointment.date, Appointment.id).filter(Appointment.series_id == series.id))
+        for row in rows:
+            audit_appointment("booked", {**row, "id": ids[row["date"]]})
+    db.session.commit()
+    appointment_index.invalidate(doctor_id)
+    return len(rows)
+
+def series_occurrences(series_id, upcoming_only=True):
+    """Criteria selecting a series' active occurrences, optionally from now on."""
+    criteria = [Appointment.series_id == series_id, Appointment.status != "Canceled"]
+    if upcoming_only:
+        criteria.append(Appointment.start_at >= datetime.now())
+    return criteria
+
+def _occurrence_rows(criteria):
+    columns = (Appointment.id, Appointment.doctor_id, Appointment.patient_id, Appointment.date,
+               Appointment.time, Appointment.duration, Appointment.status, Appointment.is_paid,
+               Appointment.version, Appointment.start_at)
+    return [dict(row._mapping) for row in db.session.query(*columns).filter(*criteria)]
+
+def cancel_series(series, upcoming_only=True):
+    """Cancel a series' occurrences with one UPDATE. Returns how many were canceled."""
+    criteria = series_occurrences(series.id, upcoming_only)
+    rows = _occurrence_rows(criteria)
+    if not rows:
+        return 0
+    Appointment.query.filter(*criteria).update(
+        {Appointment.status: "Canceled", Appointment.updated_at: datetime.utcnow(),
+         Appointment.version: Appointment.version + 1},
+        synchronize_session=False
+    )
+    bump_rollups_for(rows, sign=-1)
+    for row in rows:
+        audit_appointment("canceled", {**row, "status": "Canceled"})
+    db.session.commit()
+    appointment_index.invalidate(series.doctor_id)
+    return len(rows)
+
+def reschedule_series(series, time=None, duration=None, shift_days=0):
+    """
+    Move every upcoming occurrence to a new time of day, duration and/or by
+    `shift_days` days, as one batched UPDATE after checking all new slots.
+    Returns (moved_count, failures); nothing changes if any slot fails.
+    """
+    rows = _occurrence_rows(series_occurrences(series.id))
+    if not rows:
+        return 0, []
+
+    moved = []
+    for row in rows:
+        day = datetime.strptime(row["date"], "%Y-%m-%d") + timedelta(days=shift_days)
+        new_time, new_duration = time or row["time"], int(duration or row["duration"] or 60)
+        start_at, end_at = appointment_bounds(day.strftime("%Y-%m-%d"), new_time, new_duration)
+        moved.append({**row, "date": start_at.strftime("%Y-%m-%d"), "time": new_time,
+                      "duration": new_duration, "start_at": start_at, "end_at": end_at,
+                      "status": "Rescheduled"})
+
+    bounds = [(m["start_at"], m["end_at"]) for m in moved]
+    series_ids = {row["id"] for row in rows}
+    failures = check_occurrences(series.doctor_id, bounds, exclude_ids=series_ids)
+    if failures:
+        return 0, failures
+    clash = claim_slots(series.doctor_id, bounds, exclude_ids=series_ids)
+    if clash:
+        abandon_booking(series.doctor_id)
+        return 0, [(clash, "already booked")]
+
+    # Bulk UPDATE by primary key skips the ORM events, so start_at/end_at are set here;
+    # passing the version makes each row's UPDATE check it, as a single-row reschedule would.
+    # Rows are moved in the direction of travel (latest first when moving later), so shifting
+    # by the series' own period never lands an occurrence on a sibling that has not moved yet.
+    later = sum((m["start_at"] - row["start_at"]).total_seconds()
+                for m, row in zip(moved, rows) if row["start_at"]) > 0
+    moved.sort(key=lambda m: m["start_at"], reverse=later)
+    updated_at = datetime.utcnow()
+    try:
+        db.session.execute(db.update(Appointment), [{
+            "id": m["id"], "date": m["date"], "time": m["time"], "duration": m["duration"],
+            "start_at": m["start_at"], "end_at": m["end_at"], "status": m["status"],
+            "updated_at": updated_at, "version": m["version"],
+        } for m in moved])
+        bump_rollups_for(rows, sign=-1)
+        bump_rollups_for(moved)
+        for row in moved:
+            audit_appointment("rescheduled", row)
+        series.time = time or series.time
+        series.duration = int(duration or series.duration)
+        db.session.commit()
+    except BOOKING_CONFLICTS as exc:
+        abandon_booking(series.doctor_id)
+        reason = "changed by someone else" if isinstance(exc, StaleDataError) else "already booked"
+        return 0, [(moved[0]["start_at"], reason)]
+    appointment_index.invalidate(series.doctor_id)
+    return len(moved), []
+
+@bp.route("/series/<int:series_id>", methods=["GET", "POST"])
+def manage_series(series_id):
+    """View a recurring series and cancel or reschedule it as a whole."""
+    user = get_current_user()
+    if not user:
+        return redirect(url_for("main.login"))
+
+    series = AppointmentSeries.query.get_or_404(series_id)
+    if (user.role == "patient" and series.patient_id != user.id) or \
+       (user.role == "doctor" and series.doctor_id != user.id):
+        flash("Unauthorized to manage this series.", "danger")
+        return redirect(url_for("main.appointments"))
+
+    if request.method == "POST":
+        action = request.form.get("action")
+        if action == "cancel":
+            canceled = cancel_series(series, upcoming_only=request.form.get("scope") != "all")
+            flash(f"Canceled {canceled} appointments in the series.", "info")
+        elif action == "reschedule":
+            try:
+                moved, failures = reschedule_series(
+                    series,
+                    time=request.form.get("time") or None,
+                    duration=request.form.get("duration") or None,
+                    shift_days=int(request.form.get("shift_days") or 0)
+                )
+            except ValueError:
+                flash("Invalid time, duration or day shift.", "danger")
+                return redirect(url_for("main.manage_series", series_id=series_id))
+            if failures:
+                flash_series_failures(failures, "Nothing was changed.")
+            else:
+                flash(f"Rescheduled {moved} upcoming appointments.", "success")
+        return redirect(url_for("main.manage_series", series_id=series_id))
+
+    occurrences = Appointment.query.filter_by(series_id=series_id).order_by(Appointment.start_at).all()
+    return render_template("series.html", series=series, occurrences=occurrences, user=user,
+                           doctor=load_user(series.doctor_id), patient=load_user(series.patient_id))
+
+###############################################################################
+#                           BULK IMPORT / EXPORT                              #
+###############################################################################
+
+IMPORT_CHUNK_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FIELDS = ["id", "doctor_id", "doctor_username", "patient_id", "patient_username",
+                 "date", "time", "duration", "status", "notes", "is_paid"]
+APPOINTMENT_STATUSES = ("Scheduled", "Rescheduled", "Canceled")
+
+def read_appointment_rows(stream, fmt):
+    """Lazily yield (line_number, row dict) from a CSV or JSONL text stream."""
+    if fmt == "jsonl":
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = {"_error": "Invalid JSON"}
+            yield line_number, row if isinstance(row, dict) else {"_error": "Expected a JSON object"}
+    else:
+        # Line 1 is the CSV header
+        for line_number, row in enumerate(csv.DictReader(stream), start=2):
+            yield line_number, row
+
+def _chunk_users(rows, id_key, name_key):
+    ids = {int(r[id_key]) for _, r in rows if str(r.get(id_key) or "").isdigit()}
+    names = {r[name_key] for _, r in rows if r.get(name_key)}
+    if not ids and not names:
+        return {}, {}
+    users = User.query.filter(or_(User.id.in_(ids), User.username.in_(names)), *clinic_members()).all()
+    return {u.id: u for u in users}, {u.username: u for u in users}
+
+def import_appointment_chunk(rows):
+    """
+    Validate one chunk of (line_number, row) pairs in memory and bulk insert
+    the accepted ones in a single transaction. Rows are checked against the
+    compiled availability calendars (future appointments only, so history can
+    be migrated) and against existing bookings plus earlier rows of the same
+    chunk. Returns (accepted_count, [(line_number, reason, row)]).
+    """
+    doctors_by_id, doctors_by_name = _chunk_users(rows, "doctor_id", "doctor_username")
+    patients_by_id, patients_by_name = _chunk_users(rows, "patient_id", "patient_username")
+    now = datetime.now()
+    pending = {}
+    accepted, accepted_lines, errors = [], [], []
+
+    for line_number, row in rows:
+        if "_error" in row:
+            errors.append((line_number, row["_error"], row))
+            continue
+        doctor_key, patient_key = str(row.get("doctor_id") or ""), str(row.get("patient_id") or "")
+        doctor = doctors_by_id.get(int(doctor_key)) if doctor_key.isdigit() else doctors_by_name.get(row.get("doctor_username"))
+        patient = patients_by_id.get(int(patient_key)) if patient_key.isdigit() else patients_by_name.get(row.get("patient_username"))
+        if not doctor or doctor.role != "doctor":
+            errors.append((line_number, "Unknown doctor", row))
+            continue
+        if not patient or patient.role != "patient":
+            errors.append((line_number, "Unknown patient", row))
+            continue
+
+        status = row.get("status") or "Scheduled"
+        try:
+            duration = int(row.get("duration") or 60)
+            start_at, end_at = appointment_bounds(row.get("date"), row.get("time"), duration)
+        except (TypeError, ValueError):
+            errors.append((line_number, "Invalid date, time or duration", row))
+            continue
+        if not 0 < duration <= 24 * 60 or status not in APPOINTMENT_STATUSES:
+            errors.append((line_number, "Invalid duration or status", row))
+            continue
+
+        if status != "Canceled":
+            start, end = to_minutes(start_at), to_minutes(end_at)
+            if start_at >= now and not availability_calendar.is_available(doctor.id, start, end):
+                errors.append((line_number, "Outside the doctor's availability", row))
+                continue
+            schedule = pending.setdefault(doctor.id, DoctorSchedule())
+            if appointment_index.find_conflict(doctor.id, start, end) or schedule.find_overlap(start, end):
+                errors.append((line_number, "Overlaps an existing appointment", row))
+                continue
+            schedule.add(line_number, start, end)
+
+        accepted.append({
+            "doctor_id": doctor.id,
+            "patient_id": patient.id,
+            "date": start_at.strftime("%Y-%m-%d"),
+            "time": start_at.strftime("%H:%M"),
+            "duration": duration,
+            "start_at": start_at,
+            "end_at": end_at,
+            "status": status,
+            "notes": row.get("notes") or "",
+            "is_paid": str(row.get("is_paid", "")).lower() in ("1", "true", "yes"),
+        })
+        accepted_lines.append((line_number, row))
+
+    if not accepted:
+        return 0, errors
+
+    try:
+        db.session.execute(db.insert(Appointment), accepted)
+        bump_rollups_for(accepted)
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        reason = f"Chunk failed to insert: {exc.__class__.__name__}"
+        return 0, errors + [(number, reason, row) for number, row in accepted_lines]
+
+    # The new ids are unknown without RETURNING, so reload those doctors lazily
+    for doctor_id in pending:
+        appointment_index.invalidate(doctor_id)
+    return len(accepted), errors
+
+def import_appointments(stream, fmt, chunk_size=IMPORT_CHUNK_SIZE):
+    """Import a whole stream chunk by chunk. Yields (accepted, errors) per chunk."""
+    rows = read_appointment_rows(stream, fmt)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            break
+        yield import_appointment_chunk(chunk)
+
+def export_appointment_rows():
+    """Yield export dicts in id order, one keyset batch at a time."""
+    doctor, patient = aliased(User), aliased(User)
+    last_id = 0
+    while True:
+        batch = db.session.query(
+            Appointment.id, Appointment.doctor_id, doctor.username, Appointment.patient_id, patient.username,
+            Appointment.date, Appointment.time, Appointment.duration, Appointment.status,
+            Appointment.notes, Appointment.is_paid
+        ).join(doctor, doctor.id == Appointment.doctor_id).join(
+            patient, patient.id == Appointment.patient_id
+        ).filter(Appointment.id > last_id).order_by(Appointment.id).limit(EXPORT_BATCH_SIZE).all()
+        # Release the read transaction between batches
+        db.session.rollback()
+        if not batch:
+            break
+        for values in batch:
+            yield dict(zip(EXPORT_FIELDS, values))
+        last_id = batch[-1][0]
+
+def export_appointments(fmt):
+    """Yield the export as text chunks of CSV or JSONL."""
+    if fmt == "jsonl":
+        for row in export_appointment_rows():
+            yield json.dumps(row) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    writer.writeheader()
+    for number, row in enumerate(export_appointment_rows(), start=1):
+        writer.writerow(row)
+        if number % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def _format_for(filename, requested=None):
+    if requested in ("csv", "jsonl"):
+        return requested
+    return "jsonl" if filename and filename.endswith((".jsonl", ".json")) else "csv"
+
+@bp.route("/appointments/import", methods=["POST"])
+def import_appointments_route():
+    """Receptionists upload a CSV/JSONL file; answers with counts and rejected rows."""
+    user = get_current_user()
+    if not user or user.role != "receptionist":
+        return jsonify(error="Access denied."), 403
+    upload = request.files.get("file")
+    if not upload:
+        return jsonify(error="Upload a CSV or JSONL file as 'file'."), 400
+
+    fmt = _format_for(upload.filename, request.form.get("format"))
+    stream = io.TextIOWrapper(upload.stream, encoding="utf-8", newline="")
+    accepted, rejected = 0, []
+    for chunk_accepted, chunk_errors in import_appointments(stream, fmt):
+        accepted += chunk_accepted
+        rejected.extend({"line": line, "reason": reason} for line, reason, _ in chunk_errors)
+    return jsonify(accepted=accepted, rejected=len(rejected), errors=rejected)
+
+@bp.route("/appointments/export", methods=["GET"])
+def export_appointments_route():
+    """Stream every appointment as CSV (default) or JSONL."""
+    user = get_current_user()
+    if not user or user.role != "receptionist":
+        return jsonify(error="Access denied."), 403
+
+    fmt = _format_for(None, request.args.get("format"))
+    mimetype = "application/x-ndjson" if fmt == "jsonl" else "text/csv"
+    return Response(stream_with_context(export_appointments(fmt)), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename=appointments.{fmt}"
+    })
+
+@bp.cli.command("import-appointments")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None)
+@click.option("--chunk-size", default=IMPORT_CHUNK_SIZE, show_default=True)
+@click.option("--errors", "errors_path", type=click.Path(dir_okay=False), default="import_errors.csv",
+              show_default=True, help="Where rejected rows are written.")
+@one_clinic
+def import_appointments_command(path, fmt, chunk_size, errors_path):
+    """Import appointments from a CSV or JSONL file in chunks."""
+    fmt = _format_for(path, fmt)
+    accepted = rejected = 0
+    with open(path, newline="", encoding="utf-8") as source, \
+            open(errors_path, "w", newline="", encoding="utf-8") as report:
+        writer = csv.writer(report)
+        writer.writerow(["line", "reason", "row"])
+        for chunk_accepted, chunk_errors in import_appointments(source, fmt, chunk_size):
+            accepted += chunk_accepted
+            rejected += len(chunk_errors)
+            for line, reason, row in chunk_errors:
+                writer.writerow([line, reason, json.dumps(row)])
+            print(f"{accepted} imported, {rejected} rejected", end="\r")
+    print(f"{accepted} imported, {rejected} rejected (see {errors_path})")
+
+@bp.cli.command("export-appointments")
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None)
+@one_clinic
+def export_appointments_command(path, fmt):
+    """Export every appointment to a CSV or JSONL file without loading them all."""
+    fmt = _format_for(path, fmt)
+    with open(path, "w", newline="", encoding="utf-8") as target:
+        for text_chunk in export_appointments(fmt):
+            target.write(text_chunk)
 
 ###############################################################################
 #                                CHAT ROUTES                                  #
 ###############################################################################
-@app.route("/chat", methods=["GET", "POST"])
+
+CHAT_PAGE_SIZE = 50
+CHAT_STREAM_POLL_SECONDS = 5   # Also picks up messages committed by other workers
+CHAT_STREAM_MAX_SECONDS = 300  # EventSource reconnects with Last-Event-ID afterwards
+
+class MessageBroker:
+    """Wakes streaming chat clients in this process when a message is committed."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.version = 0
+
+    def publish(self):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+
+    def wait(self, version, timeout):
+        """Block until something is published after `version`, or the timeout passes."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+message_broker = MessageBroker()
+
+INBOX_PAGE_SIZE = 30
+CONVERSATION_PREVIEW_LENGTH = 200
+
+def record_conversation_message(msg, patient_id, receptionist_id):
+    """
+    Fold a flushed message into its conversation summary, bumping the unread
+    count for the side that did not send it and tracking whether the patient
+    is waiting for a reply. A receptionist's reply takes the conversation
+    over and is timed from the patient's first unanswered message. Call
+    before committing.
+    """
+    from_patient = msg.sender_id == patient_id
+    unread = Conversation.unread_for_receptionist if from_patient else Conversation.unread_for_patient
+    values = {
+        Conversation.receptionist_id: receptionist_id,
+        Conversation.last_message_id: msg.id,
+        Conversation.last_message_at: msg.timestamp,
+        Conversation.last_sender_id: msg.sender_id,
+        Conversation.last_preview: msg.content[:CONVERSATION_PREVIEW_LENGTH],
+        unread: unread + 1,
+    }
+    if from_patient:
+        values[Conversation.awaiting_reply] = True
+        values[Conversation.awaiting_since] = func.coalesce(Conversation.awaiting_since, msg.timestamp)
+    else:
+        waiting_since = db.session.query(Conversation.awaiting_since).filter(
+            Conversation.patient_id == patient_id, Conversation.awaiting_reply == True
+        ).scalar()
+        if waiting_since:
+            record_reply(receptionist_id, (msg.timestamp - waiting_since).total_seconds())
+        values[Conversation.awaiting_reply] = False
+        values[Conversation.awaiting_since] = None
+    updated = Conversation.query.filter_by(patient_id=patient_id).update(values, synchronize_session=False)
+    if not updated:
+        db.session.add(Conversation(
+            patient_id=patient_id,
+            receptionist_id=receptionist_id,
+            last_message_id=msg.id,
+            last_message_at=msg.timestamp,
+            last_sender_id=msg.sender_id,
+            last_preview=msg.content[:CONVERSATION_PREVIEW_LENGTH],
+            unread_for_receptionist=1 if from_patient else 0,
+            unread_for_patient=0 if from_patient else 1,
+            awaiting_reply=from_patient,
+            awaiting_since=msg.timestamp if from_patient else None,
+        ))
+
+def mark_conversation_read(patient_id, reader_role):
+    """Clear the reader's unread count; skips the write when nothing is unread."""
+    unread = Conversation.unread_for_patient if reader_role == "patient" else Conversation.unread_for_receptionist
+    updated = Conversation.query.filter(
+        Conversation.patient_id == patient_id, unread > 0
+    ).update({unread: 0}, synchronize_session=False)
+    if updated:
+        db.session.commit()
+
+def inbox_page(receptionist_id, before=None):
+    """Conversations for a receptionist, most recent activity first, keyset-paginated."""
+    query = Conversation.query.options(joinedload(Conversation.patient)).filter(
+        Conversation.receptionist_id == receptionist_id
+    )
+    if before:
+        try:
+            last_message_at, conversation_id = before.split("|")
+            position = tuple_(datetime.fromisoformat(last_message_at), int(conversation_id))
+            query = query.filter(tuple_(Conversation.last_message_at, Conversation.id) < position)
+        except ValueError:
+            pass
+    conversations = query.order_by(
+        Conversation.last_message_at.desc(), Conversation.id.desc()
+    ).limit(INBOX_PAGE_SIZE + 1).all()
+
+    next_cursor = None
+    if len(conversations) > INBOX_PAGE_SIZE:
+        conversations = conversations[:INBOX_PAGE_SIZE]
+        last = conversations[-1]
+        next_cursor = f"{last.last_message_at.isoformat()}|{last.id}"
+    return conversations, next_cursor
+
+def rebuild_conversations():
+    """Derive conversation summaries from the messages table with one grouped query."""
+    Conversation.query.delete(synchronize_session=False)
+    sender = aliased(User)
+    patient_id = db.case((sender.role == "patient", Message.sender_id), else_=Message.receiver_id)
+    latest = db.session.query(
+        patient_id.label("patient_id"), func.max(Message.id).label("message_id")
+    ).join(sender, sender.id == Message.sender_id).group_by(patient_id).subquery()
+
+    rows = db.session.query(latest.c.patient_id, Message).join(Message, Message.id == latest.c.message_id)
+    for patient_id, msg in rows:
+        receptionist_id = msg.receiver_id if msg.sender_id == patient_id else msg.sender_id
+        db.session.add(Conversation(
+            patient_id=patient_id,
+            receptionist_id=receptionist_id,
+            last_message_id=msg.id,
+            last_message_at=msg.timestamp,
+            last_sender_id=msg.sender_id,
+            last_preview=msg.content[:CONVERSATION_PREVIEW_LENGTH],
+            unread_for_receptionist=0,
+            unread_for_patient=0,
+            awaiting_reply=msg.sender_id == patient_id,
+            awaiting_since=msg.timestamp if msg.sender_id == patient_id else None,
+        ))
+
+@init_step
+def backfill_conversations():
+    """Backfill summaries for databases created before the inbox existed."""
+    if not db.session.query(Conversation.id).first() and db.session.query(Message.id).first():
+        rebuild_conversations()
+        db.session.commit()
+
+@init_step
+def backfill_conversation_queue():
+    """Mark which existing conversations wait for a reply, for databases that predate chat routing."""
+    waiting = Conversation.last_sender_id == Conversation.patient_id
+    Conversation.query.filter(Conversation.awaiting_reply.is_(None)).update({
+        Conversation.awaiting_reply: waiting,
+        Conversation.awaiting_since: db.case((waiting, Conversation.last_message_at), else_=None),
+    }, synchronize_session=False)
+    db.session.commit()
+
+def message_json(msg):
+    return {
+        "id": msg.id,
+        "sender_id": msg.sender_id,
+        "receiver_id": msg.receiver_id,
+        "content": msg.content,
+        "timestamp": msg.timestamp.strftime("%Y-%m-%d %H:%M"),
+    }
+
+def conversation_messages(patient_id, before_id=None, after_id=None, limit=CHAT_PAGE_SIZE):
+    """
+    One page of a patient's chat with reception, oldest first, whichever
+    receptionists took part.
+
+    Without a cursor this is the newest page; `before_id` pages back into
+    history and `after_id` fetches only messages newer than the cursor. What
+    the patient sent and what they received are read separately along the
+    (sender_id, timestamp) and (receiver_id, timestamp) indexes and the two
+    short lists are merged, so the cost depends on the page size, not the
+    conversation length.
+    History pages the hot table cannot fill read through to the archive.
+    Returns (messages, has_more).
+    """
+    anchor = None
+    cursor = after_id or before_id
+    if cursor:
+        anchor = (db.session.query(Message.timestamp, Message.id).filter(Message.id == cursor).first() or
+                  db.session.query(ArchivedMessage.timestamp, ArchivedMessage.id).filter(
+                      ArchivedMessage.id == cursor).first())
+
+    merged = []
+    for model in (Message, ArchivedMessage):
+        # Archived messages are all older than the hot ones, so they only matter for short history pages
+        if model is ArchivedMessage and (after_id or len(merged) > limit):
+            break
+        position = tuple_(model.timestamp, model.id)
+        for column in (model.sender_id, model.receiver_id):
+            query = model.query.filter(column == patient_id)
+            if after_id:
+                query = query.filter(position > tuple_(*anchor) if anchor else model.id > after_id)
+                query = query.order_by(model.timestamp.asc(), model.id.asc())
+            else:
+                if before_id:
+                    query = query.filter(position < tuple_(*anchor) if anchor else model.id < before_id)
+                query = query.order_by(model.timestamp.desc(), model.id.desc())
+            merged.extend(query.limit(limit + 1).all())
+
+    merged.sort(key=lambda msg: (msg.timestamp, msg.id))
+    has_more = len(merged) > limit
+    page = merged[:limit] if after_id else merged[-limit:]
+    return page, has_more
+
+def chat_patient(user, patient_id):
+    """
+    The patient whose chat `user` may read: their own for a patient, the
+    requested one for reception. Returns (patient_id, None), or (None, error
+    message) if the conversation is not allowed.
+    """
+    if user.role == "patient":
+        return user.id, None
+    if user.role == "receptionist":
+        try:
+            patient_id = int(patient_id)
+        except (TypeError, ValueError):
+            return None, "Invalid patient ID."
+        if outside_clinic(patient_id):
+            return None, "This patient belongs to another clinic."
+        return patient_id, None
+    return None, "Chat is only for Receptionists and Patients."
+
+@bp.route("/chat", methods=["GET", "POST"])
 def chat():
     """
-    Simple chat between a Receptionist and a Patient.
-    If you want real-time, you'd use websockets or similar,
-    but here we do a simple post-based system.
+    Chat between a Receptionist and a Patient. The page renders the newest
+    messages and then follows /chat/stream for new ones.
     """
     user = get_current_user()
     if not user:
-        return redirect(url_for("login"))
+        return redirect(url_for("main.login"))
 
     # Receptionist sees all messages, can choose patient to chat with.
-    # Patient sees only their conversation with the receptionist.
-    receptionist = User.query.filter_by(role="receptionist").first()
-    if not receptionist:
-        flash("No receptionist found in the system yet.", "warning")
-        return redirect(url_for("dashboard"))
-
+    # Patient sees only their conversation with reception.
     if request.method == "POST":
         content = request.form.get("content")
         if not content:
             flash("Message cannot be empty.", "danger")
-            return redirect(url_for("chat"))
+            return redirect(url_for("main.chat"))
 
         if user.role == "patient":
+            receptionist_id = route_conversation(user.id)
+            if receptionist_id is None:
+                flash("No receptionist found in the system yet.", "warning")
+                return redirect(url_for("main.dashboard"))
             msg = Message(
                 sender_id=user.id,
-                receiver_id=receptionist.id,
+                receiver_id=receptionist_id,
                 content=content
             )
             db.session.add(msg)
+            db.session.flush()
+            record_conversation_message(msg, user.id, receptionist_id)
             db.session.commit()
+            message_broker.publish()
             flash("Message sent to Receptionist.", "success")
-            return redirect(url_for("chat"))
+            return redirect(url_for("main.chat"))
 
         elif user.role == "receptionist":
             patient_id = request.form.get("patient_id")
             if not patient_id:
                 flash("Select a patient to send message to.", "danger")
-                return redirect(url_for("chat"))
+                return redirect(url_for("main.chat"))
                 
             # Check if patient exists
-            patient = User.query.get(patient_id)
-            if not patient or patient.role != "patient":
+            patient = load_user(patient_id) if patient_id.isdigit() else None
+            if not patient or patient.role != "patient" or outside_clinic(patient.id):
                 flash("Invalid patient selected.", "danger")
-                return redirect(url_for("chat"))
+                return redirect(url_for("main.chat"))
                 
             msg = Message(
                 sender_id=user.id,
@@ -571,46 +2756,1248 @@ def chat():
                 content=content
             )
             db.session.add(msg)
+            db.session.flush()
+            record_conversation_message(msg, int(patient_id), user.id)
             db.session.commit()
+            message_broker.publish()
             flash("Message sent to Patient.", "success")
-            return redirect(url_for("chat", patient_id=patient_id))
+            return redirect(url_for("main.chat", patient_id=patient_id))
 
     # GET request
+    before_id = request.args.get("before_id", type=int)
     if user.role == "patient":
-        # Show messages between this patient and receptionist
-        conversation = Message.query.filter(
-            ((Message.sender_id == user.id) & (Message.receiver_id == receptionist.id)) |
-            ((Message.sender_id == receptionist.id) & (Message.receiver_id == user.id))
-        ).order_by(Message.timestamp.asc()).all()
-        return render_template("chat.html", user=user, conversation=conversation, patients=None)
+        # Show the newest messages between this patient and reception
+        conversation, has_more = conversation_messages(user.id, before_id=before_id)
+        mark_conversation_read(user.id, "patient")
+        return render_template("chat.html", user=user, conversation=conversation,
+                               has_more=has_more, inbox=None)
 
     elif user.role == "receptionist":
-        # Show all messages, or let receptionist choose which patient's conversation to view
-        patients = User.query.filter_by(role="patient").all()
+        # Inbox of conversations by recent activity, plus the selected patient's thread
+        inbox, next_inbox_cursor = inbox_page(user.id, request.args.get("inbox_before"))
         selected_patient_id = request.args.get("patient_id")
-        conversation = []
+        selected_patient = None
+        conversation, has_more = [], False
         
         if selected_patient_id:
             try:
                 selected_patient_id = int(selected_patient_id)
+                if outside_clinic(selected_patient_id):
+                    flash("This patient belongs to another clinic.", "danger")
+                    return redirect(url_for("main.chat"))
+                selected_patient = load_user(selected_patient_id)
                 # Show conversation with that specific patient
-                conversation = Message.query.filter(
-                    ((Message.sender_id == selected_patient_id) & (Message.receiver_id == user.id)) |
-                    ((Message.sender_id == user.id) & (Message.receiver_id == selected_patient_id))
-                ).order_by(Message.timestamp.asc()).all()
+                conversation, has_more = conversation_messages(selected_patient_id, before_id=before_id)
+                mark_conversation_read(selected_patient_id, "receptionist")
             except ValueError:
                 flash("Invalid patient ID.", "danger")
-                return redirect(url_for("chat"))
+                return redirect(url_for("main.chat"))
+
+        # Starting a new conversation: look a patient up instead of listing everyone
+        patient_matches = search_patients(request.args.get("q", ""))
                 
-        return render_template("chat.html", user=user, conversation=conversation, patients=patients)
+        return render_template("chat.html", user=user, conversation=conversation,
+                               has_more=has_more, inbox=inbox, next_inbox_cursor=next_inbox_cursor,
+                               selected_patient=selected_patient, patient_matches=patient_matches,
+                               team=chat_queue_stats())
 
     else:
         flash("Chat is only for Receptionists and Patients.", "warning")
-        return redirect(url_for("dashboard"))
+        return redirect(url_for("main.dashboard"))
+
+@bp.route("/chat/inbox", methods=["GET"])
+def chat_inbox():
+    """Receptionist inbox as JSON: last message, timestamp and unread count per conversation."""
+    user = get_current_user()
+    if not user or user.role != "receptionist":
+        return jsonify(error="Access denied."), 403
+
+    conversations, next_cursor = inbox_page(user.id, request.args.get("before"))
+    return jsonify(next_cursor=next_cursor, conversations=[
+        {
+            "patient_id": conv.patient_id,
+            "patient_name": conv.patient.name,
+            "last_message": conv.last_preview,
+            "last_message_at": conv.last_message_at.strftime("%Y-%m-%d %H:%M"),
+            "last_sender_id": conv.last_sender_id,
+            "unread": conv.unread_for_receptionist,
+        }
+        for conv in conversations
+    ])
+
+@bp.route("/chat/messages", methods=["GET"])
+def chat_messages():
+    """
+    Incremental fetch as JSON. `after_id` returns only newer messages;
+    `before_id` (or no cursor) returns a history page, newest last.
+    """
+    user = get_current_user()
+    if not user:
+        return jsonify(error="Login required."), 401
+    patient_id, error = chat_patient(user, request.args.get("patient_id"))
+    if error:
+        return jsonify(error=error), 400
+
+    limit = min(request.args.get("limit", CHAT_PAGE_SIZE, type=int), 200)
+    messages, has_more = conversation_messages(
+        patient_id,
+        before_id=request.args.get("before_id", type=int),
+        after_id=request.args.get("after_id", type=int),
+        limit=limit
+    )
+    return jsonify(messages=[message_json(m) for m in messages], has_more=has_more)
+
+@bp.route("/chat/stream", methods=["GET"])
+def chat_stream():
+    """Server-Sent Events stream of new messages in one conversation."""
+    user = get_current_user()
+    if not user:
+        return jsonify(error="Login required."), 401
+    patient_id, error = chat_patient(user, request.args.get("patient_id"))
+    if error:
+        return jsonify(error=error), 400
+
+    viewer_id, viewer_role = user.id, user.role
+    after_id = request.headers.get("Last-Event-ID", type=int) or request.args.get("after_id", 0, type=int)
+
+    def events():
+        cursor = after_id
+        version = message_broker.version
+        deadline = time_module.monotonic() + CHAT_STREAM_MAX_SECONDS
+        yield "retry: 2000\n\n"
+        while time_module.monotonic() < deadline:
+            if viewer_role == "receptionist":
+                refresh_presence(viewer_id)  # An open chat keeps its receptionist online
+            messages, _ = conversation_messages(patient_id, after_id=cursor or None)
+            # Serialize before the rollback below, which would expire every loaded message
+            payloads = [message_json(msg) for msg in messages]
+            if any(payload["sender_id"] != viewer_id for payload in payloads):
+                mark_conversation_read(patient_id, viewer_role)
+            # End the read transaction so an idle stream never holds a database lock
+            db.session.rollback()
+            for payload in payloads:
+                cursor = payload["id"]
+                yield f"id: {payload['id']}\nevent: message\ndata: {json.dumps(payload)}\n\n"
+            if not payloads:
+                yield ": keepalive\n\n"
+            version = message_broker.wait(version, CHAT_STREAM_POLL_SECONDS)
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
         
+###############################################################################
+#                                  SEARCH                                     #
+###############################################################################
+
+# Chat messages and appointment notes share one SQLite FTS5 index, kept in
+# sync by triggers so Core bulk inserts are covered too. The `tags` column
+# holds tokens like "msg p12 ym202401" or "note p12 d3 ym203002", so kind,
+# patient, doctor, month and per-role visibility filters intersect posting
+# lists instead of filtering matches row by row. Rowids are id * 2 for
+# messages and id * 2 + 1 for notes; archiving a row keeps its entry, and
+# hits are resolved against the hot table first, then the archive.
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE = 50
+SEARCH_MAX_TERMS = 8
+SEARCH_RANK_WINDOW = 5000   # Only the newest matches of each kind are ranked, so common words stay cheap
+SEARCH_MAX_MONTHS = 36      # Longer date ranges are filtered per row instead of by month tokens
+_HIT_OPEN, _HIT_CLOSE = "\x02", "\x03"  # Snippet markers, turned into <mark> after escaping
+
+_MESSAGE_PATIENT = ("CASE WHEN (SELECT role FROM users WHERE id = {row}.sender_id) = 'patient' "
+                    "THEN {row}.sender_id ELSE {row}.receiver_id END")
+_MESSAGE_ENTRY = ("{row}.id * 2, {row}.content, 'msg p' || " + _MESSAGE_PATIENT +
+                  " || ' ym' || strftime('%Y%m', {row}.timestamp), 'message', {row}.id, date({row}.timestamp)")
+_NOTE_ENTRY = ("{row}.id * 2 + 1, {row}.notes, 'note p' || {row}.patient_id || ' d' || {row}.doctor_id || "
+               "' ym' || replace(substr({row}.date, 1, 7), '-', ''), 'note', {row}.id, {row}.date")
+_SEARCH_COLUMNS = "search_index(rowid, body, tags, kind, ref_id, day)"
+
+SEARCH_SCHEMA = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+    "body, tags, kind UNINDEXED, ref_id UNINDEXED, day UNINDEXED, tokenize = 'porter unicode61 remove_diacritics 2')",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN
+        INSERT OR REPLACE INTO {_SEARCH_COLUMNS} VALUES ({_MESSAGE_ENTRY.format(row="NEW")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_search_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT OR REPLACE INTO {_SEARCH_COLUMNS} VALUES ({_MESSAGE_ENTRY.format(row="NEW")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS appointments_search_insert AFTER INSERT ON appointments
+        WHEN coalesce(NEW.notes, '') != '' BEGIN
+        INSERT OR REPLACE INTO {_SEARCH_COLUMNS} VALUES ({_NOTE_ENTRY.format(row="NEW")});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS appointments_search_update
+        AFTER UPDATE OF notes, patient_id, doctor_id, date ON appointments BEGIN
+        DELETE FROM search_index WHERE rowid = NEW.id * 2 + 1;
+        INSERT INTO {_SEARCH_COLUMNS} SELECT {_NOTE_ENTRY.format(row="NEW")} WHERE coalesce(NEW.notes, '') != '';
+    END""",
+]
+
+def search_available():
+    return database_engine().dialect.name == "sqlite"
+
+def rebuild_search_index():
+    """Re-derive the whole index from the hot and archive tables."""
+    db.session.execute(text("DELETE FROM search_index"))
+    for table in ("messages", "messages_archive"):
+        db.session.execute(text(
+            f"INSERT OR REPLACE INTO {_SEARCH_COLUMNS} SELECT {_MESSAGE_ENTRY.format(row='m')} FROM {table} m"))
+    for table in ("appointments", "appointments_archive"):
+        db.session.execute(text(
+            f"INSERT OR REPLACE INTO {_SEARCH_COLUMNS} SELECT {_NOTE_ENTRY.format(row='a')} "
+            f"FROM {table} a WHERE coalesce(a.notes, '') != ''"))
+
+@bp.cli.command("rebuild-search")
+@each_clinic
+def rebuild_search_command():
+    """Rebuild the full-text index over messages and appointment notes."""
+    rebuild_search_index()
+    db.session.commit()
+    print(f"Indexed {db.session.execute(text('SELECT count(*) FROM search_index')).scalar()} documents.")
+
+@init_step
+def install_search_index():
+    """Create the index and its triggers, and backfill databases that predate them."""
+    if not search_available():
+        return
+    with database_engine().begin() as connection:
+        for statement in SEARCH_SCHEMA:
+            connection.exec_driver_sql(statement)
+    if not db.session.execute(text("SELECT rowid FROM search_index LIMIT 1")).first() and (
+            db.session.query(Message.id).first() or db.session.query(Appointment.id).first()):
+        rebuild_search_index()
+        db.session.commit()
+
+def search_expression(query):
+    """
+    FTS5 query requiring every word of `query`, or None if it has no words.
+    Words are stemmed (knee matches knees) rather than prefix-matched, which
+    would merge the posting lists of every longer word.
+    """
+    words = re.findall(r"\w+", query)[:SEARCH_MAX_TERMS]
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words)
+
+def month_tokens(date_from, date_to):
+    """The "ymYYYYMM" tags covering a date range, or None when it is open or too long to enumerate."""
+    if not (date_from and date_to):
+        return None
+    year, month = int(date_from[:4]), int(date_from[5:7])
+    tokens = []
+    while (year, month) <= (int(date_to[:4]), int(date_to[5:7])):
+        if len(tokens) == SEARCH_MAX_MONTHS:
+            return None
+        tokens.append(f"ym{year}{month:02d}")
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return tokens
+
+def highlight(snippet):
+    """Escape a snippet and turn the match markers into <mark> tags."""
+    return Markup(str(escape(snippet)).replace(_HIT_OPEN, "<mark>").replace(_HIT_CLOSE, "</mark>"))
+
+def search_records(user, query, kind=None, patient_id=None, doctor_id=None, date_from=None, date_to=None, page=1):
+    """
+    One page of hits for `query` that `user` may see: patients only their
+    own messages and notes, doctors only notes on their appointments. The
+    newest SEARCH_RANK_WINDOW matching messages and the newest as many
+    matching notes are ranked together by BM25. Each hit is a dict with kind ("message" or "note"), id, day, a highlighted
+    snippet and display fields. Returns (hits, has_more).
+    """
+    expression = search_expression(query or "")
+    if not expression:
+        return [], False
+
+    tags = []
+    if user.role == "patient":
+        tags.append(f"p{user.id}")
+    elif user.role == "doctor":
+        tags += ["note", f"d{user.id}"]
+    if kind in ("message", "note"):
+        tags.append("msg" if kind == "message" else "note")
+    if patient_id:
+        tags.append(f"p{int(patient_id)}")
+    if doctor_id:
+        tags.append(f"d{int(doctor_id)}")
+    match = f"body : ({expression})" + "".join(f' AND tags : "{tag}"' for tag in dict.fromkeys(tags))
+    months = month_tokens(date_from, date_to)
+    if months == []:
+        return [], False  # An empty date range; FTS5 rejects an empty OR group
+    if months is not None:
+        match += " AND tags : (" + " OR ".join(f'"{token}"' for token in months) + ")"
+
+    # Exact day bounds are checked per row; the window subqueries apply them too.
+    # Rowids only follow time within one kind (message and appointment ids are
+    # separate sequences), so each kind gets its own window of newest matches
+    # and busy chat cannot push every note out of the ranked set.
+    day_criteria, params = [], {"match": match}
+    if date_from:
+        day_criteria.append("day >= :date_from")
+        params["date_from"] = date_from
+    if date_to:
+        day_criteria.append("day <= :date_to")
+        params["date_to"] = date_to
+    where = " AND ".join(["search_index MATCH :match"] + day_criteria)
+    windows = []
+    for kind_name, tag in (("message", "msg"), ("note", "note")):
+        if kind in ("message", "note") and kind != kind_name:
+            continue
+        params[f"match_{tag}"] = f'{match} AND tags : "{tag}"'
+        kind_where = " AND ".join([f"search_index MATCH :match_{tag}"] + day_criteria)
+        windows.append(f"(kind = '{kind_name}' AND rowid >= coalesce((SELECT rowid FROM search_index "
+                       f"WHERE {kind_where} ORDER BY rowid DESC LIMIT 1 OFFSET :window), 0))")
+    rows = db.session.execute(text(
+        f"SELECT kind, ref_id, day, snippet(search_index, 0, :open, :close, '…', 16) FROM search_index "
+        f"WHERE {where} AND ({' OR '.join(windows)}) "
+        f"ORDER BY bm25(search_index, 1.0, 0.0) LIMIT :limit OFFSET :offset"
+    ), {**params, "open": _HIT_OPEN, "close": _HIT_CLOSE, "window": SEARCH_RANK_WINDOW - 1,
+        "limit": SEARCH_PAGE_SIZE + 1, "offset": (page - 1) * SEARCH_PAGE_SIZE}).all()
+
+    has_more = len(rows) > SEARCH_PAGE_SIZE
+    rows = rows[:SEARCH_PAGE_SIZE]
+    details = search_hit_details(
+        [ref_id for kind, ref_id, _, _ in rows if kind == "message"],
+        [ref_id for kind, ref_id, _, _ in rows if kind == "note"],
+    )
+    hits = []
+    for kind, ref_id, day, snippet in rows:
+        detail = details.get((kind, ref_id))
+        if detail is not None:  # Rows deleted outright simply drop out
+            hits.append({"kind": kind, "id": ref_id, "day": day, "snippet": highlight(snippet), **detail})
+    return hits, has_more
+
+def search_hit_details(message_ids, appointment_ids):
+    """Display fields per (kind, id), read from the hot tables and then the archive."""
+    details = {}
+    users = {}
+    for model in (Message, ArchivedMessage):
+        missing = [i for i in message_ids if ("message", i) not in details]
+        if not missing:
+            break
+        for msg in model.query.filter(model.id.in_(missing)):
+            details[("message", msg.id)] = {"sender_id": msg.sender_id, "receiver_id": msg.receiver_id,
+                                            "timestamp": msg.timestamp.strftime("%Y-%m-%d %H:%M")}
+            users.update({msg.sender_id: None, msg.receiver_id: None})
+    for model in (Appointment, ArchivedAppointment):
+        missing = [i for i in appointment_ids if ("note", i) not in details]
+        if not missing:
+            break
+        for appointment in model.query.filter(model.id.in_(missing)):
+            details[("note", appointment.id)] = {
+                "date": appointment.date, "time": appointment.time, "status": appointment.status,
+                "doctor_id": appointment.doctor_id, "patient_id": appointment.patient_id,
+                "archived": appointment.archived,
+            }
+            users.update({appointment.doctor_id: None, appointment.patient_id: None})
+    names = dict(db.session.query(User.id, User.name).filter(User.id.in_(list(users)))) if users else {}
+    for detail in details.values():
+        for key in ("sender", "receiver", "doctor", "patient"):
+            if f"{key}_id" in detail:
+                detail[f"{key}_name"] = names.get(detail[f"{key}_id"])
+    return details
+
+def search_args(args):
+    """Validated search filters from request args; raises ValueError."""
+    page = max(1, min(int(args.get("page", 1)), SEARCH_MAX_PAGE))
+    for key in ("date_from", "date_to"):
+        if args.get(key):
+            datetime.strptime(args[key], "%Y-%m-%d")
+    if args.get("date_from") and args.get("date_to") and args["date_from"] > args["date_to"]:
+        raise ValueError("date_from is after date_to")
+    return dict(
+        kind=args.get("kind") or None,
+        patient_id=int(args["patient_id"]) if args.get("patient_id") else None,
+        doctor_id=int(args["doctor_id"]) if args.get("doctor_id") else None,
+        date_from=args.get("date_from") or None,
+        date_to=args.get("date_to") or None,
+        page=page,
+    )
+
+@bp.route("/search", methods=["GET"])
+def search():
+    """Full-text search over chat messages and appointment notes; format=json for JSON."""
+    user = get_current_user()
+    if not user:
+        return redirect(url_for("main.login"))
+
+    try:
+        filters = search_args(request.args)
+    except ValueError:
+        flash("Invalid search filters.", "danger")
+        return redirect(url_for("main.search"))
+    query = request.args.get("q", "")
+    if not search_available():
+        hits, has_more = [], False
+        flash("Full-text search needs the SQLite database.", "warning")
+    else:
+        hits, has_more = search_records(user, query, **filters)
+
+    if request.args.get("format") == "json":
+        return jsonify(hits=hits, has_more=has_more, page=filters["page"])
+    doctors = reference_cache.get("doctors") if user.role != "doctor" else None
+    return render_template("search.html", user=user, query=query, filters=filters, hits=hits,
+                           has_more=has_more, doctors=doctors)
+
+###############################################################################
+#                              BACKGROUND JOBS                                #
+###############################################################################
+
+job_runs = metrics.counter("jobs_total", "Background jobs run, by kind and outcome")
+job_seconds = metrics.histogram("job_duration_seconds", "Background job run time by kind")
+
+def observe_job(kind, outcome, seconds):
+    job_runs.inc(kind=kind, outcome=outcome)
+    job_seconds.observe(seconds, kind=kind)
+
+job_queue = JobQueue(db, Job, observe=observe_job)  # Lease set by create_app()
+
+def notification_sender():
+    if current_app.config["NOTIFY_SENDER"] == "smtp":
+        return SmtpSender(current_app.config["SMTP_HOST"], current_app.config["SMTP_PORT"],
+                          current_app.config["SMTP_USERNAME"], current_app.config["SMTP_PASSWORD"])
+    return FileSender(current_app.config["NOTIFY_OUTBOX"])
+
+def reminder_message(appointment):
+    message = EmailMessage()
+    message["From"] = current_app.config["NOTIFY_FROM"]
+    message["To"] = appointment.patient.email
+    message["Subject"] = f"Appointment reminder: {appointment.date} at {appointment.time}"
+    message.set_content(
+        f"Dear {appointment.patient.name},\n\n"
+        f"This is a reminder of your appointment with Dr. {appointment.doctor.name} "
+        f"on {appointment.date} at {appointment.time} ({appointment.duration} minutes).\n"
+    )
+    return message
+
+@job_queue.handler("rebuild_billing")
+def rebuild_billing_job(doctor_id=None):
+    rebuild_billing_rollups(doctor_id)
+
+@job_queue.handler("send_reminders")
+def send_reminders_job():
+    """
+    Remind patients of appointments starting within REMINDER_HOURS_BEFORE,
+    one batch per run, then schedule the next run. An appointment is due
+    again when its start moves, since reminder_for no longer matches.
+    """
+    now = datetime.now()
+    due = Appointment.query.options(
+        joinedload(Appointment.doctor), joinedload(Appointment.patient)
+    ).filter(
+        Appointment.start_at > now,
+        Appointment.start_at <= now + timedelta(hours=current_app.config["REMINDER_HOURS_BEFORE"]),
+        Appointment.status != "Canceled",
+        or_(Appointment.reminder_for.is_(None), Appointment.reminder_for != Appointment.start_at)
+    ).order_by(Appointment.start_at).limit(current_app.config["REMINDER_BATCH_SIZE"]).all()
+
+    notification_sender().send([reminder_message(a) for a in due if a.patient.email])
+    if due:
+        # Record the start time that was announced, not the current one, in case of a concurrent reschedule
+        table = Appointment.__table__
+        db.session.execute(
+            db.update(table).where(table.c.id == db.bindparam("appointment_id")).values(
+                reminder_for=db.bindparam("announced")),
+            [{"appointment_id": a.id, "announced": a.start_at} for a in due]
+        )
+    full_batch = len(due) == current_app.config["REMINDER_BATCH_SIZE"]
+    job_queue.enqueue("send_reminders", delay=0 if full_batch else current_app.config["REMINDER_SWEEP_MINUTES"] * 60,
+                      dedupe_key="send_reminders")
+
+def schedule_recurring_jobs():
+    """Make sure the self-rescheduling jobs exist; called whenever workers start."""
+    job_queue.enqueue("send_reminders", dedupe_key="send_reminders")
+    job_queue.enqueue("archive_old_records", dedupe_key="archive_old_records")
+    job_queue.enqueue("rebalance_conversations", dedupe_key="rebalance_conversations")
+    db.session.commit()
+
+def start_job_workers(app, threads=None, clinics=None):
+    """Start a worker pool per clinic (`clinics`, default all), each running that clinic's jobs table."""
+    pools = []
+    with app.app_context():
+        clinics = clinics or clinic_names()
+    for clinic in clinics:
+        with clinic_context(clinic, app):
+            schedule_recurring_jobs()
+        pool = WorkerPool(app, job_queue, threads=threads or app.config["JOB_WORKERS"],
+                          poll_seconds=app.config["JOB_POLL_SECONDS"],
+                          context=lambda clinic=clinic: clinic_context(clinic, app))
+        pool.start()
+        pools.append(pool)
+    return pools
+
+@bp.cli.command("run-worker")
+@click.option("--threads", type=int, default=None, help="Worker threads per clinic (default JOB_WORKERS).")
+@click.option("--once", is_flag=True, help="Run the jobs that are due now, then exit.")
+@click.option("--clinic", default=None, help="Only this clinic's jobs (default: every clinic).")
+def run_worker_command(threads, once, clinic):
+    """Run background jobs (reminders, billing rebuilds) until interrupted."""
+    clinics = selected_clinics(clinic)
+    if once:
+        for clinic in clinics:
+            if clinic:
+                print(f"Clinic {clinic}:")
+            with clinic_context(clinic):
+                schedule_recurring_jobs()
+                print(f"Ran {job_queue.run_pending()} jobs.")
+        return
+    pools = start_job_workers(current_app._get_current_object(), threads, clinics)
+    print(f"Running {sum(pool.threads for pool in pools)} job worker threads; Ctrl+C to stop.")
+    try:
+        for pool in pools:
+            pool.join()
+    except KeyboardInterrupt:
+        for pool in pools:
+            pool.stop()
+
+###############################################################################
+#                                 ARCHIVAL                                    #
+###############################################################################
+
+# Old rows move to appointments_archive / messages_archive with their ids, so
+# the hot tables every page queries stay small. Billing rollups keep counting
+# archived appointments; history pages read through on request.
+
+def move_to_archive(model, archive_model, criteria, order_by, batch_size):
+    """
+    Move up to `batch_size` rows of `model` matching `criteria` into
+    `archive_model` in one transaction. Returns how many rows moved.
+    """
+    begin_write_transaction()
+    ids = db.select(model.id).where(*criteria).order_by(order_by).limit(batch_size)
+    if database_engine().dialect.name != "sqlite":
+        ids = ids.with_for_update(skip_locked=True)
+    ids = db.session.execute(ids).scalars().all()
+    if not ids:
+        db.session.rollback()
+        return 0
+
+    source, target = model.__table__, archive_model.__table__
+    columns = [column.name for column in target.columns if column.name in source.c]
+    db.session.execute(target.insert().from_select(
+        columns + ["archived_at"],
+        db.select(*[source.c[name] for name in columns],
+                  db.literal(datetime.utcnow(), db.DateTime)).where(source.c.id.in_(ids))
+    ))
+    db.session.execute(source.delete().where(source.c.id.in_(ids)))
+    db.session.commit()
+    return len(ids)
+
+def archive_old_records(max_batches=None):
+    """
+    Archive canceled and long-past paid appointments and old messages, batch
+    by batch. Unpaid appointments stay hot so they can still be marked paid,
+    and each conversation keeps its latest message for the inbox summary.
+    Done jobs older than JOB_RETENTION_DAYS are deleted, since the
+    self-rescheduling jobs add a row every run.
+    Returns ({"appointments": n, "messages": n, "jobs": n}, finished).
+    """
+    now, batch_size = datetime.now(), current_app.config["ARCHIVE_BATCH_SIZE"]
+    canceled_before = now - timedelta(days=current_app.config["ARCHIVE_CANCELED_AFTER_DAYS"])
+    paid_before = now - timedelta(days=current_app.config["ARCHIVE_APPOINTMENTS_AFTER_DAYS"])
+    messages_before = datetime.utcnow() - timedelta(days=current_app.config["ARCHIVE_MESSAGES_AFTER_DAYS"])
+    plans = {
+        "appointments": (Appointment, ArchivedAppointment, [
+            Appointment.start_at < max(canceled_before, paid_before),
+            or_(Appointment.status == "Canceled",
+                and_(Appointment.is_paid == True, Appointment.start_at < paid_before)),
+        ], Appointment.start_at),
+        "messages": (Message, ArchivedMessage, [
+            Message.timestamp < messages_before,
+            Message.id.notin_(db.select(Conversation.last_message_id).where(
+                Conversation.last_message_id.isnot(None))),
+        ], Message.timestamp),
+    }
+
+    moved, batches = {**{name: 0 for name in plans}, "jobs": 0}, 0
+    for name, (model, archive_model, criteria, order_by) in plans.items():
+        while max_batches is None or batches < max_batches:
+            count = move_to_archive(model, archive_model, criteria, order_by, batch_size)
+            moved[name] += count
+            batches += 1
+            if count < batch_size:
+                break
+        else:
+            return moved, False
+
+    jobs_before = datetime.utcnow() - timedelta(days=current_app.config["JOB_RETENTION_DAYS"])
+    while max_batches is None or batches < max_batches:
+        count = job_queue.purge(jobs_before, batch_size)
+        moved["jobs"] += count
+        batches += 1
+        if count < batch_size:
+            break
+    else:
+        return moved, False
+    return moved, True
+
+@job_queue.handler("archive_old_records")
+def archive_job(max_batches=50):
+    moved, finished = archive_old_records(max_batches)
+    current_app.logger.info("Archived %(appointments)s appointments and %(messages)s messages; "
+                            "deleted %(jobs)s finished jobs.", moved)
+    delay = 0 if not finished else current_app.config["ARCHIVE_INTERVAL_HOURS"] * 3600
+    job_queue.enqueue("archive_old_records", delay=delay, dedupe_key="archive_old_records")
+
+@bp.cli.command("archive-records")
+@each_clinic
+def archive_records_command():
+    """Move old appointments and messages into the archive tables and delete old finished jobs now."""
+    moved, _ = archive_old_records()
+    print(f"Archived {moved['appointments']} appointments and {moved['messages']} messages; "
+          f"deleted {moved['jobs']} finished jobs.")
+
+###############################################################################
+#                              CHAT ASSIGNMENT                                #
+###############################################################################
+
+# Patient conversations are spread over the receptionists who are online. A
+# conversation stays with whoever is handling it; new ones, and those whose
+# receptionist has gone, go to the online receptionist with the fewest
+# patients waiting for a reply. Presence is refreshed by requests (at most
+# once per CHAT_HEARTBEAT_SECONDS per process), so a closed browser goes
+# offline after CHAT_PRESENCE_TIMEOUT_SECONDS and the rebalance job moves its
+# waiting conversations on.
+
+RESPONSE_BUCKETS = (10, 30, 60, 120, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600)
+
+chat_assignments = metrics.counter("chat_assignments_total", "Patient messages routed to a receptionist, by reason")
+chat_response_seconds = metrics.histogram(
+    "chat_response_seconds", "Wait from a patient's first unanswered message to the reply", RESPONSE_BUCKETS)
+
+_presence_refresh_due = {}  # receptionist id -> monotonic time this process next refreshes their presence
+
+def online_receptionists():
+    """{receptionist id: last_assigned_at} for receptionists online and seen recently."""
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config["CHAT_PRESENCE_TIMEOUT_SECONDS"])
+    return dict(db.session.query(ReceptionistPresence.receptionist_id, ReceptionistPresence.last_assigned_at).filter(
+        ReceptionistPresence.status == "online", ReceptionistPresence.last_seen_at >= cutoff))
+
+def queue_depths(receptionist_ids):
+    """Conversations waiting for a reply per receptionist; missing ids have none."""
+    return dict(db.session.query(Conversation.receptionist_id, func.count()).filter(
+        Conversation.awaiting_reply == True, Conversation.receptionist_id.in_(list(receptionist_ids))
+    ).group_by(Conversation.receptionist_id))
+
+def least_loaded(candidates, depths):
+    """The candidate with the shortest queue, the one assigned to longest ago on ties."""
+    return min(candidates, key=lambda receptionist_id: (
+        depths.get(receptionist_id, 0), candidates[receptionist_id] or datetime.min, receptionist_id))
+
+def route_conversation(patient_id):
+    """
+    The receptionist who gets `patient_id`'s next message: the one already
+    handling the conversation while they are online (or while nobody is),
+    otherwise the least loaded online receptionist, or the least loaded of
+    all of them when nobody is online. Returns None if there are no
+    receptionists. Call before committing.
+    """
+    current = db.session.query(Conversation.receptionist_id).filter_by(patient_id=patient_id).scalar()
+    online = online_receptionists()
+    if current is not None and (current in online or not online):
+        chat_assignments.inc(reason="kept")
+        return current
+
+    candidates = online or {receptionist.id: None for receptionist in reference_cache.get("receptionists")}
+    if not candidates:
+        return None
+    chosen = least_loaded(candidates, queue_depths(candidates))
+    ReceptionistPresence.query.filter_by(receptionist_id=chosen).update(
+        {ReceptionistPresence.last_assigned_at: datetime.utcnow()}, synchronize_session=False)
+    chat_assignments.inc(reason="nobody online" if not online else "new" if current is None else "owner away")
+    return chosen
+
+def rebalance_conversations():
+    """
+    Mark receptionists not seen within CHAT_PRESENCE_TIMEOUT_SECONDS offline,
+    then hand every conversation waiting for a reply whose receptionist is
+    not online to the online ones, longest waiting first, each to whoever
+    has the shortest queue at that point. Conversations nobody is waiting
+    on stay put until the patient writes again. Returns how many moved;
+    call before committing.
+    """
+    cutoff = datetime.utcnow() - timedelta(seconds=current_app.config["CHAT_PRESENCE_TIMEOUT_SECONDS"])
+    ReceptionistPresence.query.filter(
+        ReceptionistPresence.status == "online", ReceptionistPresence.last_seen_at < cutoff
+    ).update({ReceptionistPresence.status: "offline"}, synchronize_session=False)
+    online = online_receptionists()
+    if not online:
+        return 0
+
+    waiting = db.session.query(Conversation.id).filter(
+        Conversation.awaiting_reply == True,
+        or_(Conversation.receptionist_id.is_(None), Conversation.receptionist_id.notin_(list(online)))
+    ).order_by(Conversation.awaiting_since).all()
+    depths = queue_depths(online)
+    moves = {}
+    for conversation_id, in waiting:
+        target = least_loaded(online, depths)
+        depths[target] = depths.get(target, 0) + 1
+        moves.setdefault(target, []).append(conversation_id)
+    for target, conversation_ids in moves.items():
+        # Skips conversations answered in the meantime
+        Conversation.query.filter(Conversation.id.in_(conversation_ids), Conversation.awaiting_reply == True).update(
+            {Conversation.receptionist_id: target}, synchronize_session=False)
+    if waiting:
+        chat_assignments.inc(len(waiting), reason="rebalanced")
+    return len(waiting)
+
+def set_presence(receptionist_id, status):
+    """Record a receptionist going online, away or offline, rebalance and commit. Returns how many conversations moved."""
+    presence = db.session.get(ReceptionistPresence, receptionist_id)
+    if presence is None:
+        presence = ReceptionistPresence(receptionist_id=receptionist_id, replies=0, reply_seconds=0)
+        db.session.add(presence)
+    presence.status = status
+    presence.last_seen_at = datetime.utcnow()
+    db.session.flush()
+    moved = rebalance_conversations()
+    db.session.commit()
+    _presence_refresh_due.pop(receptionist_id, None)
+    return moved
+
+def refresh_presence(receptionist_id):
+    """Mark a receptionist seen now, bringing them back online unless they chose to be away. Commits."""
+    now = time_module.monotonic()
+    if _presence_refresh_due.get(receptionist_id, 0) > now:
+        return
+    _presence_refresh_due[receptionist_id] = now + current_app.config["CHAT_HEARTBEAT_SECONDS"]
+    updated = ReceptionistPresence.query.filter(
+        ReceptionistPresence.receptionist_id == receptionist_id, ReceptionistPresence.status != "away"
+    ).update({ReceptionistPresence.status: "online", ReceptionistPresence.last_seen_at: datetime.utcnow()},
+             synchronize_session=False)
+    if not updated and db.session.get(ReceptionistPresence, receptionist_id) is None:
+        db.session.add(ReceptionistPresence(receptionist_id=receptionist_id, status="online",
+                                            last_seen_at=datetime.utcnow(), replies=0, reply_seconds=0))
+    db.session.commit()
+
+@bp.before_app_request
+def refresh_receptionist_presence():
+    user_id = session.get("user_id")
+    if user_id is None:
+        return
+    # Only receptionists have a presence, so only they get a refresh time; the
+    # user is memoized for the request and cached across requests anyway
+    user = load_user(user_id)
+    if user is not None and user.role == "receptionist":
+        refresh_presence(user.id)
+
+def record_reply(receptionist_id, waited_seconds):
+    """Add one reply, answered after `waited_seconds`, to the receptionist's statistics."""
+    chat_response_seconds.observe(waited_seconds)
+    ReceptionistPresence.query.filter_by(receptionist_id=receptionist_id).update({
+        ReceptionistPresence.replies: ReceptionistPresence.replies + 1,
+        ReceptionistPresence.reply_seconds: ReceptionistPresence.reply_seconds + waited_seconds,
+    }, synchronize_session=False)
+
+def chat_queue_stats():
+    """Status, queue depth and average reply time per receptionist, plus the oldest wait overall."""
+    receptionists = reference_cache.get("receptionists")
+    presence = {row.receptionist_id: row for row in ReceptionistPresence.query}
+    online = online_receptionists()
+    depths = queue_depths([receptionist.id for receptionist in receptionists])
+    oldest = db.session.query(func.min(Conversation.awaiting_since)).filter(
+        Conversation.awaiting_reply == True).scalar()
+    team = []
+    for receptionist in receptionists:
+        row = presence.get(receptionist.id)
+        status = row.status if row else "offline"
+        team.append({
+            "receptionist_id": receptionist.id,
+            "name": receptionist.name,
+            "status": "online" if receptionist.id in online else "offline" if status == "online" else status,
+            "waiting": depths.get(receptionist.id, 0),
+            "replies": row.replies if row else 0,
+            "average_reply_seconds": round(row.reply_seconds / row.replies, 1) if row and row.replies else None,
+        })
+    return {
+        "receptionists": team,
+        "online": len(online),
+        "waiting": sum(depths.values()),
+        "oldest_wait_seconds": round((datetime.utcnow() - oldest).total_seconds()) if oldest else None,
+    }
+
+@job_queue.handler("rebalance_conversations")
+def rebalance_conversations_job():
+    rebalance_conversations()
+    db.session.commit()
+    job_queue.enqueue("rebalance_conversations", delay=current_app.config["CHAT_REBALANCE_SECONDS"],
+                      dedupe_key="rebalance_conversations")
+
+@bp.route("/chat/presence", methods=["POST"])
+def chat_presence():
+    """A receptionist sets themselves online or away; going away hands their waiting patients on."""
+    user = get_current_user()
+    if not user or user.role != "receptionist":
+        flash("Access denied.", "danger")
+        return redirect(url_for("main.dashboard"))
+    status = request.form.get("status")
+    if status not in ("online", "away"):
+        flash("Invalid status.", "danger")
+        return redirect(url_for("main.chat"))
+
+    moved = set_presence(user.id, status)
+    message = f"You are now {status}."
+    if moved:
+        message += f" {moved} waiting conversation{'s' if moved != 1 else ''} reassigned."
+    flash(message, "success")
+    return redirect(url_for("main.chat"))
+
+@bp.route("/chat/queue", methods=["GET"])
+def chat_queue():
+    """Reception's chat queue as JSON: who is online, how many patients wait on each, and reply times."""
+    user = get_current_user()
+    if not user or user.role != "receptionist":
+        return jsonify(error="Access denied."), 403
+    return jsonify(chat_queue_stats())
+
+###############################################################################
+#                                 JSON API                                    #
+###############################################################################
+
+# Versioned JSON for front-desk and mobile clients. Clients log in through
+# /api/v1/session and then use the same session cookie as the web pages.
+# List endpoints take ?fields=a,b,c to return only those keys, and page with
+# the opaque `next` cursor from the previous response.
+
+API_PAGE_LIMIT = 200
+API_BATCH_LIMIT = 500
+
+APPOINTMENT_FIELDS = {
+    "id": lambda a, cost: a.id,
+    "doctor_id": lambda a, cost: a.doctor_id,
+    "doctor_name": lambda a, cost: a.doctor.name,
+    "patient_id": lambda a, cost: a.patient_id,
+    "patient_name": lambda a, cost: a.patient.name,
+    "date": lambda a, cost: a.date,
+    "time": lambda a, cost: a.time,
+    "duration": lambda a, cost: a.duration,
+    "status": lambda a, cost: a.status,
+    "notes": lambda a, cost: a.notes,
+    "cost": lambda a, cost: cost,
+    "is_paid": lambda a, cost: bool(a.is_paid),
+    "payment_date": lambda a, cost: a.payment_date.isoformat() if a.payment_date else None,
+    "series_id": lambda a, cost: a.series_id,
+    "version": lambda a, cost: a.version,
+    "archived": lambda a, cost: a.archived,
+}
+APPOINTMENT_DEFAULT_FIELDS = ("id", "doctor_id", "patient_id", "date", "time", "duration",
+                              "status", "cost", "is_paid", "version")
+
+def api_error(message, status):
+    return jsonify(error=message), status
+
+def api_user():
+    """(user, None) for a logged-in client, else (None, 401 response)."""
+    user = get_current_user()
+    if not user:
+        return None, api_error("Login required.", 401)
+    return user, None
+
+def api_fields(available, default):
+    """Field names requested with ?fields=, in order. Raises ValueError for unknown ones."""
+    requested = request.args.get("fields")
+    if not requested:
+        return list(default)
+    fields = [name.strip() for name in requested.split(",") if name.strip()]
+    unknown = [name for name in fields if name not in available]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+def serialize_appointment(appointment, cost, fields):
+    return {name: APPOINTMENT_FIELDS[name](appointment, cost) for name in fields}
+
+def api_ids(payload):
+    """Distinct appointment ids from a batch body {"ids": [...]}. Raises ValueError."""
+    ids = payload.get("ids") if isinstance(payload, dict) else None
+    if not isinstance(ids, list) or not ids:
+        raise ValueError("Expected a non-empty list of ids.")
+    if len(ids) > API_BATCH_LIMIT:
+        raise ValueError(f"At most {API_BATCH_LIMIT} ids per call.")
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise ValueError("Ids must be integers.")
+    return list(dict.fromkeys(ids))
+
+def appointment_visible(user, row):
+    """Whether `user` may act on an appointment row: its patient, its doctor, or reception."""
+    if user.role == "patient":
+        return row["patient_id"] == user.id
+    if user.role == "doctor":
+        return row["doctor_id"] == user.id
+    return user.role == "receptionist"
+
+def batch_update_appointments(user, ids, allowed, values, reason):
+    """
+    Apply `values` to every appointment in `ids` that `allowed(row)` accepts,
+    as one UPDATE in one transaction. Rows are matched on (id, version), so
+    an appointment edited since it was read aborts the whole batch rather
+    than being overwritten; that returns (None, None) for the caller to retry.
+    Otherwise returns (changed rows as dicts, skipped [{"id", "reason"}]),
+    where `reason(row)` explains why `allowed` refused a row.
+    """
+    found = {row["id"]: row for row in _occurrence_rows([Appointment.id.in_(ids)])}
+    changed, skipped = [], []
+    for appointment_id in ids:
+        row = found.get(appointment_id)
+        if row is None or not appointment_visible(user, row):
+            skipped.append({"id": appointment_id, "reason": "not found"})
+        elif not allowed(row):
+            skipped.append({"id": appointment_id, "reason": reason(row)})
+        else:
+            changed.append(row)
+    if not changed:
+        return changed, skipped
+
+    updated = Appointment.query.filter(
+        tuple_(Appointment.id, Appointment.version).in_([(row["id"], row["version"]) for row in changed])
+    ).update(
+        {**values, Appointment.updated_at: datetime.utcnow(), Appointment.version: Appointment.version + 1},
+        synchronize_session=False
+    )
+    if updated != len(changed):
+        db.session.rollback()
+        return None, None
+    return changed, skipped
+
+@bp.route("/api/v1/session", methods=["POST", "DELETE"])
+def api_session():
+    """Log in with {"username", "password"} (sets the session cookie), or log out."""
+    if request.method == "DELETE":
+        session.clear()
+        return jsonify(ok=True)
+
+    payload = request.get_json(silent=True) or {}
+    try:
+        user, retry_after = check_credentials(payload.get("username"), payload.get("password"),
+                                              request.remote_addr or "unknown")
+    except HashingBusy:
+        return jsonify(error="The server is busy right now."), 503, {"Retry-After": "2"}
+    if retry_after:
+        return jsonify(error="Too many login attempts."), 429, {"Retry-After": str(retry_after)}
+    if not user:
+        return api_error("Invalid credentials.", 401)
+    session["user_id"] = user.id
+    return jsonify(id=user.id, name=user.name, role=user.role, clinic=user_clinic(user))
+
+@bp.route("/api/v1/appointments", methods=["GET", "POST"])
+def api_appointments():
+    """
+    GET: one page of visible appointments. Filters doctor_id, status,
+    date_from, date_to, archived=1; paging with limit and after=<next>.
+    POST: book {"doctor_id", "patient_id" (reception only), "date", "time",
+    "duration", "notes"}; answers 201 with the appointment or 409 if taken.
+    """
+    user, error = api_user()
+    if error:
+        return error
+
+    if request.method == "POST":
+        if user.role not in ["patient", "receptionist"]:
+            return api_error("Access denied.", 403)
+        payload = request.get_json(silent=True) or {}
+        try:
+            patient_id = user.id if user.role == "patient" else int(payload["patient_id"])
+            doctor_id, date, time = int(payload["doctor_id"]), payload["date"], payload["time"]
+            duration = int(payload.get("duration", 60))
+            parse_minutes(date, time)
+        except (KeyError, TypeError, ValueError):
+            return api_error("doctor_id, date (YYYY-MM-DD), time (HH:MM) and an integer duration are required.", 400)
+        patient = load_user(patient_id)
+        if not patient or patient.role != "patient":
+            return api_error("Unknown patient.", 400)
+
+        appointment, message = book_appointment(doctor_id, patient_id, date, time, duration,
+                                                payload.get("notes", ""))
+        if not appointment:
+            return api_error(message, 409)
+        return jsonify(serialize_appointment(appointment, appointment.calculate_cost(),
+                                             APPOINTMENT_DEFAULT_FIELDS)), 201
+
+    try:
+        fields = api_fields(APPOINTMENT_FIELDS, APPOINTMENT_DEFAULT_FIELDS)
+    except ValueError as exc:
+        return api_error(str(exc), 400)
+    limit = min(request.args.get("limit", APPOINTMENTS_PAGE_SIZE, type=int), API_PAGE_LIMIT)
+    rows, _, next_cursor = appointment_page(user, request.args, limit=max(limit, 1))
+    return jsonify(appointments=[serialize_appointment(a, cost, fields) for a, cost in rows],
+                   next=next_cursor)
+
+@bp.route("/api/v1/appointments/<int:appointment_id>", methods=["GET"])
+def api_appointment(appointment_id):
+    user, error = api_user()
+    if error:
+        return error
+    try:
+        fields = api_fields(APPOINTMENT_FIELDS, APPOINTMENT_FIELDS)
+    except ValueError as exc:
+        return api_error(str(exc), 400)
+    appointment = db.session.get(Appointment, appointment_id) or db.session.get(ArchivedAppointment, appointment_id)
+    if not appointment or not appointment_visible(user, {"patient_id": appointment.patient_id,
+                                                         "doctor_id": appointment.doctor_id}):
+        return api_error("Appointment not found.", 404)
+    return jsonify(serialize_appointment(appointment, appointment.calculate_cost(), fields))
+
+@bp.route("/api/v1/appointments/<int:appointment_id>/history", methods=["GET"])
+def api_appointment_history(appointment_id):
+    """Audited changes to an appointment and its state replayed as of ?at= (ISO 8601, UTC; default now)."""
+    user, error = api_user()
+    if error:
+        return error
+    try:
+        at = datetime.fromisoformat(request.args["at"]) if request.args.get("at") else None
+    except ValueError:
+        return api_error("at must be an ISO 8601 date and time.", 400)
+    if at is not None and at.tzinfo is not None:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    appointment = db.session.get(Appointment, appointment_id) or db.session.get(ArchivedAppointment, appointment_id)
+    if not appointment or not appointment_visible(user, {"patient_id": appointment.patient_id,
+                                                         "doctor_id": appointment.doctor_id}):
+        return api_error("Appointment not found.", 404)
+    state, events = appointment_state_at(appointment_id, at)
+    return jsonify(id=appointment_id, at=at.isoformat() if at else None, state=state, events=[
+        {**row, "at": row["at"].isoformat(timespec="seconds")} for row in events
+    ])
+
+@bp.route("/api/v1/appointments/cancel", methods=["POST"])
+def api_cancel_appointments():
+    """Cancel many appointments: {"ids": [...]} -> {"canceled": [...], "skipped": [...]}."""
+    user, error = api_user()
+    if error:
+        return error
+    try:
+        ids = api_ids(request.get_json(silent=True))
+    except ValueError as exc:
+        return api_error(str(exc), 400)
+
+    canceled, skipped = batch_update_appointments(
+        user, ids, lambda row: row["status"] != "Canceled",
+        {Appointment.status: "Canceled"}, lambda row: "already canceled"
+    )
+    if canceled is None:
+        return api_error("Some appointments were changed by someone else. Please retry.", 409)
+    if canceled:
+        bump_rollups_for(canceled, sign=-1)
+        for row in canceled:
+            audit_appointment("canceled", {**row, "status": "Canceled"})
+        db.session.commit()
+        for row in canceled:
+            appointment_index.remove(row["doctor_id"], row["id"])
+    return jsonify(canceled=[row["id"] for row in canceled], skipped=skipped)
+
+@bp.route("/api/v1/appointments/mark_paid", methods=["POST"])
+def api_mark_paid():
+    """Record payment for many appointments: {"ids": [...]} -> {"paid": [...], "skipped": [...]}."""
+    user, error = api_user()
+    if error:
+        return error
+    if user.role not in ["doctor", "receptionist"]:
+        return api_error("Access denied.", 403)
+    try:
+        ids = api_ids(request.get_json(silent=True))
+    except ValueError as exc:
+        return api_error(str(exc), 400)
+
+    paid, skipped = batch_update_appointments(
+        user, ids, lambda row: row["status"] != "Canceled" and not row["is_paid"],
+        {Appointment.is_paid: True, Appointment.payment_date: datetime.utcnow()},
+        lambda row: "canceled" if row["status"] == "Canceled" else "already paid"
+    )
+    if paid is None:
+        return api_error("Some appointments were changed by someone else. Please retry.", 409)
+    if paid:
+        bump_rollups_for(paid, sign=-1)
+        bump_rollups_for([{**row, "is_paid": True} for row in paid])
+        for row in paid:
+            audit_appointment("paid", {**row, "is_paid": True})
+        db.session.commit()
+    return jsonify(paid=[row["id"] for row in paid], skipped=skipped)
+
+@bp.route("/api/v1/availability/<int:doctor_id>", methods=["GET"])
+def api_availability(doctor_id):
+    """A doctor's weekly windows and upcoming exceptions, with ETag revalidation."""
+    user, error = api_user()
+    if error:
+        return error
+    windows, exceptions = reference_cache.get("availability", doctor_id)
+    today = datetime.now().strftime("%Y-%m-%d")
+    payload = {
+        "doctor_id": doctor_id,
+        "windows": [{"day_of_week": w.day_of_week, "start_time": w.start_time, "end_time": w.end_time,
+                     "is_available": bool(w.is_available)}
+                    for w in windows],
+        "exceptions": [{"date": e.date, "start_time": e.start_time, "end_time": e.end_time,
+                        "is_available": bool(e.is_available), "reason": e.reason}
+                       for e in exceptions if e.date >= today],
+    }
+    return conditional_json(page_validators(user, [("availability", doctor_id)]), payload)
+
+@bp.route("/api/v1/rates", methods=["GET"])
+def api_rates():
+    """Hourly rate per doctor, with ETag revalidation."""
+    user, error = api_user()
+    if error:
+        return error
+    doctors = reference_cache.get("doctors")
+    rates = reference_cache.get("rates")
+    payload = {"rates": [
+        {"doctor_id": d.id, "doctor_name": d.name,
+         "rate_per_hour": rates[d.id].rate_per_hour if d.id in rates else None}
+        for d in doctors
+    ]}
+    return conditional_json(page_validators(user, [("doctors", None), ("rates", None)]), payload)
+
+@bp.route("/api/v1/billing", methods=["GET"])
+def api_billing():
+    """Billed, paid and outstanding totals from the rollups; see billing_report_for."""
+    user, error = api_user()
+    if error:
+        return error
+    group_by = request.args.get("group_by", "day")
+    rows = billing_report_for(user, group_by, request.args)
+    if rows is None:
+        return api_error("group_by must be doctor, patient, day or clinic.", 400)
+    return jsonify(group_by=group_by, rows=rows)
+
+@bp.route("/api/v1/search", methods=["GET"])
+def api_search():
+    """Ranked full-text hits over messages and notes; same filters as /search."""
+    user, error = api_user()
+    if error:
+        return error
+    if not search_available():
+        return api_error("Full-text search needs the SQLite database.", 501)
+    try:
+        filters = search_args(request.args)
+    except ValueError:
+        return api_error("Invalid search filters.", 400)
+    hits, has_more = search_records(user, request.args.get("q", ""), **filters)
+    return jsonify(hits=hits, has_more=has_more, page=filters["page"])
+
+@bp.route("/api/v1/messages", methods=["GET"])
+def api_messages():
+    """
+    One page of the caller's conversation (patient_id selects it for
+    reception): after_id for newer messages, before_id for history.
+    """
+    user, error = api_user()
+    if error:
+        return error
+    patient_id, error = chat_patient(user, request.args.get("patient_id"))
+    if error:
+        return api_error(error, 400)
+    limit = min(request.args.get("limit", CHAT_PAGE_SIZE, type=int), API_PAGE_LIMIT)
+    messages, has_more = conversation_messages(
+        patient_id,
+        before_id=request.args.get("before_id", type=int),
+        after_id=request.args.get("after_id", type=int),
+        limit=max(limit, 1)
+    )
+    return jsonify(messages=[message_json(m) for m in messages], has_more=has_more)
+
+###############################################################################
+#                                  METRICS                                    #
+###############################################################################
+
+@bp.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    """Prometheus text exposition of the request, SQL, template and hashing metrics."""
+    if not current_app.config["METRICS_ENABLED"]:
+        return "Metrics are disabled.", 404
+    token = current_app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return "Unauthorized.", 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+###############################################################################
+#                             APPLICATION FACTORY                             #
+###############################################################################
+
+def configure_services(config):
+    """Size the process-wide helpers from an app's config; nothing here connects or starts a thread."""
+    global password_hasher, ip_throttle, account_throttle
+    metrics.slow_query_seconds = config["METRICS_SLOW_QUERY_MS"] / 1000
+    identity_cache.max_size = config["IDENTITY_CACHE_SIZE"]
+    identity_cache.ttl = config["IDENTITY_CACHE_TTL"]
+    reference_cache.ttl = config["REFERENCE_CACHE_TTL"]
+    job_queue.lease = timedelta(seconds=config["JOB_LEASE_SECONDS"])
+    audit_log.batch_size = config["AUDIT_BATCH_SIZE"]
+    audit_log.flush_seconds = config["AUDIT_FLUSH_SECONDS"]
+    audit_log.max_pending = config["AUDIT_MAX_PENDING"]
+    password_hasher = PasswordHasher(
+        rounds=config["PASSWORD_HASH_ROUNDS"],
+        workers=config["PASSWORD_HASH_WORKERS"],
+        max_pending=config["PASSWORD_HASH_MAX_PENDING"]
+    )
+    ip_throttle = AttemptThrottle(*config["LOGIN_ATTEMPTS_PER_IP"])
+    account_throttle = AttemptThrottle(*config["LOGIN_FAILURES_PER_ACCOUNT"])
+
+def create_app(profile=None, **overrides):
+    """
+    Build the app for a config profile (default APP_PROFILE, else
+    "development") plus `overrides`. No database connection is opened and
+    no thread is started, so a server can build it once and fork workers
+    from it; creating and migrating the schema is left to `flask init-db`.
+    """
+    profile = profile or os.environ.get("APP_PROFILE", "development")
+    app = Flask(__name__)
+    app.config.from_object(PROFILES[profile])
+    app.config.update(overrides)
+    if profile == "production" and app.config["SECRET_KEY"] == DEFAULT_SECRET_KEY:
+        raise RuntimeError("Set SECRET_KEY for the production profile.")
+    if profile == "production" and app.config["METRICS_ENABLED"] and not app.config["METRICS_TOKEN"]:
+        # /metrics lists every route's latency, status counts and SQL timings
+        raise RuntimeError("Set METRICS_TOKEN (or METRICS_ENABLED=0) for the production profile.")
+    if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {
+            "pool_size": app.config["DATABASE_POOL_SIZE"],
+            "max_overflow": app.config["DATABASE_MAX_OVERFLOW"],
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+        })
+    if app.config["CLINIC_DATABASES"]:
+        # One engine per clinic beside the default (directory) one; ClinicSession picks between them
+        app.config["SQLALCHEMY_BINDS"] = {
+            **app.config.get("SQLALCHEMY_BINDS", {}),
+            **{clinic_bind_key(clinic): url for clinic, url in app.config["CLINIC_DATABASES"].items()},
+        }
+
+    db.init_app(app)
+    app.register_blueprint(bp)
+    configure_services(app.config)
+    audit_log.writer = audit_writer(app)
+    metrics.logger = app.logger
+    if app.config["METRICS_ENABLED"]:
+        metrics.instrument_app(app)
+
+    with app.app_context():
+        engines = list(db.engines.values())
+    for engine in engines:
+        if engine.dialect.name == "sqlite":
+            event.listen(engine, "connect", sqlite_connection_listener(app.config))
+        if app.config["METRICS_ENABLED"]:
+            metrics.instrument_engine(engine)
+
+    # A forked worker must not reuse its parent's connections; it opens its own on first use
+    def discard_inherited_connections():
+        for engine in engines:
+            engine.dispose(close=False)
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=discard_inherited_connections)
+
+    if app.config["PRECOMPILE_TEMPLATES"]:
+        # Compiled once here, so preforked workers share them instead of each compiling on first render
+        for name in app.jinja_env.list_templates(extensions=["html"]):
+            app.jinja_env.get_template(name)
+    return app
+
 ###############################################################################
 #                                MAIN EXECUTION                               #
 ###############################################################################
 
 if __name__ == "__main__":
-    app.run(debug=True,port=5002)
+    app = create_app()
+    with app.app_context():
+        init_database()  # The development server keeps its own database up to date
+    # The reloader runs the app in a child process; only that one gets workers
+    if not app.debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_job_workers(app)
+    app.run(debug=app.config["DEBUG"], host=app.config["HOST"], port=app.config["PORT"])
@@ -0,0 +1,139 @@
+"""
+audit.py
+
+Write-behind audit log, so recording history adds no statement to the
+write it describes:
+- AuditLog: events handed over once their change has committed are
+  buffered in memory and appended to the database in batches by one
+  background thread, and written out at interpreter exit
+- replay(): fold a sequence of events into the state they describe at a
+  point in time
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class AuditLog:
+    """
+    Events are dicts of the audit table's columns, written through
+    `writer(rows)`, which must insert one batch in one transaction. The
+    writer thread starts with the first event, so building an app and
+    forking workers from it starts none.
+
+    The thread writes every `flush_seconds`, or sooner once `batch_size`
+    events wait. A batch that fails to write is kept and retried. Past
+    `max_pending` waiting events (the database is slow or down), the
+    recording thread writes a batch itself, so writers slow down instead of
+    memory growing without bound. With flush_seconds=0 every event is
+    written before record() returns.
+
+    Buffered events are only lost if the process dies without running its
+    exit handlers (e.g. SIGKILL), and then at most `flush_seconds` of them.
+    """
+
+    def __init__(self, writer=None, batch_size=500, flush_seconds=1.0, max_pending=50000, observe=None):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_pending = max_pending
+        self.observe = observe  # observe(events_written, seconds) after every batch
+        self._reset()
+        atexit.register(self.close)
+        if hasattr(os, "register_at_fork"):
+            # The parent still owns and writes what it buffered; a child starts empty, without a thread
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # One batch at a time, so events reach the table in order
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def pending(self):
+        return len(self._pending)
+
+    def record(self, events):
+        """Buffer events for changes that have committed."""
+        if not events:
+            return
+        with self._lock:
+            self._pending.extend(events)
+            backlog = len(self._pending)
+            inline = not self.flush_seconds or self._stop.is_set()
+            if not inline and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                self._thread.start()
+        if inline or backlog > self.max_pending:
+            try:
+                self.flush(limit=None if inline else self.batch_size)
+            except Exception:
+                # The change itself has committed; its events stay buffered for the writer thread
+                logger.exception("Could not write audit events; %d kept for retry", self.pending())
+        elif backlog >= self.batch_size:
+            self._wake.set()
+
+    def flush(self, limit=None):
+        """Write buffered events (at most `limit`) in batches; returns how many were written."""
+        written = 0
+        with self._write_lock:
+            while limit is None or written < limit:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    break
+                started = time.perf_counter()
+                try:
+                    self.writer(batch)
+                except Exception:
+                    with self._lock:
+                        self._pending.extendleft(reversed(batch))
+                    raise
+                written += len(batch)
+                if self.observe:
+                    self.observe(len(batch), time.perf_counter() - started)
+        return written
+
+    def close(self, timeout=10):
+        """Stop the writer thread and write whatever is still buffered; runs at exit."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._pending:
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Lost %d audit events at shutdown", self.pending())
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Audit writer failed; %d events kept for the next attempt", self.pending())
+                self._stop.wait(self.flush_seconds)
+
+
+def replay(events, at=None):
+    """
+    The state described by `events` (dicts with "at" and "data", oldest
+    first) as of `at`, or after all of them: each event's data overrides
+    the fields it names. None if no event happened by then.
+    """
+    state = None
+    for event in events:
+        if at is not None and event["at"] > at:
+            break
+        state = {**(state or {}), **event["data"]}
+    return state
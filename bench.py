@@ -0,0 +1,634 @@
+"""
+bench.py
+
+Local benchmarks for Med Sched Pro.
+
+Usage:
+    python bench.py hashing [--rounds N] [--workers N] [--seconds S]
+    python bench.py stress-booking [--processes N] [--requests N] [--database URL]
+    python bench.py seed --database URL [--doctors N] [--patients N] [--appointments N] [--messages N]
+    python bench.py http --database URL [--url URL] [--seconds S] [--save FILE] [--compare FILE]
+    python bench.py startup [--profile NAME ...] [--runs N] [--database URL]
+    python bench.py audit [--cycles N] [--database URL]
+"""
+
+import argparse
+import http.cookiejar
+import json
+import math
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+from passwords import HashingBusy, PasswordHasher
+
+
+def bench_hashing(args):
+    """Logins/sec: PBKDF2 verifies on one core, then through the bounded pool."""
+    hasher = PasswordHasher(rounds=args.rounds, workers=args.workers, max_pending=args.workers * 4)
+    stored = hasher.scheme.hash("correct horse battery staple")
+
+    deadline = time.perf_counter() + args.seconds
+    single = 0
+    while time.perf_counter() < deadline:
+        hasher.scheme.verify("correct horse battery staple", stored)
+        single += 1
+    per_core = single / args.seconds
+
+    # Offer more concurrent logins than the pool accepts to show load shedding
+    done, rejected = 0, 0
+    def login():
+        nonlocal done, rejected
+        try:
+            hasher.verify("correct horse battery staple", stored)
+            done += 1
+        except HashingBusy:
+            rejected += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers * 8) as clients:
+        while time.perf_counter() - started < args.seconds:
+            list(clients.map(lambda _: login(), range(args.workers * 8)))
+    elapsed = time.perf_counter() - started
+    hasher.shutdown()
+
+    print(f"rounds:            {hasher.scheme.default_rounds}")
+    print(f"logins/sec/core:   {per_core:.1f}")
+    print(f"pool workers:      {args.workers}")
+    print(f"pool logins/sec:   {done / elapsed:.1f}  (rejected {rejected / elapsed:.1f}/sec as busy)")
+
+
+STRESS_FIRST_DAY = date(2031, 1, 6)  # A Monday far enough ahead to be bookable
+STRESS_DAYS = 2
+
+
+def _seed_stress_database(patients):
+    """One doctor open 08:00-17:00 every day and `patients` patients, all with password "pw"."""
+    from app import DoctorAvailability, User, create_app, db, hash_password, init_database
+
+    app = create_app()
+    with app.app_context():
+        init_database()
+        password = hash_password("pw")
+        doctor = User(username="stress-doctor", password=password, role="doctor", name="Stress")
+        db.session.add(doctor)
+        db.session.add_all(User(username=f"stress-patient-{i}", password=password, role="patient",
+                                name=f"Patient {i}") for i in range(patients))
+        db.session.flush()
+        db.session.add_all(DoctorAvailability(doctor_id=doctor.id, day_of_week=day, start_time="08:00",
+                                              end_time="17:00", is_available=True) for day in range(7))
+        db.session.commit()
+        return doctor.id
+
+
+def _booking_worker(worker, doctor_id, patients, requests, start_at):
+    """Log in as one patient and fire booking requests at random, overlapping slots."""
+    from app import create_app
+
+    client = create_app().test_client()
+    client.post("/login", data={"username": f"stress-patient-{worker % patients}", "password": "pw"})
+    rng = random.Random(worker)
+    time.sleep(max(start_at - time.time(), 0))  # Let every process start before the race
+
+    booked = rejected = errors = 0
+    for _ in range(requests):
+        day = STRESS_FIRST_DAY + timedelta(days=rng.randrange(STRESS_DAYS))
+        minute = 8 * 60 + 15 * rng.randrange(32)
+        response = client.post("/schedule_appointment", data={
+            "doctor_id": doctor_id,
+            "date": day.isoformat(),
+            "time": f"{minute // 60:02d}:{minute % 60:02d}",
+            "duration": rng.choice([30, 60]),
+        })
+        if response.status_code >= 500:
+            errors += 1
+        elif response.headers.get("Location", "").endswith("/appointments"):
+            booked += 1
+        else:
+            rejected += 1
+    return booked, rejected, errors
+
+
+def bench_stress_booking(args):
+    """Concurrent processes race for a few hours of one doctor's time; any overlap is a double booking."""
+    if args.database:
+        os.environ["DATABASE_URL"] = args.database
+    else:
+        os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'stress.db')}"
+    doctor_id = _seed_stress_database(args.processes)
+
+    # Spawned workers import app afresh, so each has its own engine and appointment index
+    start_at = time.time() + args.warmup
+    with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+        results = pool.starmap(_booking_worker, [
+            (worker, doctor_id, args.processes, args.requests, start_at) for worker in range(args.processes)
+        ])
+    elapsed = time.time() - start_at
+    booked, rejected, errors = (sum(column) for column in zip(*results))
+
+    from app import create_app, db
+    from sqlalchemy import text
+    with create_app().app_context():
+        double_booked = db.session.execute(text("""
+            SELECT COUNT(*) FROM appointments a JOIN appointments b
+              ON a.doctor_id = b.doctor_id AND a.id < b.id
+             AND a.start_at < b.end_at AND b.start_at < a.end_at
+           WHERE a.status != 'Canceled' AND b.status != 'Canceled'
+        """)).scalar()
+        dialect = db.engine.dialect.name
+
+    total = booked + rejected + errors
+    print(f"database:          {dialect}")
+    print(f"processes:         {args.processes}")
+    print(f"requests:          {total} in {elapsed:.1f}s ({total / elapsed:.1f}/sec)")
+    print(f"booked/rejected:   {booked}/{rejected}  (server errors {errors})")
+    print(f"double bookings:   {double_booked}")
+    if double_booked or errors:
+        raise SystemExit(1)
+
+
+SEED_BATCH_SIZE = 10000
+SEED_HOURS = range(8, 17)  # One-hour slots inside the seeded 08:00-17:00 availability
+
+
+def _use_database(url):
+    """Point app.py at `url`; must run before app (and so config) is first imported."""
+    if url:
+        os.environ["DATABASE_URL"] = url
+
+
+def _insert_batches(db, model, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= SEED_BATCH_SIZE:
+            db.session.execute(db.insert(model), batch)
+            db.session.commit()
+            batch = []
+    if batch:
+        db.session.execute(db.insert(model), batch)
+        db.session.commit()
+
+
+def _seed_appointments(rng, doctor_ids, patient_ids, count, today):
+    """Non-overlapping one-hour appointments, spread around today for every doctor."""
+    per_doctor = -(-count // len(doctor_ids))
+    days = max(-(-per_doctor * 3 // (2 * len(SEED_HOURS))), 1)  # About two-thirds of slots taken
+    first_day = today - timedelta(days=days // 2)
+    produced = 0
+    for doctor_id in doctor_ids:
+        for slot in sorted(rng.sample(range(days * len(SEED_HOURS)), min(per_doctor, count - produced))):
+            start_at = datetime.combine(first_day + timedelta(days=slot // len(SEED_HOURS)), datetime.min.time())
+            start_at += timedelta(hours=SEED_HOURS[slot % len(SEED_HOURS)])
+            paid = start_at.date() < today and rng.random() < 0.7
+            yield {
+                "doctor_id": doctor_id,
+                "patient_id": rng.choice(patient_ids),
+                "date": start_at.strftime("%Y-%m-%d"),
+                "time": start_at.strftime("%H:%M"),
+                "duration": 60,
+                "start_at": start_at,
+                "end_at": start_at + timedelta(hours=1),
+                "status": rng.choices(["Scheduled", "Rescheduled", "Canceled"], [85, 10, 5])[0],
+                "notes": "",
+                "is_paid": paid,
+                "payment_date": start_at + timedelta(days=1) if paid else None,
+            }
+            produced += 1
+
+
+def _seed_messages(rng, patient_ids, receptionist_ids, count, now):
+    started = now - timedelta(days=365)
+    step = timedelta(days=365) / max(count, 1)
+    for i in range(count):
+        patient_id, receptionist_id = rng.choice(patient_ids), rng.choice(receptionist_ids)
+        sender, receiver = (patient_id, receptionist_id) if rng.random() < 0.5 else (receptionist_id, patient_id)
+        yield {"sender_id": sender, "receiver_id": receiver, "content": f"Message {i}", "timestamp": started + step * i}
+
+
+def bench_seed(args):
+    """Fill an empty database with a reproducible synthetic clinic."""
+    _use_database(args.database)
+    from app import (Appointment, DoctorAvailability, DoctorRate, Message, User, create_app, db,
+                     hash_password, init_database, rebuild_billing_rollups, rebuild_conversations)
+
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    app = create_app()
+    with app.app_context():
+        init_database()
+        if db.session.query(User.id).first():
+            raise SystemExit("The database already has users; seed an empty one.")
+        password = hash_password("pw")  # Every seeded user logs in with "pw"
+        users = [("doctor", args.doctors), ("patient", args.patients), ("receptionist", args.receptionists)]
+        _insert_batches(db, User, (
+            {"username": f"{role}-{i}", "password": password, "role": role,
+             "name": f"{role.title()} {i}", "email": f"{role}-{i}@example.com"}
+            for role, count in users for i in range(count)
+        ))
+        ids = {role: [user_id for user_id, in db.session.query(User.id).filter_by(role=role).order_by(User.id)]
+               for role, _ in users}
+
+        _insert_batches(db, DoctorAvailability, (
+            {"doctor_id": doctor_id, "day_of_week": day, "start_time": "08:00", "end_time": "17:00",
+             "start_minute": 8 * 60, "end_minute": 17 * 60, "is_available": True}
+            for doctor_id in ids["doctor"] for day in range(7)
+        ))
+        _insert_batches(db, DoctorRate, (
+            {"doctor_id": doctor_id, "rate_per_hour": rng.choice([80, 100, 120, 150, 200])}
+            for doctor_id in ids["doctor"]
+        ))
+        _insert_batches(db, Appointment, _seed_appointments(
+            rng, ids["doctor"], ids["patient"], args.appointments, date.today()))
+        _insert_batches(db, Message, _seed_messages(
+            rng, ids["patient"], ids["receptionist"], args.messages, datetime.utcnow()))
+
+        rebuild_billing_rollups()
+        rebuild_conversations()
+        db.session.commit()
+        dialect = db.engine.dialect.name
+
+    print(f"database:          {dialect}")
+    for label, count in [("doctors", args.doctors), ("patients", args.patients),
+                         ("receptionists", args.receptionists), ("appointments", args.appointments),
+                         ("messages", args.messages)]:
+        print(f"{label + ':':<19}{count}")
+    print(f"seeded in:         {time.perf_counter() - started:.1f}s")
+
+
+# Requests per role as (method, path, weight); POST bodies are built in _request_data
+HTTP_WORKLOAD = {
+    "patient": [("GET", "/dashboard", 2), ("GET", "/appointments", 4), ("GET", "/chat", 2),
+                ("POST", "/schedule_appointment", 1)],
+    "doctor": [("GET", "/dashboard", 1), ("GET", "/appointments", 4), ("GET", "/billing", 2)],
+    "receptionist": [("GET", "/appointments", 3), ("GET", "/billing", 2), ("GET", "/chat", 2),
+                     ("GET", "/chat/inbox", 2)],
+}
+HTTP_ROLE_MIX = {"patient": 6, "doctor": 3, "receptionist": 1}
+
+
+class _TestClientSession:
+    """One logged-in user driving app.py in-process, counting SQL statements per request."""
+
+    queries = threading.local()
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        self.queries.count = 0
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, self.queries.count
+
+
+class _ServerSession:
+    """One logged-in user driving a running server over HTTP; query counts are unknown."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                response.read()
+                return response.status, None
+        except urllib.error.HTTPError as error:
+            return error.code, None
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def _request_data(method, path, rng, doctor_ids):
+    if path == "/schedule_appointment":
+        day = date.today() + timedelta(days=rng.randrange(1, 60))
+        return {"doctor_id": rng.choice(doctor_ids), "date": day.isoformat(),
+                "time": f"{rng.choice(SEED_HOURS):02d}:00", "duration": 60}
+    return None
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(max(math.ceil(fraction * len(sorted_values)) - 1, 0), len(sorted_values) - 1)]
+
+
+def _http_worker(make_session, users, doctor_ids, deadline, seed, results, lock):
+    rng = random.Random(seed)
+    role = rng.choices(list(HTTP_ROLE_MIX), list(HTTP_ROLE_MIX.values()))[0]
+    session = make_session()
+    session.request("POST", "/login", {"username": rng.choice(users[role]), "password": "pw"})
+    routes = HTTP_WORKLOAD[role]
+    samples = []
+    while time.perf_counter() < deadline:
+        method, path, _ = rng.choices(routes, [weight for _, _, weight in routes])[0]
+        started = time.perf_counter()
+        status, queries = session.request(method, path, _request_data(method, path, rng, doctor_ids))
+        samples.append((f"{method} {path}", time.perf_counter() - started, queries, status >= 500))
+    with lock:
+        results.extend(samples)
+
+
+def _http_report(samples, elapsed):
+    """Per-route latency percentiles (ms), throughput and mean queries per request."""
+    by_route = defaultdict(list)
+    for route, seconds, queries, failed in samples:
+        by_route[route].append((seconds, queries, failed))
+    report = {}
+    for route, rows in sorted(by_route.items()):
+        latencies = sorted(seconds * 1000 for seconds, _, _ in rows)
+        queries = [q for _, q, _ in rows if q is not None]
+        report[route] = {
+            "requests": len(rows),
+            "throughput": len(rows) / elapsed,
+            "p50_ms": percentile(latencies, 0.50),
+            "p95_ms": percentile(latencies, 0.95),
+            "p99_ms": percentile(latencies, 0.99),
+            "queries_per_request": sum(queries) / len(queries) if queries else None,
+            "errors": sum(1 for _, _, failed in rows if failed),
+        }
+    return report
+
+
+def _queries(row):
+    return "-" if row["queries_per_request"] is None else f"{row['queries_per_request']:.1f}"
+
+
+def _compare_http(report, baseline, tolerance):
+    """Print regressions against a saved baseline; returns how many were found."""
+    regressions = 0
+    for route, current in report.items():
+        before = baseline.get(route)
+        if not before:
+            continue
+        slower = current["p95_ms"] > before["p95_ms"] * (1 + tolerance)
+        more_queries = (current["queries_per_request"] or 0) > (before["queries_per_request"] or 0) + 0.5
+        if slower or more_queries:
+            regressions += 1
+            print(f"REGRESSION {route}: p95 {before['p95_ms']:.1f} -> {current['p95_ms']:.1f} ms, "
+                  f"queries {_queries(before)} -> {_queries(current)}")
+    return regressions
+
+
+def bench_http(args):
+    """Mixed-role load against the routes, in-process via the test client or against --url."""
+    _use_database(args.database)
+    from app import User, create_app, db
+    from sqlalchemy import event
+
+    app = create_app()
+    with app.app_context():
+        users = {role: [name for name, in db.session.query(User.username).filter_by(role=role).limit(args.users)]
+                 for role in HTTP_WORKLOAD}
+        doctor_ids = [user_id for user_id, in db.session.query(User.id).filter_by(role="doctor")]
+        if not all(users.values()):
+            raise SystemExit("Seed the database first: python bench.py seed --database URL")
+        if args.url:
+            make_session = lambda: _ServerSession(args.url)
+        else:
+            @event.listens_for(db.engine, "before_cursor_execute")
+            def count_query(*_):
+                _TestClientSession.queries.count = getattr(_TestClientSession.queries, "count", 0) + 1
+            make_session = lambda: _TestClientSession(app)
+
+    results, lock = [], threading.Lock()
+    started = time.perf_counter()
+    deadline = started + args.seconds
+    with ThreadPoolExecutor(max_workers=args.concurrency) as workers:
+        for worker in range(args.concurrency):
+            workers.submit(_http_worker, make_session, users, doctor_ids, deadline, args.seed + worker, results, lock)
+    elapsed = time.perf_counter() - started
+
+    report = _http_report(results, elapsed)
+    print(f"{'route':<28}{'requests':>9}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'queries':>9}{'5xx':>6}")
+    for route, row in report.items():
+        print(f"{route:<28}{row['requests']:>9}{row['throughput']:>9.1f}{row['p50_ms']:>9.1f}"
+              f"{row['p95_ms']:>9.1f}{row['p99_ms']:>9.1f}{_queries(row):>9}{row['errors']:>6}")
+    print(f"total: {len(results)} requests in {elapsed:.1f}s ({len(results) / elapsed:.1f}/sec)")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = _compare_http(report, json.load(f), args.tolerance)
+        print(f"{regressions} regressions against {args.compare}")
+        if regressions:
+            raise SystemExit(1)
+
+
+# Runs in a fresh interpreter per measurement, so imports are really cold
+_STARTUP_PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+connections = []
+event.listen(Engine, "connect", lambda *args: connections.append(1))
+import app
+imported = time.perf_counter()
+application = app.create_app(sys.argv[1])
+created = time.perf_counter()
+opened = len(connections)
+status = application.test_client().get("/login").status_code
+served = time.perf_counter()
+print(json.dumps({
+    "import": imported - started, "create_app": created - imported, "first_request": served - created,
+    "connections": opened, "status": status, "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+
+def bench_startup(args):
+    """Cold start per profile: import, create_app and first request times, and connections opened before forking."""
+    database = args.database or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'startup.db')}"
+    env = dict(os.environ, DATABASE_URL=database)
+    env.setdefault("SECRET_KEY", "startup-benchmark")
+    env.setdefault("METRICS_TOKEN", "startup-benchmark")
+    _use_database(database)
+    from app import create_app, init_database
+    with create_app().app_context():
+        init_database()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    print(f"{'profile':<12} {'import':>9} {'create_app':>11} {'1st request':>12} {'connections':>12} {'max RSS':>9}")
+    leaked = False
+    for profile in args.profile:
+        runs = []
+        for _ in range(args.runs):
+            output = subprocess.run([sys.executable, "-c", _STARTUP_PROBE, profile], cwd=here, env=env,
+                                    capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        median = {key: statistics.median(run[key] for run in runs)
+                  for key in ("import", "create_app", "first_request", "max_rss_mb")}
+        connections = max(run["connections"] for run in runs)
+        leaked = leaked or connections > 0
+        print(f"{profile:<12} {median['import'] * 1000:>7.1f}ms {median['create_app'] * 1000:>9.1f}ms "
+              f"{median['first_request'] * 1000:>10.1f}ms {connections:>12} {median['max_rss_mb']:>7.1f}MB")
+    if leaked:
+        # A connection opened before a preforking server forks would be shared by every worker
+        print("create_app opened a database connection; it is not safe to preload before fork.")
+        raise SystemExit(1)
+
+
+AUDIT_MODES = {
+    "off": {"AUDIT_ENABLED": False},
+    "write-behind": {"AUDIT_ENABLED": True},
+    "synchronous": {"AUDIT_ENABLED": True, "AUDIT_FLUSH_SECONDS": 0},  # Insert on the request thread
+}
+AUDIT_OPERATIONS = ("book", "mark paid", "reschedule", "cancel")
+
+
+def _audit_cycle(client, doctor_id, patient_id, day):
+    """Book, pay, move and cancel one appointment as reception; returns seconds per operation."""
+    timings = []
+    started = time.perf_counter()
+    response = client.post("/api/v1/appointments", json={
+        "doctor_id": doctor_id, "patient_id": patient_id, "date": day.isoformat(), "time": "09:00"})
+    timings.append(time.perf_counter() - started)
+    appointment_id = response.get_json()["id"]
+    for method, path, body in (
+        ("POST", "/api/v1/appointments/mark_paid", {"json": {"ids": [appointment_id]}}),
+        ("POST", f"/reschedule_appointment/{appointment_id}", {"data": {"date": day.isoformat(), "time": "11:00"}}),
+        ("POST", "/api/v1/appointments/cancel", {"json": {"ids": [appointment_id]}}),
+    ):
+        started = time.perf_counter()
+        response = client.open(path, method=method, **body)
+        timings.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            raise SystemExit(f"{path} answered {response.status_code}")
+    return timings
+
+
+def bench_audit(args):
+    """Write latency with auditing off, written behind in batches, and inserted synchronously."""
+    database = args.database or f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'audit.db')}"
+    _use_database(database)
+    from app import AuditEvent, DoctorAvailability, User, audit_log, create_app, db, hash_password, init_database
+
+    results = {}
+    for mode, overrides in AUDIT_MODES.items():
+        app = create_app("production", SECRET_KEY="audit-benchmark", METRICS_TOKEN="audit-benchmark", **overrides)
+        with app.app_context():
+            init_database()
+            password = hash_password("pw")
+            doctor = User(username=f"audit-doctor-{mode}", password=password, role="doctor", name="Audit")
+            patient = User(username=f"audit-patient-{mode}", password=password, role="patient", name="Audit")
+            reception = User(username=f"audit-reception-{mode}", password=password, role="receptionist", name="Audit")
+            db.session.add_all([doctor, patient, reception])
+            db.session.flush()
+            db.session.add_all(DoctorAvailability(doctor_id=doctor.id, day_of_week=day, start_time="08:00",
+                                                  end_time="17:00", is_available=True) for day in range(7))
+            db.session.commit()
+            doctor_id, patient_id = doctor.id, patient.id
+            before = AuditEvent.query.count()
+
+        client = app.test_client()
+        client.post("/login", data={"username": f"audit-reception-{mode}", "password": "pw"})
+        first_day = date.today() + timedelta(days=1)
+        _audit_cycle(client, doctor_id, patient_id, first_day)  # Warm caches and the writer thread
+        samples = defaultdict(list)
+        started = time.perf_counter()
+        for cycle in range(1, args.cycles + 1):
+            for operation, seconds in zip(AUDIT_OPERATIONS, _audit_cycle(client, doctor_id, patient_id,
+                                                                         first_day + timedelta(days=cycle))):
+                samples[operation].append(seconds)
+        elapsed = time.perf_counter() - started
+        left_behind = audit_log.pending()
+        with app.app_context():
+            audit_log.flush()
+            written = AuditEvent.query.count() - before
+        expected = 0 if mode == "off" else 4 * (args.cycles + 1)
+        results[mode] = (samples, elapsed, left_behind, written, expected)
+
+    baseline = results["off"][1]
+    print(f"{'mode':<13} {'writes/sec':>10} {'overhead':>9} " +
+          " ".join(f"{operation + ' p95':>15}" for operation in AUDIT_OPERATIONS) + f" {'buffered':>9} {'events':>7}")
+    lost = False
+    for mode, (samples, elapsed, left_behind, written, expected) in results.items():
+        writes = sum(len(values) for values in samples.values())
+        p95s = " ".join(f"{percentile(sorted(samples[operation]), 0.95) * 1000:>13.2f}ms" for operation in AUDIT_OPERATIONS)
+        print(f"{mode:<13} {writes / elapsed:>10.1f} {(elapsed / baseline - 1) * 100:>8.1f}% {p95s} "
+              f"{left_behind:>9} {written:>7}")
+        lost = lost or written != expected
+    if lost:
+        print("Some audit events were not written.")
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    hashing = commands.add_parser("hashing", help="PBKDF2 login throughput")
+    hashing.add_argument("--rounds", type=int, default=29000)
+    hashing.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    hashing.add_argument("--seconds", type=float, default=3.0)
+    hashing.set_defaults(run=bench_hashing)
+
+    stress = commands.add_parser("stress-booking", help="concurrent booking race; fails on any double booking")
+    stress.add_argument("--processes", type=int, default=8)
+    stress.add_argument("--requests", type=int, default=200, help="booking attempts per process")
+    stress.add_argument("--database", help="SQLAlchemy URL (default: a fresh SQLite file)")
+    stress.add_argument("--warmup", type=float, default=5.0, help="seconds to let workers start")
+    stress.set_defaults(run=bench_stress_booking)
+
+    seed = commands.add_parser("seed", help="fill an empty database with synthetic data")
+    seed.add_argument("--database", help="SQLAlchemy URL (default: DATABASE_URL or hospital.db)")
+    seed.add_argument("--doctors", type=int, default=200)
+    seed.add_argument("--patients", type=int, default=5000)
+    seed.add_argument("--receptionists", type=int, default=10)
+    seed.add_argument("--appointments", type=int, default=200000)
+    seed.add_argument("--messages", type=int, default=100000)
+    seed.add_argument("--seed", type=int, default=42)
+    seed.set_defaults(run=bench_seed)
+
+    load = commands.add_parser("http", help="per-route latency under a mixed-role workload")
+    load.add_argument("--database", help="SQLAlchemy URL of a seeded database")
+    load.add_argument("--url", help="drive a running server instead of the in-process test client")
+    load.add_argument("--seconds", type=float, default=20.0)
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--users", type=int, default=50, help="distinct users per role to log in as")
+    load.add_argument("--seed", type=int, default=42)
+    load.add_argument("--save", help="write the per-route results to this JSON baseline")
+    load.add_argument("--compare", help="fail if p95 or queries/request regress against this baseline")
+    load.add_argument("--tolerance", type=float, default=0.2, help="allowed p95 slowdown (0.2 = 20%%)")
+    load.set_defaults(run=bench_http)
+
+    startup = commands.add_parser("startup", help="cold start time and memory per config profile")
+    startup.add_argument("--profile", action="append", help="config profile (repeatable; default development and production)")
+    startup.add_argument("--runs", type=int, default=5, help="fresh interpreters per profile")
+    startup.add_argument("--database", help="SQLAlchemy URL (default: a fresh SQLite file)")
+    startup.set_defaults(run=bench_startup)
+
+    audit = commands.add_parser("audit", help="write overhead of the audit log, off vs write-behind vs synchronous")
+    audit.add_argument("--cycles", type=int, default=300, help="book/pay/reschedule/cancel cycles per mode")
+    audit.add_argument("--database", help="SQLAlchemy URL (default: a fresh SQLite file)")
+    audit.set_defaults(run=bench_audit)
+
+    args = parser.parse_args()
+    if args.command == "startup" and not args.profile:
+        args.profile = ["development", "production"]
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
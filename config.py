@@ -0,0 +1,101 @@
+"""
+config.py
+
+Configuration profiles for create_app(), chosen by name or APP_PROFILE:
+- development: debug server with template reloading (the default)
+- production: no debug, templates compiled once at startup so preloading
+  servers share them across forked workers; requires SECRET_KEY, and
+  METRICS_TOKEN unless METRICS_ENABLED=0
+- testing: in-memory SQLite and cheap password hashing
+
+Settings read from the environment are read when this module is imported.
+"""
+
+import os
+
+DEFAULT_SECRET_KEY = "secret_key_for_session"  # Only good for development
+
+
+class Config:
+    SECRET_KEY = os.environ.get("SECRET_KEY", DEFAULT_SECRET_KEY)
+    HOST = os.environ.get("HOST", "127.0.0.1")
+    PORT = int(os.environ.get("PORT", 5002))
+    PRECOMPILE_TEMPLATES = False  # Compile every template in create_app instead of on first render
+
+    # The database: SQLite by default, or any SQLAlchemy URL (e.g. PostgreSQL) via DATABASE_URL
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///hospital.db").replace("postgres://", "postgresql://", 1)
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLITE_JOURNAL_MODE = "WAL"     # Readers no longer block the writer
+    SQLITE_BUSY_TIMEOUT_MS = 10000  # Wait for the write lock instead of "database is locked"
+    DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 10))
+    DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 20))
+    # Clinics with a database each, e.g. "north=sqlite:///north.db,south=sqlite:///south.db"; the
+    # first is where users without a clinic belong. When set, the database above holds the user
+    # directory (logins and which clinic each user belongs to) and no clinic data.
+    CLINIC_DATABASES = dict(entry.split("=", 1) for entry in os.environ.get("CLINIC_DATABASES", "").split(",") if entry)
+    CLINIC_FANOUT_WORKERS = int(os.environ.get("CLINIC_FANOUT_WORKERS", 8))  # Clinics queried at once by cross-clinic reports
+
+    IDENTITY_CACHE_SIZE = 4096     # Users kept across requests
+    IDENTITY_CACHE_TTL = 300       # Seconds before a cached user is re-read
+    REFERENCE_CACHE_TTL = 300      # Seconds before doctors, rates and availability are re-read
+    PASSWORD_HASH_ROUNDS = 29000   # PBKDF2 rounds; stored hashes are upgraded on login
+    PASSWORD_HASH_WORKERS = os.cpu_count() or 2
+    PASSWORD_HASH_MAX_PENDING = 4 * PASSWORD_HASH_WORKERS
+    LOGIN_ATTEMPTS_PER_IP = (30, 60)          # (attempts, seconds)
+    LOGIN_FAILURES_PER_ACCOUNT = (5, 300)     # (failures, seconds)
+    METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+    METRICS_SLOW_QUERY_MS = 250    # Log statements slower than this, with their parameters
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")  # If set, /metrics requires "Bearer <token>"
+    JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))  # Threads per worker process
+    JOB_POLL_SECONDS = 5           # Idle workers look for due jobs this often
+    JOB_LEASE_SECONDS = 300        # A job still running after this is retried elsewhere
+    JOB_RETENTION_DAYS = 7         # Done jobs are deleted by the archive job after this; failed ones stay
+    REMINDER_HOURS_BEFORE = 24     # Patients are reminded this long before their appointment
+    REMINDER_SWEEP_MINUTES = 10    # How often the reminder job looks for newly due reminders
+    REMINDER_BATCH_SIZE = 200
+    NOTIFY_SENDER = os.environ.get("NOTIFY_SENDER", "file")  # "file" (writes .eml) or "smtp"
+    NOTIFY_OUTBOX = os.environ.get("NOTIFY_OUTBOX", "outbox")
+    NOTIFY_FROM = os.environ.get("NOTIFY_FROM", "clinic@localhost")
+    SMTP_HOST = os.environ.get("SMTP_HOST", "localhost")
+    SMTP_PORT = int(os.environ.get("SMTP_PORT", 25))
+    SMTP_USERNAME = os.environ.get("SMTP_USERNAME")
+    SMTP_PASSWORD = os.environ.get("SMTP_PASSWORD")
+    ARCHIVE_CANCELED_AFTER_DAYS = 30        # Canceled appointments leave the hot table after this
+    ARCHIVE_APPOINTMENTS_AFTER_DAYS = 365   # ...and paid ones after this; unpaid ones stay
+    ARCHIVE_MESSAGES_AFTER_DAYS = 365
+    ARCHIVE_BATCH_SIZE = 1000
+    ARCHIVE_INTERVAL_HOURS = 24
+    CHAT_PRESENCE_TIMEOUT_SECONDS = 180  # A receptionist unseen this long is offline; their waiting chats move
+    CHAT_HEARTBEAT_SECONDS = 60          # Requests refresh a receptionist's presence at most this often
+    CHAT_REBALANCE_SECONDS = 60          # How often the rebalance job looks for receptionists who went away
+    AUDIT_ENABLED = os.environ.get("AUDIT_ENABLED", "1") != "0"  # Appointment and rate history in audit_events
+    AUDIT_FLUSH_SECONDS = 1.0    # Buffered audit events are written at least this often; 0 writes them on commit
+    AUDIT_BATCH_SIZE = 500
+    AUDIT_MAX_PENDING = 50000    # Beyond this, committing requests write a batch themselves
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+
+
+class ProductionConfig(Config):
+    DEBUG = False
+    PRECOMPILE_TEMPLATES = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    CLINIC_DATABASES = {}
+    PASSWORD_HASH_ROUNDS = 1000
+    PASSWORD_HASH_WORKERS = 2
+    PASSWORD_HASH_MAX_PENDING = 8
+    JOB_WORKERS = 0
+    AUDIT_FLUSH_SECONDS = 0
+
+
+PROFILES = {
+    "development": DevelopmentConfig,
+    "production": ProductionConfig,
+    "testing": TestingConfig,
+}
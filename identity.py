@@ -0,0 +1,72 @@
+"""
+identity.py
+
+Cross-request cache of user records for get_current_user:
+- bounded LRU with a time-to-live per entry
+- per-user version counters, bumped whenever a user row changes, so an
+  entry filled before the change is never served after it
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdentityCache:
+    """
+    LRU of user snapshots keyed by id.
+
+    Callers read `version(user_id)` *before* loading a user from the
+    database and pass it to `put`; an invalidation that lands in between
+    bumps the version, so the stale snapshot is rejected on the next `get`.
+    The TTL bounds staleness for changes made by other processes.
+    """
+
+    def __init__(self, max_size=1024, ttl=300, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, user_id):
+        with self._lock:
+            return self._versions.get(user_id, 0)
+
+    def get(self, user_id):
+        """Cached snapshot for `user_id`, or None if missing, expired or outdated."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                value, version, expires_at = entry
+                if version == self._versions.get(user_id, 0) and expires_at > self._clock():
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return value
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def put(self, user_id, value, version):
+        with self._lock:
+            if version != self._versions.get(user_id, 0):
+                return
+            self._entries[user_id] = (value, version, self._clock() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Bump the user's version and drop any cached snapshot."""
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            for user_id in self._entries:
+                self._versions[user_id] = self._versions.get(user_id, 0) + 1
+            self._entries.clear()
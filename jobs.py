@@ -0,0 +1,253 @@
+"""
+jobs.py
+
+Background work persisted in the database, so request handlers only enqueue:
+- JobQueue: enqueue/claim/run over a jobs table, with scheduled run times,
+  leases (a crashed worker's jobs are picked up again) and exponential
+  backoff between attempts
+- WorkerPool: threads that claim small batches and run registered handlers
+- FileSender / SmtpSender: pluggable delivery for outgoing notifications
+
+Claiming is a single UPDATE ... WHERE id IN (SELECT ... LIMIT n), so any
+number of worker threads and processes can share one table; server
+databases add FOR UPDATE SKIP LOCKED so claimers never wait on each other.
+"""
+
+import json
+import logging
+import os
+import smtplib
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """
+    Jobs stored through a Flask-SQLAlchemy `db` and a `model` with the
+    columns of app.Job. Handlers are registered per kind and called with the
+    job's payload as keyword arguments, inside the job's transaction: their
+    writes commit together with the job being marked done, and roll back if
+    they raise. Delivery is at-least-once, so handlers must be idempotent.
+    """
+
+    def __init__(self, db, model, lease_seconds=300, backoff_seconds=30, max_backoff_seconds=3600,
+                 observe=None, clock=datetime.utcnow):
+        self.db = db
+        self.model = model
+        self.lease = timedelta(seconds=lease_seconds)
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.observe = observe  # observe(kind, outcome, seconds) after every run
+        self._clock = clock
+        self.handlers = {}
+
+    def handler(self, kind):
+        """Decorator registering the function that runs jobs of `kind`."""
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def enqueue(self, kind, payload=None, delay=0, run_at=None, max_attempts=5, dedupe_key=None):
+        """
+        Add a job to the caller's transaction; it becomes visible to workers
+        when the caller commits. With `dedupe_key`, nothing is added while a
+        job with that key is still waiting (a running one does not count, so
+        work requested mid-run is not lost). Returns the job, or None.
+        """
+        model, session = self.model, self.db.session
+        if dedupe_key is not None and session.query(model.id).filter(
+            model.dedupe_key == dedupe_key, model.status == QUEUED
+        ).first():
+            return None
+        job = model(
+            kind=kind,
+            payload=json.dumps(payload or {}),
+            status=QUEUED,
+            run_at=run_at or self._clock() + timedelta(seconds=delay),
+            attempts=0,
+            max_attempts=max_attempts,
+            dedupe_key=dedupe_key,
+        )
+        session.add(job)
+        return job
+
+    def claim(self, worker, limit=10):
+        """
+        Lease up to `limit` due jobs to `worker` and commit. A running job
+        whose lease has expired counts as due, so its worker is presumed dead.
+        """
+        model, session = self.model, self.db.session
+        now = self._clock()
+        token = f"{worker}:{uuid.uuid4().hex[:12]}"
+        due = and_(model.status.in_((QUEUED, RUNNING)), model.run_at <= now)
+
+        candidates = self.db.select(model.id).where(due).order_by(model.run_at).limit(limit)
+        if session.get_bind(model).dialect.name != "sqlite":
+            candidates = candidates.with_for_update(skip_locked=True)
+        session.query(model).filter(model.id.in_(candidates.scalar_subquery()), due).update({
+            model.status: RUNNING,
+            model.locked_by: token,
+            model.run_at: now + self.lease,  # While running, run_at is the lease expiry
+            model.attempts: model.attempts + 1,
+        }, synchronize_session=False)
+        session.commit()
+        return session.query(model).filter(model.locked_by == token).order_by(model.run_at).all()
+
+    def run(self, job):
+        """Run one claimed job and record the outcome: done, retry later, or failed."""
+        session = self.db.session
+        kind, started = job.kind, time.perf_counter()
+        func = self.handlers.get(kind)
+        try:
+            if func is None:
+                raise LookupError(f"No handler for job kind {kind!r}")
+            if job.attempts > job.max_attempts:
+                raise RuntimeError("Lease expired on every attempt")
+            func(**json.loads(job.payload or "{}"))
+            job.status = DONE
+            job.finished_at = self._clock()
+            job.locked_by = None
+            session.commit()
+            outcome = DONE
+        except Exception as exc:
+            session.rollback()
+            outcome = self._record_failure(job, exc, permanent=func is None)
+        if self.observe:
+            self.observe(kind, outcome, time.perf_counter() - started)
+        return outcome
+
+    def _record_failure(self, job, exc, permanent=False):
+        logger.warning("Job %s (%s) attempt %s failed: %r", job.id, job.kind, job.attempts, exc)
+        job.last_error = f"{type(exc).__name__}: {exc}"[:1000]
+        job.locked_by = None
+        if permanent or job.attempts >= job.max_attempts:
+            job.status = FAILED
+            job.finished_at = self._clock()
+        else:
+            delay = min(self.backoff_seconds * 2 ** (job.attempts - 1), self.max_backoff_seconds)
+            job.status = QUEUED
+            job.run_at = self._clock() + timedelta(seconds=delay)
+        self.db.session.commit()
+        return job.status if job.status == FAILED else "retry"
+
+    def purge(self, finished_before, limit=1000):
+        """
+        Delete up to `limit` done jobs that finished before `finished_before`
+        and commit; returns how many. Failed jobs are kept for inspection.
+        """
+        model, session = self.model, self.db.session
+        ids = self.db.select(model.id).where(
+            model.status == DONE, model.finished_at < finished_before).limit(limit)
+        deleted = session.query(model).filter(model.id.in_(ids.scalar_subquery())).delete(
+            synchronize_session=False)
+        session.commit()
+        return deleted
+
+    def run_pending(self, worker="inline", limit=100):
+        """Claim and run due jobs in the calling thread until none are left or `limit` ran."""
+        ran = 0
+        while ran < limit:
+            jobs = self.claim(worker, min(10, limit - ran))
+            if not jobs:
+                break
+            for job in jobs:
+                self.run(job)
+            ran += len(jobs)
+        return ran
+
+
+class WorkerPool:
+    """
+    `threads` daemon threads, each claiming up to `batch_size` jobs at a
+    time inside an app context and sleeping `poll_seconds` when idle.
+    `context()`, if given, makes that context instead of app.app_context().
+    """
+
+    def __init__(self, app, queue, threads=2, batch_size=10, poll_seconds=5, context=None):
+        self.app = app
+        self.context = context or app.app_context
+        self.queue = queue
+        self.threads = threads
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        name = f"{socket.gethostname()}:{os.getpid()}"
+        for number in range(self.threads):
+            thread = threading.Thread(target=self._loop, args=(f"{name}:{number}",),
+                                      name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Ask the threads to exit after their current job and wait for them."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _loop(self, worker):
+        while not self._stop.is_set():
+            ran = 0
+            try:
+                with self.context():
+                    for job in self.queue.claim(worker, self.batch_size):
+                        self.queue.run(job)
+                        ran += 1
+            except Exception:
+                # e.g. the database is unreachable; jobs stay leased and are retried later
+                logger.exception("Job worker %s failed to claim jobs", worker)
+            if not ran:
+                self._stop.wait(self.poll_seconds)
+
+
+class FileSender:
+    """Writes each message to `directory` as an .eml file; a stand-in for SMTP in development."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def send(self, messages):
+        os.makedirs(self.directory, exist_ok=True)
+        for message in messages:
+            name = f"{datetime.utcnow():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.eml"
+            with open(os.path.join(self.directory, name), "wb") as handle:
+                handle.write(message.as_bytes())
+
+
+class SmtpSender:
+    """Sends a batch of messages over one SMTP connection."""
+
+    def __init__(self, host="localhost", port=25, username=None, password=None, starttls=False, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+
+    def send(self, messages):
+        if not messages:
+            return
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            for message in messages:
+                smtp.send_message(message)
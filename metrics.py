@@ -0,0 +1,200 @@
+"""
+metrics.py
+
+In-process request instrumentation with a Prometheus text exposition:
+- Histogram/Counter: labelled, thread-safe, fixed-bucket metrics
+- Metrics: a registry plus hooks for Flask requests and templates and
+  SQLAlchemy cursor execution (per-request query count and time, slow-query log)
+
+Observations are a dict lookup, a bisect and a few additions under a lock,
+so the hooks are cheap enough to leave on in production.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+class Counter:
+    """Monotonic totals per label set."""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield f"{self.name}{_label_text(labels)} {value}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, as Prometheus expects."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[position] += 1
+            series[-1] += value
+
+    def samples(self):
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket{_label_text(labels + (('le', bound),))} {cumulative}"
+            yield f"{self.name}_sum{_label_text(labels)} {series[-1]}"
+            yield f"{self.name}_count{_label_text(labels)} {cumulative}"
+
+
+class Metrics:
+    """
+    Registry of counters and histograms plus the Flask and SQLAlchemy hooks
+    that feed them. Nothing is hooked until `instrument_app` and
+    `instrument_engine` are called, so a disabled configuration costs nothing.
+    """
+
+    def __init__(self, slow_query_seconds=None, logger=None):
+        self.slow_query_seconds = slow_query_seconds
+        self.logger = logger
+        self._metrics = {}
+        self.requests = self.counter("http_requests_total", "Requests by route, method and status")
+        self.request_seconds = self.histogram("http_request_duration_seconds", "Request latency by route")
+        self.request_queries = self.histogram("http_request_queries", "SQL statements per request", COUNT_BUCKETS)
+        self.request_sql_seconds = self.histogram("http_request_sql_seconds", "SQL time per request")
+        self.template_seconds = self.histogram("template_render_seconds", "Template render time")
+        self.query_seconds = self.histogram("sql_query_duration_seconds", "SQL statement latency")
+        self.slow_queries = self.counter("sql_slow_queries_total", "Statements slower than the slow-query threshold")
+
+    def counter(self, name, help_text):
+        if name not in self._metrics:
+            self._metrics[name] = Counter(name, help_text)
+        return self._metrics[name]
+
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, help_text, buckets)
+        return self._metrics[name]
+
+    @contextmanager
+    def timer(self, histogram, **labels):
+        """Observe the duration of the `with` block in `histogram`."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    # -- Flask ---------------------------------------------------------------
+
+    def instrument_app(self, app):
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+
+    def _start_request(self):
+        g.metrics_started = time.perf_counter()
+        g.sql_queries = 0
+        g.sql_seconds = 0.0
+
+    def _finish_request(self, response):
+        started = g.pop("metrics_started", None)
+        if started is None:
+            return response
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        elapsed = time.perf_counter() - started
+        self.requests.inc(route=route, method=request.method, status=response.status_code)
+        self.request_seconds.observe(elapsed, route=route, method=request.method)
+        self.request_queries.observe(g.sql_queries, route=route)
+        self.request_sql_seconds.observe(g.sql_seconds, route=route)
+        response.headers["Server-Timing"] = (
+            f'app;dur={elapsed * 1000:.1f}, sql;dur={g.sql_seconds * 1000:.1f};desc="{g.sql_queries} queries"'
+        )
+        return response
+
+    def _start_template(self, app, template, context, **extra):
+        g.setdefault("template_started", {})[id(template)] = time.perf_counter()
+
+    def _finish_template(self, app, template, context, **extra):
+        started = g.get("template_started", {}).pop(id(template), None)
+        if started is not None:
+            self.template_seconds.observe(time.perf_counter() - started, template=template.name)
+
+    # -- SQLAlchemy ----------------------------------------------------------
+
+    def instrument_engine(self, engine):
+        """Hook cursor execution on an Engine (or the Engine class, for every engine)."""
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+        event.listen(engine, "handle_error", self._failed_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    def _failed_execute(self, context):
+        started = context.connection.info.get("metrics_started") if context.connection else None
+        if started:
+            started.pop()
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("metrics_started")
+        if not started:
+            return
+        elapsed = time.perf_counter() - started.pop()
+        self.query_seconds.observe(elapsed)
+        if has_request_context() and "sql_queries" in g:
+            g.sql_queries += 1
+            g.sql_seconds += elapsed
+        if self.slow_query_seconds is not None and elapsed >= self.slow_query_seconds:
+            self.slow_queries.inc()
+            if self.logger:
+                self.logger.warning("Slow query (%.1f ms): %s %.500r", elapsed * 1000, statement, parameters)
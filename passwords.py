@@ -0,0 +1,117 @@
+"""
+passwords.py
+
+Password hashing kept off the request threads' critical path:
+- PasswordHasher: PBKDF2 on a dedicated, size-limited thread pool with a
+  queue-depth limit, so a login burst is rejected early instead of
+  starving every worker
+- AttemptThrottle: sliding-window attempt counters per account or client IP
+"""
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+from passlib.hash import pbkdf2_sha256
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing pool is saturated; callers should answer 503."""
+
+
+class PasswordHasher:
+    """
+    PBKDF2-SHA256 with configurable rounds.
+
+    At most `workers` hashes run at once (hashlib releases the GIL, so they
+    run in parallel) and at most `max_pending` may be queued or running.
+    Beyond that, or when a result takes longer than `timeout` seconds,
+    HashingBusy is raised straight away.
+    """
+
+    def __init__(self, rounds=None, workers=2, max_pending=8, timeout=10.0):
+        self.scheme = pbkdf2_sha256.using(rounds=rounds) if rounds else pbkdf2_sha256
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pbkdf2")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(self.timeout)
+        except FutureTimeout:
+            raise HashingBusy()
+
+    def hash(self, password):
+        return self._run(self.scheme.hash, password)
+
+    def verify(self, password, hashed):
+        return self._run(self.scheme.verify, password, hashed)
+
+    def verify_and_update(self, password, hashed):
+        """
+        (matches, new_hash). new_hash is set when the password matched but the
+        stored hash uses different rounds than configured, so callers can
+        persist it and transparently migrate to the new cost.
+        """
+        def check():
+            if not self.scheme.verify(password, hashed):
+                return False, None
+            if self.scheme.needs_update(hashed):
+                return True, self.scheme.hash(password)
+            return True, None
+        return self._run(check)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+class AttemptThrottle:
+    """At most `limit` recorded attempts per key within a sliding `window` (seconds)."""
+
+    def __init__(self, limit, window, max_keys=100000, clock=time.monotonic):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._clock = clock
+        self._attempts = {}
+        self._lock = threading.Lock()
+
+    def _prune(self, attempts, now):
+        while attempts and attempts[0] <= now - self.window:
+            attempts.popleft()
+
+    def retry_after(self, key):
+        """Seconds until `key` may try again, or 0 if it is not throttled."""
+        now = self._clock()
+        with self._lock:
+            attempts = self._attempts.get(key)
+            if not attempts:
+                return 0
+            self._prune(attempts, now)
+            if len(attempts) < self.limit:
+                return 0
+            return max(int(attempts[0] + self.window - now) + 1, 1)
+
+    def record(self, key):
+        now = self._clock()
+        with self._lock:
+            if len(self._attempts) >= self.max_keys:
+                # Drop keys whose attempts have all aged out before growing further
+                for stale in [k for k, v in self._attempts.items() if not v or v[-1] <= now - self.window]:
+                    del self._attempts[stale]
+            attempts = self._attempts.setdefault(key, deque())
+            self._prune(attempts, now)
+            attempts.append(now)
+
+    def reset(self, key):
+        with self._lock:
+            self._attempts.pop(key, None)
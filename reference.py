@@ -0,0 +1,107 @@
+"""
+reference.py
+
+Process-wide cache for slow-changing reference data (doctor list, patient
+directory, availability tables, rates):
+- datasets are registered with a loader and filled per key on first use
+- writers invalidate after their transaction commits, so readers never
+  re-cache a row that is about to change; a TTL bounds staleness for
+  writes made by other processes
+- every load or invalidation bumps the entry's version and last-modified
+  time, which double as HTTP validators for pages built from the data
+- an optional scope (e.g. the current clinic) keeps a separate copy of
+  every dataset per scope value
+"""
+
+import hashlib
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+CURRENT_SCOPE = object()  # invalidate() default: whatever scope() returns now
+
+
+class ReferenceCache:
+    """
+    Named datasets keyed by an optional key (e.g. a doctor id).
+
+    `register(name, loader)` supplies `loader(key)`; `get(name, key)` returns
+    the cached value, loading it when missing or expired. Validators include
+    a per-process token (renewed in forked children), so a client
+    revalidating against another worker simply gets a full response.
+    With `scope`, entries are kept per `scope()` value, read when each
+    method is called.
+    """
+
+    def __init__(self, ttl=300, clock=time.monotonic, scope=None):
+        self.ttl = ttl
+        self._clock = clock
+        self.scope = scope or (lambda: None)
+        self._loaders = {}
+        self._entries = {}    # (scope, name, key) -> (value, version, expires_at)
+        self._versions = {}   # (scope, name, key) -> (version, last_modified)
+        self._generations = {}  # (scope, name) -> count of whole-dataset invalidations
+        self._lock = threading.Lock()
+        self._instance = os.urandom(4).hex()
+        self._started = datetime.now(timezone.utc).replace(microsecond=0)
+        if hasattr(os, "register_at_fork"):
+            # Forked workers load and invalidate independently, so they need their own token
+            os.register_at_fork(after_in_child=self._new_instance)
+
+    def _new_instance(self):
+        self._instance = os.urandom(4).hex()
+
+    def register(self, name, loader):
+        self._loaders[name] = loader
+
+    def _bump(self, entry_key):
+        version, _ = self._versions.get(entry_key, (0, None))
+        self._versions[entry_key] = (version + 1, datetime.now(timezone.utc).replace(microsecond=0))
+        return version + 1
+
+    def get(self, name, key=None):
+        scope = self.scope()
+        entry_key = (scope, name, key)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None and entry[2] > self._clock():
+                return entry[0]
+            seen = (self._generations.get((scope, name), 0), self._versions.get(entry_key, (0, None))[0])
+
+        value = self._loaders[name](key)
+
+        with self._lock:
+            # An invalidation while loading changed the version; serve the value but do not keep it
+            if (self._generations.get((scope, name), 0), self._versions.get(entry_key, (0, None))[0]) == seen:
+                self._entries[entry_key] = (value, self._bump(entry_key), self._clock() + self.ttl)
+        return value
+
+    def version(self, name, key=None):
+        with self._lock:
+            return self._versions.get((self.scope(), name, key), (0, None))[0]
+
+    def last_modified(self, name, key=None):
+        """When the entry was last loaded or invalidated in this process (UTC, whole seconds)."""
+        with self._lock:
+            return self._versions.get((self.scope(), name, key), (0, None))[1] or self._started
+
+    def invalidate(self, name, key=None, scope=CURRENT_SCOPE):
+        """Drop one entry, or every key of the dataset when `key` is None, in the current or given scope."""
+        scope = self.scope() if scope is CURRENT_SCOPE else scope
+        with self._lock:
+            if key is None:
+                self._generations[(scope, name)] = self._generations.get((scope, name), 0) + 1
+                stale = {entry_key for entry_key in self._versions if entry_key[:2] == (scope, name)}
+            else:
+                stale = {(scope, name, key)}
+            for entry_key in stale:
+                self._entries.pop(entry_key, None)
+                self._bump(entry_key)
+
+    def etag(self, datasets, *extra):
+        """Strong validator for a response built from (name, key) `datasets` plus `extra` values."""
+        parts = [self._instance, str(self.scope())]
+        parts += [f"{name}:{key}:{self.version(name, key)}" for name, key in datasets]
+        parts += [str(value) for value in extra]
+        return hashlib.sha1("|".join(parts).encode()).hexdigest()
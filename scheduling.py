@@ -0,0 +1,357 @@
+"""
+scheduling.py
+
+In-memory scheduling structures used by app.py:
+- DoctorSchedule: sorted appointment intervals for one doctor, searched with bisect
+- AppointmentIndex: lazily loaded per-doctor schedules used for conflict detection
+- AvailabilityCalendar: per-doctor weekly availability compiled to bitsets
+- expand_recurrence: occurrence dates for RRULE-style recurrence rules
+
+Times are expressed as integer minutes since the Unix epoch (naive local time),
+so an appointment is the half-open interval [start, start + duration).
+"""
+
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+EPOCH = datetime(1970, 1, 1)
+
+# Availability is tracked in fixed 5-minute slots, 288 per day and 2016 per week
+SLOT_MINUTES = 5
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+SLOTS_PER_WEEK = 7 * SLOTS_PER_DAY
+MINUTES_PER_WEEK = 7 * 24 * 60
+
+WEEKDAY_CODES = ["MO", "TU", "WE", "TH", "FR", "SA", "SU"]
+MAX_OCCURRENCES = 104  # Two years of weekly visits
+
+
+def to_minutes(value):
+    """Convert a naive datetime to minutes since the epoch."""
+    return (value - EPOCH) // timedelta(minutes=1)
+
+
+def from_minutes(minutes):
+    """Convert minutes since the epoch back to a naive datetime."""
+    return EPOCH + timedelta(minutes=minutes)
+
+
+def parse_minutes(date, time):
+    """Parse the "%Y-%m-%d" / "%H:%M" strings stored on appointments."""
+    return to_minutes(datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M"))
+
+
+def parse_clock(value):
+    """Parse an "%H:%M" string into minutes after midnight (ints pass through)."""
+    if isinstance(value, int):
+        return value
+    hours, minutes = value.split(":")[:2]
+    return int(hours) * 60 + int(minutes)
+
+
+def week_start(day):
+    """Monday of the week containing `day`."""
+    return day - timedelta(days=day.weekday())
+
+
+def span_mask(first_slot, last_slot):
+    """Bitmask with bits [first_slot, last_slot) set."""
+    if last_slot <= first_slot:
+        return 0
+    return ((1 << (last_slot - first_slot)) - 1) << first_slot
+
+
+def window_mask(weekday, start, end):
+    """Slots of `weekday` lying entirely inside the [start, end) minutes window."""
+    first = -(-start // SLOT_MINUTES)
+    last = min(end, 24 * 60) // SLOT_MINUTES
+    offset = weekday * SLOTS_PER_DAY
+    return span_mask(offset + first, offset + last)
+
+
+class DoctorSchedule:
+    """
+    Appointment intervals for a single doctor, kept sorted by start.
+
+    Overlap queries bisect the start array for the last interval that begins
+    before the query ends, then walk backwards only while the running maximum
+    of end times can still reach the query start. With non-overlapping
+    bookings this touches at most one interval, so queries are O(log n).
+    """
+
+    __slots__ = ("_starts", "_ends", "_ids", "_start_by_id", "_max_ends")
+
+    def __init__(self, intervals=()):
+        ordered = sorted((start, end, appointment_id) for appointment_id, start, end in intervals)
+        self._starts = [start for start, _, _ in ordered]
+        self._ends = [end for _, end, _ in ordered]
+        self._ids = [appointment_id for _, _, appointment_id in ordered]
+        self._start_by_id = {appointment_id: start for start, _, appointment_id in ordered}
+        self._max_ends = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _position(self, appointment_id):
+        start = self._start_by_id.get(appointment_id)
+        if start is None:
+            return None
+        i = bisect_left(self._starts, start)
+        while i < len(self._ids) and self._starts[i] == start:
+            if self._ids[i] == appointment_id:
+                return i
+            i += 1
+        return None
+
+    def add(self, appointment_id, start, end):
+        """Insert (or move) an appointment interval."""
+        self.remove(appointment_id)
+        i = bisect_right(self._starts, start)
+        self._starts.insert(i, start)
+        self._ends.insert(i, end)
+        self._ids.insert(i, appointment_id)
+        self._start_by_id[appointment_id] = start
+        self._max_ends = None
+
+    def remove(self, appointment_id):
+        """Drop an appointment interval; returns False if it was not indexed."""
+        i = self._position(appointment_id)
+        if i is None:
+            return False
+        del self._starts[i], self._ends[i], self._ids[i]
+        del self._start_by_id[appointment_id]
+        self._max_ends = None
+        return True
+
+    def _running_max_ends(self):
+        # Rebuilt lazily after a mutation; queries between writes reuse it.
+        if self._max_ends is None:
+            running, max_ends = None, []
+            for end in self._ends:
+                running = end if running is None or end > running else running
+                max_ends.append(running)
+            self._max_ends = max_ends
+        return self._max_ends
+
+    def overlapping(self, start, end, exclude_id=None):
+        """Yield (appointment_id, start, end) for intervals overlapping [start, end)."""
+        max_ends = self._running_max_ends()
+        i = bisect_left(self._starts, end) - 1
+        while i >= 0 and max_ends[i] > start:
+            if self._ends[i] > start and self._ids[i] != exclude_id:
+                yield self._ids[i], self._starts[i], self._ends[i]
+            i -= 1
+
+    def find_overlap(self, start, end, exclude_id=None):
+        """Return the id of any appointment overlapping [start, end), or None."""
+        for appointment_id, _, _ in self.overlapping(start, end, exclude_id):
+            return appointment_id
+        return None
+
+
+class AppointmentIndex:
+    """
+    Per-doctor DoctorSchedule cache.
+
+    A doctor's schedule is loaded on first use via `loader(doctor_id)`, which
+    must return (appointment_id, start, end) tuples for active appointments.
+    Routes call add/remove after committing so the index tracks the database;
+    `invalidate` forces a reload for changes made outside those paths.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._schedules = {}
+        self._lock = threading.RLock()
+
+    def _schedule(self, doctor_id):
+        schedule = self._schedules.get(doctor_id)
+        if schedule is None:
+            schedule = DoctorSchedule(self._loader(doctor_id))
+            self._schedules[doctor_id] = schedule
+        return schedule
+
+    def find_conflict(self, doctor_id, start, end, exclude_id=None):
+        """Return the id of an appointment clashing with [start, end), or None."""
+        with self._lock:
+            return self._schedule(int(doctor_id)).find_overlap(start, end, exclude_id)
+
+    def overlapping(self, doctor_id, start, end):
+        """Return (appointment_id, start, end) tuples overlapping [start, end)."""
+        with self._lock:
+            return list(self._schedule(int(doctor_id)).overlapping(start, end))
+
+    def add(self, doctor_id, appointment_id, start, end):
+        with self._lock:
+            # Unloaded doctors will pick the committed row up on first load.
+            schedule = self._schedules.get(int(doctor_id))
+            if schedule is not None:
+                schedule.add(appointment_id, start, end)
+
+    def remove(self, doctor_id, appointment_id):
+        with self._lock:
+            schedule = self._schedules.get(int(doctor_id))
+            if schedule is not None:
+                schedule.remove(appointment_id)
+
+    def invalidate(self, doctor_id=None):
+        """Forget one doctor's schedule, or every schedule when doctor_id is None."""
+        with self._lock:
+            if doctor_id is None:
+                self._schedules.clear()
+            else:
+                self._schedules.pop(int(doctor_id), None)
+
+
+class CompiledAvailability:
+    """
+    One doctor's availability compiled to week bitsets.
+
+    `weekly` holds the recurring windows for a generic week (bit i is slot
+    i % SLOTS_PER_DAY of weekday i // SLOTS_PER_DAY). Dated exceptions are kept
+    per week and folded in when that week's mask is first requested: extra
+    openings are OR-ed in, then closures are cleared, so closures always win.
+    """
+
+    __slots__ = ("weekly", "_exceptions", "_weeks")
+
+    def __init__(self, windows, exceptions):
+        self.weekly = 0
+        for weekday, start, end in windows:
+            self.weekly |= window_mask(int(weekday), parse_clock(start), parse_clock(end))
+
+        self._exceptions = {}
+        for day, start, end, is_available in exceptions:
+            if isinstance(day, str):
+                day = datetime.strptime(day, "%Y-%m-%d").date()
+            if start and end:
+                mask = window_mask(day.weekday(), parse_clock(start), parse_clock(end))
+            else:
+                mask = window_mask(day.weekday(), 0, 24 * 60)
+            masks = self._exceptions.setdefault(week_start(day), [0, 0])
+            if is_available:
+                masks[0] |= mask
+            else:
+                masks[1] |= mask
+        self._weeks = {}
+
+    def week(self, monday):
+        """Availability bitset for the week starting on `monday`."""
+        mask = self._weeks.get(monday)
+        if mask is None:
+            openings, closures = self._exceptions.get(monday, (0, 0))
+            mask = (self.weekly | openings) & ~closures
+            self._weeks[monday] = mask
+        return mask
+
+
+class AvailabilityCalendar:
+    """
+    Per-doctor CompiledAvailability cache.
+
+    `loader(doctor_id)` returns (windows, exceptions) where windows are
+    (weekday, "HH:MM", "HH:MM") tuples and exceptions are
+    (date, start or None, end or None, is_available) tuples. The strings are
+    parsed once at compile time; checks afterwards are pure bitmask ANDs.
+    Call `invalidate` whenever a doctor's availability rows change.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._compiled = {}
+        self._lock = threading.RLock()
+
+    def compiled(self, doctor_id):
+        doctor_id = int(doctor_id)
+        with self._lock:
+            compiled = self._compiled.get(doctor_id)
+            if compiled is None:
+                windows, exceptions = self._loader(doctor_id)
+                compiled = CompiledAvailability(windows, exceptions)
+                self._compiled[doctor_id] = compiled
+            return compiled
+
+    def week_mask(self, doctor_id, day):
+        """Bitset for the week containing `day` (a date)."""
+        compiled = self.compiled(doctor_id)
+        with self._lock:
+            return compiled.week(week_start(day))
+
+    def works_on(self, doctor_id, day):
+        """True if the doctor has any available slot on `day`."""
+        offset = day.weekday() * SLOTS_PER_DAY
+        return bool(self.week_mask(doctor_id, day) & span_mask(offset, offset + SLOTS_PER_DAY))
+
+    def is_available(self, doctor_id, start, end):
+        """True if every slot touched by [start, end) epoch minutes is available."""
+        while start < end:
+            day = from_minutes(start).date()
+            monday = week_start(day)
+            week_offset = to_minutes(datetime.combine(monday, datetime.min.time()))
+            week_end = min(end, week_offset + MINUTES_PER_WEEK)
+            first = (start - week_offset) // SLOT_MINUTES
+            last = -(-(week_end - week_offset) // SLOT_MINUTES)
+            required = span_mask(first, last)
+            if self.week_mask(doctor_id, day) & required != required:
+                return False
+            start = week_end
+        return True
+
+    def invalidate(self, doctor_id=None):
+        """Forget one doctor's compiled calendar, or every calendar when doctor_id is None."""
+        with self._lock:
+            if doctor_id is None:
+                self._compiled.clear()
+            else:
+                self._compiled.pop(int(doctor_id), None)
+
+
+def expand_recurrence(rule, first_day, max_occurrences=MAX_OCCURRENCES):
+    """
+    Occurrence dates for an RRULE-style rule starting on `first_day`, e.g.
+    "FREQ=WEEKLY;BYDAY=TU;COUNT=12" or "FREQ=DAILY;INTERVAL=2;UNTIL=20250131".
+    Supports FREQ (DAILY, WEEKLY), INTERVAL, COUNT, UNTIL and BYDAY (weekly
+    only). Either COUNT or UNTIL is required. Raises ValueError on bad rules.
+    """
+    parts = {}
+    for part in rule.upper().replace("RRULE:", "").split(";"):
+        if part.strip():
+            key, _, value = part.partition("=")
+            parts[key.strip()] = value.strip()
+
+    freq = parts.get("FREQ")
+    if freq not in ("DAILY", "WEEKLY"):
+        raise ValueError("FREQ must be DAILY or WEEKLY")
+    interval = int(parts.get("INTERVAL", 1))
+    count = int(parts["COUNT"]) if "COUNT" in parts else None
+    until = None
+    if "UNTIL" in parts:
+        until = datetime.strptime(parts["UNTIL"].replace("-", "")[:8], "%Y%m%d").date()
+    if interval < 1 or (count is None and until is None) or (count is not None and count < 1):
+        raise ValueError("A positive INTERVAL and a COUNT or UNTIL are required")
+
+    if freq == "WEEKLY" and "BYDAY" in parts:
+        weekdays = sorted({WEEKDAY_CODES.index(code) for code in parts["BYDAY"].split(",")})
+    else:
+        weekdays = [first_day.weekday()]
+
+    occurrences = []
+    period_start = week_start(first_day) if freq == "WEEKLY" else first_day
+    step = timedelta(weeks=interval) if freq == "WEEKLY" else timedelta(days=interval)
+    while True:
+        if freq == "WEEKLY":
+            candidates = [period_start + timedelta(days=weekday) for weekday in weekdays]
+        else:
+            candidates = [period_start]
+        for day in candidates:
+            if day < first_day:
+                continue
+            if (until and day > until) or (count and len(occurrences) >= count):
+                if not occurrences:
+                    raise ValueError("The repeat rule produces no dates on or after the first date")
+                return occurrences
+            if len(occurrences) >= max_occurrences:
+                raise ValueError(f"A series can have at most {max_occurrences} occurrences")
+            occurrences.append(day)
+        period_start += step
@@ -0,0 +1,97 @@
+"""
+slot_search.py
+
+Vectorized "next available slot" search across doctors.
+
+The search grid covers whole days at SLOT_MINUTES granularity. One boolean
+matrix of doctors x slots is built from the compiled availability calendars,
+booked intervals from the appointment index are subtracted with a
+difference-array pass, and a cumulative sum finds every start with enough
+consecutive free slots for the requested duration.
+"""
+
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from scheduling import SLOT_MINUTES, SLOTS_PER_DAY, SLOTS_PER_WEEK, from_minutes, to_minutes, week_start
+
+
+def week_bits(mask):
+    """Unpack a week availability bitset into a boolean array of SLOTS_PER_WEEK slots."""
+    raw = np.frombuffer(mask.to_bytes(SLOTS_PER_WEEK // 8, "little"), dtype=np.uint8)
+    return np.unpackbits(raw, bitorder="little").astype(bool)
+
+
+def availability_matrix(calendar, doctor_ids, first_day, days):
+    """Boolean (doctors x days * SLOTS_PER_DAY) matrix of available slots."""
+    first_monday = week_start(first_day)
+    weeks = (first_day - first_monday).days + days
+    weeks = -(-weeks // 7)
+    offset = (first_day - first_monday).days * SLOTS_PER_DAY
+
+    matrix = np.zeros((len(doctor_ids), days * SLOTS_PER_DAY), dtype=bool)
+    for row, doctor_id in enumerate(doctor_ids):
+        bits = np.concatenate([
+            week_bits(calendar.week_mask(doctor_id, first_monday + timedelta(weeks=w)))
+            for w in range(weeks)
+        ])
+        matrix[row] = bits[offset:offset + days * SLOTS_PER_DAY]
+    return matrix
+
+
+def booked_matrix(index, doctor_ids, grid_start, n_slots):
+    """Boolean matrix marking slots touched by active appointments."""
+    grid_end = grid_start + n_slots * SLOT_MINUTES
+    rows, firsts, lasts = [], [], []
+    for row, doctor_id in enumerate(doctor_ids):
+        for _, start, end in index.overlapping(doctor_id, grid_start, grid_end):
+            rows.append(row)
+            firsts.append(max(start - grid_start, 0) // SLOT_MINUTES)
+            lasts.append(min(-(-(end - grid_start) // SLOT_MINUTES), n_slots))
+
+    # +1 at the first booked slot, -1 after the last; a running sum > 0 is booked
+    diff = np.zeros((len(doctor_ids), n_slots + 1), dtype=np.int32)
+    if rows:
+        np.add.at(diff, (rows, firsts), 1)
+        np.add.at(diff, (rows, lasts), -1)
+    return np.cumsum(diff[:, :n_slots], axis=1) > 0
+
+
+def find_free_slots(calendar, index, doctor_ids, first_day, last_day, duration,
+                    limit=10, step=15, not_before=None):
+    """
+    Earliest `limit` free (doctor_id, start datetime) pairs between first_day
+    and last_day inclusive, ordered by start time and then by doctor order.
+    Starts are aligned to `step` minutes after midnight.
+    """
+    days = (last_day - first_day).days + 1
+    if not doctor_ids or days <= 0:
+        return []
+
+    n_slots = days * SLOTS_PER_DAY
+    needed = max(-(-int(duration) // SLOT_MINUTES), 1)
+    if needed > n_slots:
+        return []
+    grid_start = to_minutes(datetime.combine(first_day, datetime.min.time()))
+
+    free = availability_matrix(calendar, doctor_ids, first_day, days)
+    free &= ~booked_matrix(index, doctor_ids, grid_start, n_slots)
+
+    # A start is valid when the next `needed` slots are all free
+    counts = np.zeros((len(doctor_ids), n_slots + 1), dtype=np.int32)
+    np.cumsum(free, axis=1, out=counts[:, 1:])
+    valid = (counts[:, needed:] - counts[:, :-needed]) == needed
+
+    starts = np.arange(valid.shape[1])
+    allowed = (starts * SLOT_MINUTES) % max(int(step), SLOT_MINUTES) == 0
+    if not_before is not None:
+        allowed &= grid_start + starts * SLOT_MINUTES >= to_minutes(not_before)
+    valid &= allowed
+
+    # Transposing makes nonzero() return hits ordered by time first
+    slot_positions, rows = np.nonzero(valid.T)
+    return [
+        (doctor_ids[row], from_minutes(grid_start + int(slot) * SLOT_MINUTES))
+        for slot, row in zip(slot_positions[:limit], rows[:limit])
+    ]
@@ -0,0 +1,23 @@
+"""
+wsgi.py
+
+Production entry point, e.g.:
+    gunicorn --preload --workers 4 --bind 0.0.0.0:8000 wsgi:app
+
+The app is built once in the server's master process (APP_PROFILE, default
+"production"): templates are compiled and no database connection is open,
+so forked workers start instantly and share that memory copy-on-write.
+Run `flask --app app init-db` once per deploy, and background jobs with
+`flask --app app run-worker`.
+"""
+
+import gc
+import os
+
+from app import create_app
+
+app = create_app(os.environ.get("APP_PROFILE", "production"))
+
+# Objects built so far live as long as the process; keeping the collector off
+# them stops it touching (and so copying) their pages in every worker
+gc.freeze()